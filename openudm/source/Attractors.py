@@ -0,0 +1,144 @@
+import os
+import numpy as np
+from scipy import ndimage
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+import source.FocalStatistics as fs
+
+############################################################################################################
+# Attractor generators - attractor layers computed in the pipeline instead of read from the data directory
+# A row of attractors.csv uses a generator when its optional 'generator' column is set:
+#   distance_to_development - distance to the current development raster (current_development.asc)
+#   distance_to_feature     - distance to the non-zero cells of the raster named in the 'source' column
+#   travel_cost             - accumulated travel cost to the non-zero cells of 'source' over the cost raster
+#                             named in the 'cost' column (cost per unit distance; NoData or negative is impassable)
+#   focal                   - focal statistic (FocalStatistics.py) of the raster named in 'source', or of the current
+#                             development when no source is given, e.g. the share of developed land within 1 km;
+#                             columns 'kernel' (circular, gaussian or annulus), 'radius' (map units; sigma for
+#                             gaussian), 'inner_radius' (annulus) and 'statistic' (mean or sum, default mean)
+# The optional 'max_distance' column caps distances in map units, which also lets the distance transform run
+# in tiles on large grids. Distances are small near the source, so near = attractive is reverse_polarity_flag 1.
+############################################################################################################
+
+# Tile size (cells per side) of the tiled distance transform
+TILE_SIZE = 2048
+
+
+# Function distance_to_mask: Euclidean distance in map units from every cell to the nearest True cell of mask.
+# With max_distance the grid is processed in tiles, each with a halo wide enough to hold every source cell
+# within max_distance of the tile, and distances are capped at max_distance.
+def distance_to_mask(mask, cellsize, max_distance=None, tile_size=TILE_SIZE):
+    if not mask.any():
+        if max_distance is None:
+            raise ValueError("Distance attractor has no source cells")
+        return np.full(mask.shape, max_distance, dtype=np.float64)
+    if max_distance is None or (mask.shape[0] <= tile_size and mask.shape[1] <= tile_size):
+        distance = ndimage.distance_transform_edt(~mask, sampling=cellsize)
+        return distance if max_distance is None else np.minimum(distance, max_distance)
+
+    nrows, ncols = mask.shape
+    halo = int(np.ceil(max_distance / cellsize))
+    distance = np.empty(mask.shape, dtype=np.float64)
+    for row in range(0, nrows, tile_size):
+        for col in range(0, ncols, tile_size):
+            r0, r1 = max(row - halo, 0), min(row + tile_size + halo, nrows)
+            c0, c1 = max(col - halo, 0), min(col + tile_size + halo, ncols)
+            tile = (slice(row, min(row + tile_size, nrows)), slice(col, min(col + tile_size, ncols)))
+            window = mask[r0:r1, c0:c1]
+            if not window.any():
+                distance[tile] = max_distance
+                continue
+            window_distance = ndimage.distance_transform_edt(~window, sampling=cellsize)
+            distance[tile] = np.minimum(window_distance[row - r0:tile[0].stop - r0, col - c0:tile[1].stop - c0], max_distance)
+    return distance
+
+# Function travel_cost_to_mask: Least accumulated cost from every cell to the nearest True cell of mask, moving between
+# 8-connected neighbours at the mean cost of the two cells times the step length. Unreachable cells get max_distance,
+# or the largest reachable cost when max_distance is not given.
+def travel_cost_to_mask(mask, cost, cellsize, nodata_value, max_distance=None):
+    nrows, ncols = mask.shape
+    passable = (cost != nodata_value) & (cost >= 0)
+    sources = np.flatnonzero(mask & passable)
+    if len(sources) == 0:
+        raise ValueError("Travel cost attractor has no passable source cells")
+
+    index = np.arange(nrows * ncols).reshape(nrows, ncols)
+    heads, tails, weights = [], [], []
+    for drow, dcol in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        a = (slice(0, nrows - drow), slice(max(-dcol, 0), ncols - max(dcol, 0)))
+        b = (slice(drow, nrows), slice(max(dcol, 0), ncols - max(-dcol, 0)))
+        both = passable[a] & passable[b]
+        heads.append(index[a][both])
+        tails.append(index[b][both])
+        weights.append((cost[a][both] + cost[b][both]) / 2 * cellsize * np.hypot(drow, dcol))
+    graph = sparse.coo_matrix((np.concatenate(weights), (np.concatenate(heads), np.concatenate(tails))),
+                              shape=(nrows * ncols, nrows * ncols)).tocsr()
+    accumulated = dijkstra(graph, directed=False, indices=sources, min_only=True, limit=np.inf if max_distance is None else max_distance)
+
+    reachable = np.isfinite(accumulated)
+    fill = max_distance if max_distance is not None else accumulated[reachable].max()
+    return np.where(reachable, accumulated, fill).reshape(nrows, ncols)
+
+
+# Helpers reading the source and cost rasters of a generator
+def _source_mask(raster, nodata_value):
+    return (raster != 0) & (raster != nodata_value)
+
+def _max_distance(spec):
+    value = spec.get('max_distance')
+    return None if value is None or np.isnan(value) else float(value)
+
+def _read_layer(path_to_data, spec, key):
+    if not isinstance(spec.get(key), str):
+        raise ValueError(f"Attractor {spec['layer_name']}: generator {spec['generator']} requires a '{key}' raster")
+    return np.loadtxt(os.path.join(path_to_data, spec[key]), skiprows=6)
+
+
+# Generators: spec is the attractors.csv row; current_dev is the current development array
+def distance_to_development(spec, path_to_data, current_dev, header_values):
+    return distance_to_mask(current_dev == 1, header_values[4], _max_distance(spec))
+
+def distance_to_feature(spec, path_to_data, current_dev, header_values):
+    source = _read_layer(path_to_data, spec, 'source')
+    return distance_to_mask(_source_mask(source, header_values[-1]), header_values[4], _max_distance(spec))
+
+def travel_cost(spec, path_to_data, current_dev, header_values):
+    # Without a source raster, travel cost is measured to the current development
+    source = current_dev == 1 if not isinstance(spec.get('source'), str) else \
+        _source_mask(_read_layer(path_to_data, spec, 'source'), header_values[-1])
+    cost = _read_layer(path_to_data, spec, 'cost')
+    return travel_cost_to_mask(source, cost, header_values[4], header_values[-1], _max_distance(spec))
+
+def focal(spec, path_to_data, current_dev, header_values):
+    values = current_dev if not isinstance(spec.get('source'), str) else _read_layer(path_to_data, spec, 'source')
+    statistic = spec.get('statistic') if isinstance(spec.get('statistic'), str) else 'mean'
+    kernel = spec.get('kernel') if isinstance(spec.get('kernel'), str) else 'circular'
+    inner_radius = spec.get('inner_radius')
+    inner_radius = 0.0 if inner_radius is None or np.isnan(inner_radius) else float(inner_radius)
+    if spec.get('radius') is None or np.isnan(spec['radius']):
+        raise ValueError(f"Attractor {spec['layer_name']}: generator focal requires a 'radius'")
+    layer = fs.focal_statistic(values, header_values[-1], kernel, float(spec['radius']),
+                               header_values[4], statistic, inner_radius)
+    # Cells without a valid neighbourhood add no attraction
+    layer[layer == header_values[-1]] = 0
+    return layer
+
+
+GENERATORS = {
+    'distance_to_development': distance_to_development,
+    'distance_to_feature': distance_to_feature,
+    'travel_cost': travel_cost,
+    'focal': focal,
+}
+
+# Function generator_name: generator of an attractors.csv row, or None for an attractor read from file
+def generator_name(spec):
+    generator = spec.get('generator')
+    return generator.strip() if isinstance(generator, str) and generator.strip() else None
+
+# Function generate_attractor: Compute the attractor layer of an attractors.csv row with its generator
+def generate_attractor(spec, path_to_data, current_dev, header_values):
+    generator = generator_name(spec)
+    if generator not in GENERATORS:
+        raise ValueError(f"Attractor {spec['layer_name']}: unknown generator {generator}, expected one of {', '.join(GENERATORS)}")
+    return GENERATORS[generator](spec, path_to_data, current_dev, header_values)
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import heapq
+import itertools
+import traceback
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+import source.RasterIO as rio
+import source.RasterToolkit as rt
+import source.RasterCatalog as rc
+
+############################################################################################################
+# Multi-area batch runs
+# Each area is a data directory under one root (a subdirectory holding parameters.csv and its zones, zone_identity.asc or
+# the vector file named by zones_vector in parameters.csv), run through main.main into the subdirectory of the same name
+# under the output root. Areas are queued largest first (by grid size) on a local process pool, so the long runs
+# start early and the small ones fill the gaps. Every run gets a fresh worker process, optionally under an
+# address-space limit, and its printed output goes to run.log in its output directory; a failed run (an exception,
+# a memory limit or a killed worker) is queued again up to the number of retries. The out_cell_dev rasters of the completed areas are then mosaicked into one
+# grid covering every area, streamed row block by row block into their windows of a disk-backed array.
+############################################################################################################
+
+# Files every area holds, besides its zones
+AREA_FILES = ['parameters.csv']
+# Zone identity raster of an area whose zones are not given as a vector file
+ZONE_RASTER = 'zone_identity.asc'
+
+
+# Function area_grid_raster: Raster with the grid an area runs on - the reference raster its vector zones are rasterised onto
+# (see main.zone_reference_raster), or its zone identity raster; None when path_to_data is not an area
+def area_grid_raster(path_to_data):
+    if not all(os.path.exists(os.path.join(path_to_data, file_name)) for file_name in AREA_FILES):
+        return None
+    import source.main as main
+    parameters = pd.read_csv(os.path.join(path_to_data, 'parameters.csv')).to_dict(orient='records')[0]
+    if main.text_parameter(parameters, 'zones_vector') is not None:
+        return main.zone_reference_raster(path_to_data, parameters, main.generate_table_filepaths(path_to_data, path_to_data))
+    zone_ras = os.path.join(path_to_data, ZONE_RASTER)
+    return zone_ras if os.path.exists(zone_ras) else None
+
+# Function find_areas: Areas under path_to_areas, as dictionaries of name, data path and grid size (cells)
+def find_areas(path_to_areas):
+    areas = []
+    for name in sorted(os.listdir(path_to_areas)):
+        path_to_data = os.path.join(path_to_areas, name)
+        grid_raster = area_grid_raster(path_to_data) if os.path.isdir(path_to_data) else None
+        if grid_raster is not None:
+            header = rc.read_header(grid_raster)
+            areas.append({'name': name, 'path_to_data': path_to_data, 'cells': header['ncols'] * header['nrows']})
+    return areas
+
+
+# Function run_area: Run the model for one area in a worker process; returns the run time in seconds.
+# memory_limit_mb sets the worker's address-space limit (RLIMIT_AS, where available), so a run that outgrows it
+# fails with a MemoryError instead of exhausting the machine.
+def run_area(path_to_data, path_to_output, memory_limit_mb=None, checkpoint=False):
+    if memory_limit_mb:
+        import resource
+        limit = int(memory_limit_mb) * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    import source.main as main
+
+    os.makedirs(path_to_output, exist_ok=True)
+    start = time.perf_counter()
+    with open(os.path.join(path_to_output, 'run.log'), 'a') as log, redirect_stdout(log):
+        try:
+            # Resume from the checkpoint of a failed attempt, if there is one
+            main.main(path_to_data, path_to_output, checkpoint=checkpoint, resume=checkpoint)
+        except BaseException:
+            traceback.print_exc(file=log)
+            raise
+    return time.perf_counter() - start
+
+
+# Function run_batch: Run every area on a process pool, largest first, retrying failed runs.
+# Returns one dictionary per area with its status ('done' or 'failed'), attempts, run time and last error.
+def run_batch(areas, path_to_output, max_workers=None, memory_limit_mb=None, retries=1, checkpoint=False):
+    workers = max(1, max_workers or os.cpu_count() or 1)
+    areas = {area['name']: area for area in areas}
+    results = {name: {'area': name, 'cells': area['cells'], 'status': 'queued', 'attempts': 0, 'seconds': np.nan, 'error': ''}
+               for name, area in areas.items()}
+    # Queue ordered on decreasing grid size; ties keep the order of the areas
+    order = itertools.count()
+    queue = [(-area['cells'], next(order), name) for name, area in areas.items()]
+    heapq.heapify(queue)
+
+    # Fresh worker processes (spawned, one run each), so a memory limit or a crash does not outlive its run
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), max_tasks_per_child=1)
+
+    executor = new_executor()
+    running = {}
+    try:
+        while queue or running:
+            while queue and len(running) < workers:
+                _, _, name = heapq.heappop(queue)
+                results[name]['attempts'] += 1
+                future = executor.submit(run_area, areas[name]['path_to_data'], os.path.join(path_to_output, name),
+                                         memory_limit_mb, checkpoint)
+                running[future] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                name = running.pop(future)
+                result = results[name]
+                try:
+                    result['seconds'] = future.result()
+                    result['status'] = 'done'
+                    print(f"Area {name} completed in {result['seconds']:.1f} s.")
+                except Exception as err:
+                    # A killed worker breaks the pool and fails every run in it; those runs are queued again as well
+                    broken = broken or isinstance(err, BrokenProcessPool)
+                    result['error'] = f"{type(err).__name__}: {err}"
+                    if result['attempts'] <= retries:
+                        print(f"Area {name} failed ({result['error']}), retrying.")
+                        heapq.heappush(queue, (-result['cells'], next(order), name))
+                    else:
+                        result['status'] = 'failed'
+                        print(f"Area {name} failed after {result['attempts']} attempts: {result['error']}")
+
+            # A broken pool accepts no more runs; replace it once its remaining runs have failed
+            if broken:
+                for future in running:
+                    future.exception()
+                executor.shutdown(wait=True)
+                executor = new_executor()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return [results[name] for name in areas]
+
+
+# Function mosaic_rasters: Mosaic ESRI ASCII grids with the same cell size and alignment into one grid covering them all.
+# Each raster is read a block of rows at a time and its data cells are copied into its window of a disk-backed array
+# (memory use is one block, whatever the size of the mosaic), which is then written to output_path.
+def mosaic_rasters(file_paths, output_path, fmt='%d', block_rows=rio.WRITE_BLOCK_ROWS):
+    headers = [rc.read_header(file_path) for file_path in file_paths]
+    cellsize, nodata = headers[0]['cellsize'], headers[0]['nodata_value']
+    for file_path, header in zip(file_paths, headers):
+        if header['cellsize'] != cellsize or header['nodata_value'] != nodata:
+            raise ValueError(f"{file_path}: cell size and NODATA value must match those of {file_paths[0]}")
+
+    # Extent of the mosaic, and the window of each raster in it
+    xll = min(header['xllcorner'] for header in headers)
+    yll = min(header['yllcorner'] for header in headers)
+    xur = max(header['xllcorner'] + header['ncols'] * cellsize for header in headers)
+    yur = max(header['yllcorner'] + header['nrows'] * cellsize for header in headers)
+    ncols, nrows = int(round((xur - xll) / cellsize)), int(round((yur - yll) / cellsize))
+    header_values = [ncols, nrows, xll, yll, cellsize, nodata]
+
+    mosaic_path = output_path + '.mosaic.npy'
+    mosaic = np.lib.format.open_memmap(mosaic_path, mode='w+', dtype=np.float64, shape=(nrows, ncols))
+    try:
+        mosaic[:] = nodata
+        for file_path, header in zip(file_paths, headers):
+            col0 = int(round((header['xllcorner'] - xll) / cellsize))
+            row0 = int(round((yur - header['yllcorner'] - header['nrows'] * cellsize) / cellsize))
+            if abs(col0 * cellsize - (header['xllcorner'] - xll)) > 1e-6 * cellsize or abs(row0 * cellsize - (yur - header['yllcorner'] - header['nrows'] * cellsize)) > 1e-6 * cellsize:
+                raise ValueError(f"{file_path} is not aligned with the grid of {file_paths[0]}")
+            with open(file_path) as f:
+                for _ in range(6):
+                    f.readline()
+                for start in range(0, header['nrows'], block_rows):
+                    block = np.loadtxt(list(itertools.islice(f, block_rows)), ndmin=2)
+                    window = mosaic[row0 + start:row0 + start + block.shape[0], col0:col0 + header['ncols']]
+                    data = block != nodata
+                    window[data] = block[data]
+        rio.write_raster_now(mosaic, output_path, rt.header_lines(header_values), fmt)
+    finally:
+        del mosaic
+        os.remove(mosaic_path)
+    return header_values
+
+
+# Function batch: Run every area under path_to_areas into path_to_output, write batch_summary.csv and mosaic the
+# out_cell_dev rasters of the completed areas into path_to_output/out_cell_dev.asc
+def batch(path_to_areas, path_to_output, max_workers=None, memory_limit_mb=None, retries=1, checkpoint=False):
+    areas = find_areas(path_to_areas)
+    print(f"Batch of {len(areas)} areas, {max_workers or os.cpu_count()} workers.")
+    os.makedirs(path_to_output, exist_ok=True)
+    results = run_batch(areas, path_to_output, max_workers, memory_limit_mb, retries, checkpoint)
+    pd.DataFrame(results).to_csv(os.path.join(path_to_output, 'batch_summary.csv'), index=False)
+
+    completed = [os.path.join(path_to_output, result['area'], 'out_cell_dev.asc') for result in results if result['status'] == 'done']
+    if completed:
+        mosaic_rasters(completed, os.path.join(path_to_output, 'out_cell_dev.asc'))
+    num_failed = len(results) - len(completed)
+    print(f"Batch completed: {len(completed)} areas mosaicked, {num_failed} failed.")
+    return results
+
+
+if __name__ == "__main__":
+    # Usage: python -m source.Batch path_to_areas path_to_output [--workers n] [--memory-mb m] [--retries r] [--checkpoint]
+    import getopt
+    usage = 'Usage: python -m source.Batch path_to_areas path_to_output [--workers n] [--memory-mb m] [--retries r] [--checkpoint]'
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["workers=", "memory-mb=", "retries=", "checkpoint"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    if len(args) != 2:
+        print(usage)
+        sys.exit(2)
+    options = dict(opts)
+    results = batch(args[0], args[1], max_workers=int(options['--workers']) if '--workers' in options else None,
+                    memory_limit_mb=int(options['--memory-mb']) if '--memory-mb' in options else None,
+                    retries=int(options.get('--retries', 1)), checkpoint='--checkpoint' in options)
+    sys.exit(0 if all(result['status'] == 'done' for result in results) else 1)
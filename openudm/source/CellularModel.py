@@ -1,12 +1,30 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
+from scipy.ndimage import find_objects
+import source.Kernels as kn
+import source.RasterIO as rio
+import source.RasterToolkit as rt
+import source.Events as ev
+import source.ZoneIndex as zi
+import source.SharedRasters as sr
+from source.PackedMask import read_mask
 
 
 # Function RunModel
-def run_model(num_zones,parameters, table_files, raster_files,header_values):
-
-    # read zone_id_ras
-    zone_id_ras = np.loadtxt(raster_files['zone_id_ras'], skiprows=6)
+# rasters: optional dictionary of preloaded rasters (see load_model_rasters), e.g. read-only views attached from a
+# SharedRasterPool by a worker process; when not given the rasters are read from raster_files. The population and dwelling
+# density of the new development (out_cell_pph, out_cell_dph) are added to it, keyed as in raster_files
+# checkpoint: optional Checkpoint; the cells developed in each zone are stored and reapplied when resuming
+# model_workers in parameters.csv (default 1) ranks the zones of the rank raster on that many worker processes, sharing the
+# rasters through shared memory (see development_rank_raster)
+def run_model(num_zones,parameters, table_files, raster_files,header_values, rasters=None, checkpoint=None):
+
+    # read the zone ID, patch ID, patch suitability, cell suitability and current development rasters
+    if rasters is None:
+        rasters = load_model_rasters(raster_files, header_values[5])
+    zone_id_ras = rasters['zone_id_ras']
 
     # read parameters from parameters.csv
     maximum_plot_size = parameters['maximum_plot_size']
@@ -16,41 +34,127 @@ def run_model(num_zones,parameters, table_files, raster_files,header_values):
     zone_ids,zone_codes, zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare = \
         get_zone_data(density_calculation_type, table_files, parameters)   
 
-    # Read the patch ID, suitability, cell suitability and current development rasters
-    dev_patchid_array = np.loadtxt(raster_files['dev_patch_id_ras'], skiprows=6)
-    dev_patch_suit_array = np.loadtxt(raster_files['dev_patch_suit_ras'], skiprows=6)
-    cell_suit_ras = np.loadtxt(raster_files['cell_suit_ras'], skiprows=6)
-    current_dev_ras = np.loadtxt(raster_files['current_dev_ras'], skiprows=6)
+    dev_patchid_array = rasters['dev_patch_id_ras']
+    dev_patch_suit_array = rasters['dev_patch_suit_ras']
+    cell_suit_ras = rasters['cell_suit_ras']
+    # The current development is a packed mask (PackedMask.py), unpacked a zone window at a time
+    current_dev_mask = rasters['current_dev_mask']
         
-    #CalculateRequiredDevelopment
-    num_req_cells_zones = [calculate_required_cells(density_calculation_type,
-                             current_dev_ras, zone_id_ras, zone_label,
-                             zone_cur_pop[zone_label], zone_fut_pop[zone_label],
-                             dwellings_increase[zone_label],
-                             dwellings_per_hectare) for zone_label in zone_ids]
+    # Zone windows: every per-zone count, mask and growth below works on the zone's bounding box window of the grid
+    zone_index = get_zone_index(raster_files, header_values, zone_id_ras)
+    windows = zi.zone_windows(zone_index)
+
+    # Variable density (density types 2 and 4): each zone develops its cells in development order (the rank raster) until
+    # the cumulative dwelling capacity of the cells meets its dwellings increase; a zone is an overflow zone when the capacity
+    # of all its patch cells falls short
+    variable_density = density_calculation_type in VARIABLE_DENSITY_TYPES
+    rank_ras = None
+    if variable_density:
+        rank_ras = development_rank_raster(zone_ids, windows, zone_id_ras, dev_patchid_array, dev_patch_suit_array, cell_suit_ras, header_values[5],
+                                           int(parameters.get('model_workers', 1)))
+        density_ras = rio.read_raster(raster_files['density_ras'])
+        cell_capacity = cell_dwelling_capacity(density_ras, header_values)
+        num_req_cells_zones, overFlow_array, num_suitCells = variable_density_required_cells(rank_ras, zone_id_ras, cell_capacity, zone_ids,
+                                                                                             dwellings_increase, windows)
+    else:
+        #CalculateRequiredDevelopment
+        num_req_cells_zones = [calculate_required_cells(density_calculation_type,
+                                 current_dev_mask.window_bool(zi.zone_window(windows, zone_label)), zone_id_ras[zi.zone_window(windows, zone_label)], zone_label,
+                                 zone_cur_pop[zone_label], zone_fut_pop[zone_label],
+                                 dwellings_increase[zone_label],
+                                 dwellings_per_hectare) for zone_label in zone_ids]
         
+    # Coarse-to-fine allocation (coarse_factor > 1 in parameters.csv): the zone capacities and the patches each zone develops
+    # come from a per-patch table with coarse block extents, and the fine grid is only read in the blocks of those patches
+    coarse_factor = int(parameters.get('coarse_factor', 0))
+    patch_table = coarse_patch_table(dev_patchid_array, zone_id_ras, dev_patch_suit_array, coarse_factor) if coarse_factor > 1 and not variable_density else None
+
     #Find overflow zones: assuming patch id are integers
-    overFlow_array,num_suitCells = find_overflow_zones(dev_patchid_array, zone_id_ras, zone_ids, num_req_cells_zones)
+    if variable_density:
+        pass
+    elif patch_table is not None:
+        overFlow_array, num_suitCells = find_overflow_zones_coarse(patch_table, zone_ids, num_req_cells_zones)
+    else:
+        overFlow_array,num_suitCells = find_overflow_zones(dev_patchid_array, zone_id_ras, zone_ids, num_req_cells_zones, windows)
+
+    # Optionally move the unmet demand of overflow zones to neighbouring zones with spare suitable capacity
+    num_dev_cells_zones = num_req_cells_zones
+    redistribution = None
+    if parameters.get('overflow_redistribution', 0) and not variable_density:
+        num_dev_cells_zones, unmet_cells, received_cells = redistribute_overflow(zone_ids, num_req_cells_zones, num_suitCells, zone_index,
+                                                                                  int(parameters.get('overflow_max_rounds', 3)))
+        redistribution = (unmet_cells, received_cells)
     
     #number of non overflow zones
     num_nonOverflowZones = (overFlow_array==False).sum()
     num_OverflowZones = num_zones - num_nonOverflowZones
     
+    # Rank allocation: grow every zone once to full capacity, recording each cell's development rank; the development for
+    # the required cells of each zone is then the cells of rank below it - the same cells as the zone by zone development
+    if parameters.get('rank_allocation', 0) or variable_density:
+        if rank_ras is None:
+            rank_ras = development_rank_raster(zone_ids, windows, zone_id_ras, dev_patchid_array, dev_patch_suit_array, cell_suit_ras, header_values[5],
+                                           int(parameters.get('model_workers', 1)))
+        # out_cell_rank holds the ranks of the patch cells; the other cells are written as the NODATA value of its header
+        if 'cell_rank_ras' in raster_files:
+            rio.write_raster(np.where(rank_ras >= 0, rank_ras, header_values[5]), raster_files['cell_rank_ras'], rt.header_lines(header_values))
+        print('Development rank raster computed for', len(zone_ids), 'zones.')
+        new_development = allocate_from_rank(rank_ras, zone_id_ras, current_dev_mask.to_array(header_values[5]), zone_ids, num_dev_cells_zones)
+        write_zone_diagnostic_table(zone_ids, zone_codes, overFlow_array, zone_cur_pop, zone_fut_pop, 
+                                    dwellings_increase, dwellings_per_hectare, num_req_cells_zones, 
+                                    num_suitCells, current_dev_mask, header_values, table_files, redistribution)
+        rasters.update(write_development_density(raster_files, parameters, header_values, new_development, current_dev_mask, zone_id_ras,
+                                                 zone_ids, overFlow_array, num_suitCells, zone_cur_pop, zone_fut_pop, dwellings_increase,
+                                                 dwellings_per_hectare, density_ras if variable_density else None) or {})
+        return new_development
+
+    # All zones are developed into one new development raster
+    new_development = current_dev_mask.to_array(header_values[5])
+    # Zone progress events (Events.py), with the cells developed in each zone
+    progress = ev.Progress('zone', 'run_model', num_zones)
+
     #Develop non-overflow zones
     if num_nonOverflowZones > 0:
         print('Developing ', num_nonOverflowZones, ' non-overflow zones.')
         # get the indices of non-overflow zones
         nonOverflow_zones_ids = zone_ids[overFlow_array==False]
         for zone_id in nonOverflow_zones_ids:
-            new_development = develop_one_non_overflow_zone(current_dev_ras, num_req_cells_zones[zone_id], dev_patchid_array, 
-                                                            dev_patch_suit_array, cell_suit_ras, header_values[5])
+            if restore_zone_development(checkpoint, zone_id, new_development):
+                progress.advance(zone_id=zone_id, cells=num_dev_cells_zones[zone_id], restored=True)
+                continue
+            if patch_table is not None:
+                selection = select_zone_patches(patch_table, zone_id, num_dev_cells_zones[zone_id])
+                window = selection[2] if selection is not None else (slice(0, 0), slice(0, 0))
+                before = new_development[window].copy() if checkpoint is not None else None
+                if selection is not None:
+                    develop_selected_patches(selection, num_dev_cells_zones[zone_id], dev_patchid_array, cell_suit_ras, new_development)
+                save_zone_development(checkpoint, zone_id, before, new_development, window)
+                progress.advance(zone_id=zone_id, cells=num_dev_cells_zones[zone_id])
+                continue
+            # Only the patches of the current zone are candidates for its development; the zone is developed in its window,
+            # through a view of the new development raster, so all zones accumulate in it (the legacy model kept the last zone)
+            window = zi.zone_window(windows, zone_id)
+            zone_patchid_array = np.where(zone_id_ras[window] == zone_id, dev_patchid_array[window], 0)
+            before = new_development[window].copy() if checkpoint is not None else None
+            develop_one_non_overflow_zone(current_dev_mask.window_bool(window), num_dev_cells_zones[zone_id], zone_patchid_array, 
+                                          dev_patch_suit_array[window], cell_suit_ras[window], header_values[5], new_development[window])
+            save_zone_development(checkpoint, zone_id, before, new_development, window)
+            progress.advance(zone_id=zone_id, cells=num_dev_cells_zones[zone_id])
     
     #Develop overflow zones
     if num_OverflowZones > 0:
         print('Developing', num_OverflowZones, 'overflow zones.')
         overflow_zones_ids = zone_ids[overFlow_array==True]
         for zone_id in overflow_zones_ids:
-            new_development = develop_one_overflow_zone(current_dev_ras,dev_patchid_array, zone_id_ras, zone_id)    
+            if restore_zone_development(checkpoint, zone_id, new_development):
+                progress.advance(zone_id=zone_id, cells=num_suitCells[zone_id], overflow=True, restored=True)
+                continue
+            window = zi.zone_window(windows, zone_id)
+            before = new_development[window].copy() if checkpoint is not None else None
+            develop_one_overflow_zone(current_dev_mask.window_bool(window), dev_patchid_array[window], zone_id_ras[window], zone_id, new_development[window])
+            save_zone_development(checkpoint, zone_id, before, new_development, window)
+            progress.advance(zone_id=zone_id, cells=num_suitCells[zone_id], overflow=True)
+    progress.end()
     
     # Write admin zone diagnostic table to csv
     # Calculate the developed number of cells: for non-overflow zones, it is the required number of cells; 
@@ -58,7 +162,10 @@ def run_model(num_zones,parameters, table_files, raster_files,header_values):
 
     write_zone_diagnostic_table(zone_ids, zone_codes, overFlow_array, zone_cur_pop, zone_fut_pop, 
                                 dwellings_increase, dwellings_per_hectare, num_req_cells_zones, 
-                                num_suitCells, current_dev_ras, header_values, table_files)
+                                num_suitCells, current_dev_mask, header_values, table_files, redistribution)
+    rasters.update(write_development_density(raster_files, parameters, header_values, new_development, current_dev_mask, zone_id_ras, zone_ids,
+                                             overFlow_array, num_suitCells, zone_cur_pop, zone_fut_pop, dwellings_increase,
+                                             dwellings_per_hectare) or {})
 
     return new_development
 
@@ -66,11 +173,20 @@ def run_model(num_zones,parameters, table_files, raster_files,header_values):
 # Functions related to Runmodel
 ####################################################################################################################
 
+# Function load_model_rasters: Read the rasters used by run_model into a dictionary keyed as in raster_files; the current
+# development raster is read as a packed mask, keyed current_dev_mask
+def load_model_rasters(raster_files, nodata_value):
+    keys = ['zone_id_ras', 'dev_patch_id_ras', 'dev_patch_suit_ras', 'cell_suit_ras']
+    rasters = {key: rio.read_raster(raster_files[key]) for key in keys}
+    rasters['current_dev_mask'] = read_mask(raster_files['current_dev_ras'], nodata_value)
+    return rasters
+
 # Function get_zone_data: This function reads the zone data based on the density calculation type.
 # If density_calculation_type is 1, it reads the current and future population data.
-# If density_calculation_type is 2, it reads the current and future dwellings data.
+# If density_calculation_type is 2, it reads the dwellings increase, met from the per-cell capacity of the density raster.
 # If density_calculation_type is 3, it reads the current and future dwellings data and the dwellings per hectare value.
-# If density_calculation_type is 4, TBC.
+# If density_calculation_type is 4, it reads the current and future population data; the population change in dwellings
+# (people_per_dwelling) is met from the per-cell capacity of the density raster.
 def get_zone_data(density_calculation_type, table_files, parameters):
     zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare = (0, 0, 0, 0)
     # Validate the density calculation type
@@ -82,11 +198,11 @@ def get_zone_data(density_calculation_type, table_files, parameters):
         # Read from population.csv admin_zone, current_population, future_population
         zone_ids,zone_codes, zone_cur_pop, zone_fut_pop = pd.read_csv(table_files['population_tbl'], usecols=[0, 1, 2, 3]).values.T
         
-    # Option 2 - Calculate required development based on dwellings change
-    # elif density_calculation_type == 2:
-    #     # Read from dwellings.csv admin_zone, current_dwellings, future_dwellings
-    #     zone_ids,zone_codes, dwellings_increase = pd.read_csv(table_files['dwellings_tbl'], usecols=[0, 1, 2]).values.T
-    #     zone_cur_pop, zone_fut_pop = pd.read_csv(table_files['population_tbl'], usecols=[2, 3]).values.T
+    # Option 2 - Variable density: the dwellings increase is met from the per-cell dwelling capacity of the density raster
+    elif density_calculation_type == 2:
+        # Read from dwellings.csv admin_zone, zone_code, dwellings_increase
+        zone_ids,zone_codes, dwellings_increase = pd.read_csv(table_files['dwellings_tbl'], usecols=[0, 1, 2]).values.T
+        zone_cur_pop, zone_fut_pop = pd.read_csv(table_files['population_tbl'], usecols=[2, 3]).values.T
     
     # Option 3 - Calculate required development based on dwellings change and dwellings per hectare
     elif density_calculation_type == 3:
@@ -94,25 +210,33 @@ def get_zone_data(density_calculation_type, table_files, parameters):
         dwellings_per_hectare = parameters['dwellings_per_hectare']
         zone_cur_pop, zone_fut_pop = pd.read_csv(table_files['population_tbl'], usecols=[2, 3]).values.T
     
-    # Option 4 - Placeholder for variable density calculation methods
+    # Option 4 - Variable density: the population change, in dwellings of people_per_dwelling, is met from the per-cell
+    # dwelling capacity of the density raster
     elif density_calculation_type == 4:
-        pass
+        zone_ids,zone_codes, zone_cur_pop, zone_fut_pop = pd.read_csv(table_files['population_tbl'], usecols=[0, 1, 2, 3]).values.T
+        dwellings_increase = (zone_fut_pop - zone_cur_pop) / parameters['people_per_dwelling']
     
     return zone_ids,zone_codes, zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare
 
 # Function find_overflow_zones: This function finds the overflow zones based on the number of required development cells.
-def find_overflow_zones(dev_patchid_array, zone_id_ras, adminzone_idx, num_req_cells_zones):
-    num_suitCells = [(dev_patchid_array[zone_id_ras == zone_label] > 0).sum() for zone_label in adminzone_idx]
+# Each zone's suitable cells are counted in its window only (see ZoneIndex.zone_windows).
+def find_overflow_zones(dev_patchid_array, zone_id_ras, adminzone_idx, num_req_cells_zones, windows):
+    num_suitCells = [int(np.count_nonzero((dev_patchid_array[zi.zone_window(windows, zone_label)] > 0)
+                                          & (zone_id_ras[zi.zone_window(windows, zone_label)] == zone_label))) for zone_label in adminzone_idx]
     overFlow_array = np.asarray(num_suitCells) < np.asarray(num_req_cells_zones)
     return overFlow_array.flatten(),num_suitCells
 
-def write_zone_diagnostic_table(zone_ids, zone_codes, overFlow_array, zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare, num_req_cells_zones, num_suitCells, current_dev_ras, header_values, table_files):
-    developed_cells = [num_req_cells_zones[zone_id] if not overFlow_array[zone_id] else num_suitCells[zone_id] for zone_id in zone_ids]
+# current_dev_mask: the current development as a PackedMask
+# redistribution: optional (unmet cells, received cells) per zone from redistribute_overflow, added as two columns
+def write_zone_diagnostic_table(zone_ids, zone_codes, overFlow_array, zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare, num_req_cells_zones, num_suitCells, current_dev_mask, header_values, table_files,
+                                redistribution=None):
+    received_cells = redistribution[1] if redistribution is not None else np.zeros(len(zone_ids))
+    developed_cells = [num_req_cells_zones[zone_id] + received_cells[zone_id] if not overFlow_array[zone_id] else num_suitCells[zone_id] for zone_id in zone_ids]
 
     areas_required = np.array(num_req_cells_zones) * header_values[4]**2
 
     areas_developed = np.array(developed_cells) * header_values[4]**2
-    current_pop_cell_density = zone_cur_pop / current_dev_ras[current_dev_ras==1].sum()
+    current_pop_cell_density = zone_cur_pop / current_dev_mask.count()
     future_pop_cell_density = (zone_fut_pop-zone_cur_pop) / developed_cells
 
     zone_diagnostic_tbl = pd.DataFrame({'AdminZone': zone_codes, 'Overflow': overFlow_array, 
@@ -121,7 +245,82 @@ def write_zone_diagnostic_table(zone_ids, zone_codes, overFlow_array, zone_cur_p
                                         'RequiredDevelopmentCells': num_req_cells_zones,'ActualDevelopedCells': developed_cells,
                                         'AreaRequired':areas_required, 'AreaDeveloped':areas_developed, 
                                         'CurrentPopCellDensity':current_pop_cell_density, 'FuturePopCellDensity':future_pop_cell_density,})
+    if redistribution is not None:
+        zone_diagnostic_tbl['UnmetCells'] = redistribution[0]
+        zone_diagnostic_tbl['ReceivedCells'] = redistribution[1]
     zone_diagnostic_tbl.to_csv(table_files['zone_diagnostic_tbl'], index=False)
+
+####################################################################################################################
+# Functions related to checkpointing the zone development
+####################################################################################################################
+
+# Function save_zone_development: Store the cells newly developed in a zone (the difference with the raster before it);
+# with a window, before is the window of the raster before the zone was developed
+def save_zone_development(checkpoint, zone_id, before, new_development, window=None):
+    if checkpoint is not None:
+        if window is None:
+            cells = np.flatnonzero(new_development != before)
+        else:
+            cells = zi.window_cells(np.flatnonzero(new_development[window] != before), window, new_development.shape)
+        checkpoint.save_zone('run_model', zone_id, cells=cells.astype(np.int64))
+
+# Function restore_zone_development: Reapply the stored development of a completed zone; returns False if there is none
+def restore_zone_development(checkpoint, zone_id, new_development):
+    if checkpoint is None or not checkpoint.zone_done('run_model', zone_id):
+        return False
+    new_development.flat[checkpoint.load_zone('run_model', zone_id)['cells']] = 1
+    return True
+
+####################################################################################################################
+# Functions related to overflow redistribution
+####################################################################################################################
+
+# Function get_zone_index: Zone index of the zone identity raster, cached at raster_files['zone_index'] when given
+def get_zone_index(raster_files, header_values, zone_id_ras):
+    if 'zone_index' in raster_files:
+        return zi.load_zone_index(raster_files['zone_id_ras'], raster_files['zone_index'], header_values[5], header_values[4], zone_id_ras)
+    return zi.build_zone_index(zone_id_ras, header_values[5], header_values[4])
+
+# Function redistribute_overflow: Move the unmet demand of overflow zones (required minus suitable cells) to neighbouring zones
+# with spare suitable capacity, over the zone adjacency graph. In each round a zone with unmet demand fills its neighbours'
+# spare capacity, longest shared boundary first; what is left is carried to its longest-boundary neighbour, whose own
+# neighbours are tried in the next round. Demand still unplaced after max_rounds is dropped.
+# Zones of the tables without cells in the zone raster have no neighbours: their unmet demand stays with them and they receive none.
+# Returns the number of cells to develop per zone (required plus received), and the unmet and received cells per zone.
+def redistribute_overflow(zone_ids, num_req_cells_zones, num_suitCells, zone_index, max_rounds):
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    present = np.isin(zone_ids, zone_index['zone_ids'])
+    positions = np.searchsorted(zone_index['zone_ids'], zone_ids[present])
+    num_req = np.asarray(num_req_cells_zones, dtype=float)
+    num_suit = np.asarray(num_suitCells, dtype=float)
+    initial_unmet = np.maximum(num_req - num_suit, 0)
+    unmet = np.zeros(len(zone_index['zone_ids']))
+    spare = np.zeros(len(zone_index['zone_ids']))
+    received = np.zeros(len(zone_index['zone_ids']))
+    unmet[positions] = initial_unmet[present]
+    spare[positions] = np.maximum(num_suit - num_req, 0)[present]
+
+    for _ in range(max_rounds):
+        if not unmet.any():
+            break
+        carried = np.zeros(len(unmet))
+        for i in np.flatnonzero(unmet):
+            neighbours, _ = zi.zone_neighbours(zone_index, i)
+            for j in neighbours:
+                moved = min(unmet[i], spare[j])
+                spare[j] -= moved
+                received[j] += moved
+                unmet[i] -= moved
+            if unmet[i] > 0 and len(neighbours) > 0:
+                carried[neighbours[0]] += unmet[i]
+                unmet[i] = 0
+        unmet += carried
+    if unmet.any():
+        print('Overflow redistribution left', unmet.sum(), 'cells of demand unplaced.')
+
+    zone_received = np.zeros(len(zone_ids))
+    zone_received[present] = received[positions]
+    return num_req + zone_received, initial_unmet, zone_received
 ####################################################################################################################
 # Functions related to calculate required number of development cells
 ####################################################################################################################
@@ -228,17 +427,13 @@ def calculate_required_cells(density_calculation_type,
     if density_calculation_type == 1:
         num_req_cells = calculate_req_cells_population(current_dev_ras, zone_id_ras, zone_label, zone_cur_pop, zone_fut_pop)
     
-    # # Calculate required cells based on dwellings
-    # elif density_calculation_type == 2:
-    #     num_req_cells = calculate_req_cells_dwellings(current_dev_ras, zone_id_ras, zone_label, zone_cur_dwellings, zone_fut_dwellings)
-    
     # Calculate required cells based on dwellings per hectare
     elif density_calculation_type == 3:
         num_req_cells = calculate_req_cells_DwellingsPerHectare(dwellings_increase, dwellings_per_hectare)
     
-    # Placeholder for future density calculation type
-    elif density_calculation_type == 4:
-        pass
+    # Variable density types (2 and 4) depend on the development order: see variable_density_required_cells
+    else:
+        raise ValueError(f"density_calculation_type {density_calculation_type} uses variable_density_required_cells")
     
     return num_req_cells
 
@@ -257,146 +452,330 @@ def get_patch_indices(dev_patchid_array, nodata_value):
 
 # Function get_patch_suitability: Given the patch ID array, the suitability array, and the patch indices,
 # this function returns the suitability values for cells with the specified patch indices.
+# The patch suitability is constant over a patch, so it is read at the first cell of each patch.
 def get_patch_suitability(dev_patchid_array, dev_patch_suit_array, patch_idx):
     if len(patch_idx) == 0:
         print('The patch indices are empty.')
         return np.array([])
     else:
-        patch_suit = np.array([dev_patch_suit_array[dev_patchid_array == patch][0] for patch in patch_idx])
-        return patch_suit
+        patch_ids_flat = dev_patchid_array.ravel()
+        first_cells = np.flatnonzero(np.isin(patch_ids_flat, patch_idx))
+        ids, first_idx = np.unique(patch_ids_flat[first_cells], return_index=True)
+        patch_suit = dev_patch_suit_array.ravel()[first_cells[first_idx]]
+        return patch_suit[np.searchsorted(ids, patch_idx)]
 
 # Helper funciton: Sorts patch indices based on their suitability scores.
 def sort_patch_indices_by_suitability(patch_idx, patch_suit):
     return patch_idx[np.argsort(patch_suit)]
 
-# Function develop_entire_patch: Given the new development raster, the patch ID array, a patch ID, the number of new development cells,
-# and the number of cells in the patch, this function updates the new development raster by developing the entire patch.  
-def develop_entire_patch(new_development_ras, dev_patchid_array, patch_id, num_new_dev_cells,num_patchcells):
-    num_new_dev_cells += num_patchcells
-    new_development_ras[dev_patchid_array == patch_id] = 1
+# Function develop_entire_patch: Given the new development raster, the flat indices of the patch cells and the number of new
+# development cells, this function updates the new development raster by developing the entire patch.  
+def develop_entire_patch(new_development_ras, patch_cells, num_new_dev_cells):
+    num_new_dev_cells += len(patch_cells)
+    new_development_ras.flat[patch_cells] = 1
     return num_new_dev_cells, new_development_ras
 
-# Function initialize_patch_potential_cells: Given the development area patch ID array and a patch ID,
-# this function initializes the potential cells to be the cells in the patch.
-def initialize_patch_potential_cells(dev_patchid_array, patch_id):
-    patch_cells = np.argwhere(dev_patchid_array == patch_id)
-    potential_cells = {tuple(cell) for cell in patch_cells}
-    return potential_cells
-
-# Function develop_seed_cell: Given the new development raster, the cell suitability raster, the number of new development cells,
-# the potential cells, and the seed cells set, this function finds the cell with the highest suitability in the potential cells,
-# develops it, and adds it to the seed cells set. 
-# The functions updates the new development raster, the number of new development cells, the seed cells set, and the potential cells set.
-def develop_seed_cell(new_development_ras, cell_suit_ras, num_new_dev_cells,potential_cells,seed_cells):
-    potential_cells_list = list(potential_cells)
-    cell_suit = [cell_suit_ras[cell] for cell in potential_cells_list]
-    max_idx = np.argmax(cell_suit)
-    seed_cell_idx = potential_cells_list[max_idx]
-    seed_cells.add(seed_cell_idx)
-    potential_cells.remove(seed_cell_idx)
-    new_development_ras[seed_cell_idx[0], seed_cell_idx[1]] = 1
-    num_new_dev_cells += 1
-    return seed_cell_idx,new_development_ras,num_new_dev_cells, seed_cells, potential_cells
-
-# Function find_neighbours: Given a seed cell index and a list of potential cell indices,
-# find the indices of the 8-connected neighbours within the potential cells.
-def find_neighbours(seed_idx,potential_indices_list):
-    cell_neighbours = []
-    potential_indices_set = set(potential_indices_list)
-    for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]:
-        neighbour = (seed_idx[0] + dx, seed_idx[1] + dy)
-        if neighbour in potential_indices_set:
-            cell_neighbours.append(neighbour)
-    return set(cell_neighbours)
-
-# Function update_neighbours: Given the cell neighbours, the current neighbours set, and the potential cells set,
-# this function updates the neighbours set to include the new cell neighbours and updates the potential cells set to remove the new cell neighbours.
-def update_neighbours(cell_neighbours,neighbours,potential_cells):
-    neighbours = neighbours|cell_neighbours
-    potential_cells -= cell_neighbours
-    return neighbours, potential_cells
-
-# Function develop_neighbouring_cells: Given the neighbouring cells, the seed cells list, the potential cells list,
-# the new development raster, and the cell suitability raster, this function finds the cell with the highest suitability
-# among the neighbours, develops it, and adds it to the seed cells list.
-# The function updates the seed cells list, the potential cells list, the new development raster, and the number of new development cells.
-def develop_neighbouring_cell(neighbours,seed_cells,potential_cells,new_development_ras,cell_suit_ras,num_new_dev_cells):
-    neighbours = list(neighbours)
-    neighbour_suit = [cell_suit_ras[cell] for cell in neighbours]
-    max_idx = np.argmax(neighbour_suit)
-    new_cell_idx = neighbours[max_idx]
-    seed_cells.add(new_cell_idx)
-    new_development_ras[new_cell_idx[0], new_cell_idx[1]] = 1
-    num_new_dev_cells += 1
-    return new_cell_idx,seed_cells, potential_cells, new_development_ras, num_new_dev_cells
+# Function grow_patch: Given the new development raster, the flat indices of the patch cells, the cell suitability raster and the
+# number of cells still required, this function develops the patch from its most suitable cell outwards with the kernel backend
+# (see Kernels.grow_patch) until the required number of cells is met.
+def grow_patch(new_development_ras, patch_cells, cell_suit_ras, num_new_dev_cells, num_cells_required):
+    nrows, ncols = cell_suit_ras.shape
+    order = np.empty(len(patch_cells), dtype=np.int32)
+    num_grown = kn.grow_patch(patch_cells, np.ascontiguousarray(cell_suit_ras.ravel()[patch_cells], dtype=np.float64),
+                              ncols, nrows, num_cells_required, order)
+    new_development_ras.flat[order[:num_grown]] = 1
+    return num_new_dev_cells + num_grown, new_development_ras
 
+# Patches developed between patch progress events
+PATCH_BATCH = 1000
 
 # Function develop_one_non_overflow_zone: Given the current development raster, the required number of cells in the zone,
 # the development area patch ID array, the development area suitability array, the cell suitability raster, and the nodata value,
 # this function develops one non-overflow zone by developing the entire patch if the required cells are less than the patch size,
 # or by developing the cells with the highest suitability in the patch.
-def develop_one_non_overflow_zone(current_dev_ras, zone_required_cells, dev_patchid_array, dev_patch_suit_array, cell_suit_ras, nodata_value):
+# Patches are developed in decreasing order of patch suitability; new_development_ras, if given, is developed in place.
+# Unlike the legacy model, a grown patch develops exactly the cells still required (a developed frontier cell was counted
+# twice), and ties in cell suitability go to the lowest flat index rather than to set iteration order.
+def develop_one_non_overflow_zone(current_dev_ras, zone_required_cells, dev_patchid_array, dev_patch_suit_array, cell_suit_ras, nodata_value,
+                                  new_development_ras=None):
     # Initialize new development raster to be the copy of current development raster
-    new_development_ras = initialize_development_raster(current_dev_ras)
+    if new_development_ras is None:
+        new_development_ras = initialize_development_raster(current_dev_ras)
     num_new_dev_cells = 0
     
     # Get patch indices and suitability - prepare to rank patches by average patch suitability
+    # A zone without patches (e.g. a zone of the tables without cells in the raster) has nothing to develop
     patch_idx = get_patch_indices(dev_patchid_array, nodata_value)
+    if len(patch_idx) == 0:
+        return new_development_ras
     patch_suit = get_patch_suitability(dev_patchid_array, dev_patch_suit_array, patch_idx)
     
     # Sort patch indices by patch suitability 
     patch_idx = sort_patch_indices_by_suitability(patch_idx, patch_suit)
+
+    # Group the cells of each patch once, instead of scanning the whole raster per patch
+    patch_ids = np.where(dev_patchid_array > 0, dev_patchid_array, 0).astype(np.int32)
+    cells, starts = kn.group_patch_cells(patch_ids, int(patch_ids.max()))
     
-    # Develop the zone patch by patch
-    while num_new_dev_cells < zone_required_cells:
-        for patch_id in reversed(patch_idx):
-            #Calculate the number of cells in the patch
-            num_patchcells = (dev_patchid_array == patch_id).sum()
-
-            # When developing all cells of a patch is still insufficient, develop the entire patch
-            if num_new_dev_cells + num_patchcells <= zone_required_cells:
-                num_new_dev_cells, new_development_ras = develop_entire_patch(new_development_ras, dev_patchid_array, patch_id, num_new_dev_cells,num_patchcells)
-                continue
-            
-            #If all cells of the patch developed is more than enough, develop from the cell in the patch with highest cell sutiability
-            else:
-                # Initialize for developing seed & neighbours in the patch
-                # Initialize potential cells for development to be all cells in the patch
-                potential_cells = initialize_patch_potential_cells(dev_patchid_array, patch_id)
-                # Initialize neighbours
-                neighbours = set()
-                # Initialize seed cells
-                seed_cells = set()
-
-                # If the number of development cells not met, develop the rest of the cells in the patch
-                while num_new_dev_cells < zone_required_cells:
-
-
-                    #Find and develop seed - the cell with highest suitability in the potential cells
-                    seed_cell_idx,new_development_ras,num_new_dev_cells, seed_cells, potential_cells = develop_seed_cell(new_development_ras, cell_suit_ras, num_new_dev_cells,potential_cells,seed_cells)
-                    # Test if after developing the seed cell, the required number of cells is already met
-                    if num_new_dev_cells == zone_required_cells:
-                        break
-
-                    # Find the neighbours of the last added seed cell:
-                    cell_neighbours = find_neighbours(seed_cell_idx, potential_cells)
-                    # Update the neighbours to include the new cell neighours; update potential cells to remove the new cell neighbours
-                    neighbours, potential_cells = update_neighbours(cell_neighbours,neighbours,potential_cells)
-
-                    # If the last added seed cell has no neighbours, find a non-adjacent new seed cell in rest of patch cells with the highest suitability
-                    if neighbours == set():
-                        continue
-                    # If the last added seed cell has neighbours, develop the neighbours
-                    else:
-                        while len(neighbours)>0:
-                            new_cell_idx,seed_cells, potential_cells, new_development_ras, num_new_dev_cells = develop_neighbouring_cell(neighbours,seed_cells,
-                                                                                                                         potential_cells,new_development_ras,cell_suit_ras,num_new_dev_cells)
-                            if num_new_dev_cells == zone_required_cells:
-                                break
-                            # Find the neighbours of the last added seed cell:
-                            cell_neighbours = find_neighbours(new_cell_idx, potential_cells)
-                            # Update the neighbours to include the new cell neighours; update potential cells to remove the new cell neighbours
-                            neighbours, potential_cells = update_neighbours(cell_neighbours,neighbours,potential_cells)
+    # Develop the zone patch by patch, with a patch progress event every PATCH_BATCH patches when events are enabled
+    events = ev.enabled()
+    for num_patches, patch_id in enumerate(reversed(patch_idx)):
+        if num_new_dev_cells >= zone_required_cells:
+            break
+        if events and num_patches and num_patches % PATCH_BATCH == 0:
+            ev.emit('patches', 'progress', 'run_model', done=num_patches, total=len(patch_idx), cells=num_new_dev_cells)
+        patch_cells = cells[starts[int(patch_id)]:starts[int(patch_id) + 1]]
+
+        # When developing all cells of a patch is still insufficient, develop the entire patch
+        if num_new_dev_cells + len(patch_cells) <= zone_required_cells:
+            num_new_dev_cells, new_development_ras = develop_entire_patch(new_development_ras, patch_cells, num_new_dev_cells)
+        
+        #If all cells of the patch developed is more than enough, develop from the cell in the patch with highest cell sutiability
+        else:
+            num_new_dev_cells, new_development_ras = grow_patch(new_development_ras, patch_cells, cell_suit_ras, num_new_dev_cells,
+                                                                int(zone_required_cells - num_new_dev_cells))
+    return new_development_ras
+
+
+####################################################################################################################
+# Functions related to the development rank raster
+####################################################################################################################
+
+# Function rank_one_zone: Rank the patch cells of one zone in the order the zone would develop them - patches in decreasing
+# patch suitability, each grown in full from its most suitable cell (Kernels.grow_patch) - writing ranks 0, 1, ... to
+# rank_ras (which may be the zone's window of the rank raster). Returns the number of ranked cells.
+# As a partly grown patch develops a prefix of its full growth order, the cells developed for any number of required cells
+# are exactly the cells with a rank below it.
+def rank_one_zone(zone_patchid_array, dev_patch_suit_array, cell_suit_ras, nodata_value, rank_ras):
+    patch_idx = get_patch_indices(zone_patchid_array, nodata_value)
+    if len(patch_idx) == 0:
+        return 0
+    patch_suit = get_patch_suitability(zone_patchid_array, dev_patch_suit_array, patch_idx)
+    patch_idx = sort_patch_indices_by_suitability(patch_idx, patch_suit)
+
+    patch_ids = np.where(zone_patchid_array > 0, zone_patchid_array, 0).astype(np.int32)
+    cells, starts = kn.group_patch_cells(patch_ids, int(patch_ids.max()))
+    nrows, ncols = cell_suit_ras.shape
+    cell_suit_flat = np.ascontiguousarray(cell_suit_ras.ravel(), dtype=np.float64)
+    num_ranked = 0
+    for patch_id in reversed(patch_idx):
+        patch_cells = cells[starts[int(patch_id)]:starts[int(patch_id) + 1]]
+        order = np.empty(len(patch_cells), dtype=np.int32)
+        num_grown = kn.grow_patch(patch_cells, cell_suit_flat[patch_cells], ncols, nrows, len(patch_cells), order)
+        rank_ras.flat[order[:num_grown]] = np.arange(num_ranked, num_ranked + num_grown)
+        num_ranked += num_grown
+    return num_ranked
+
+# Function development_rank_raster: int32 raster of the development rank of every patch cell within its zone (-1 elsewhere),
+# each zone ranked in its window
+# With workers > 1 the zones are ranked on a pool of worker processes: the rasters are published once to a SharedRasterPool
+# and every worker ranks its zones on zero-copy views of them, returning the ranks of each zone's window
+def development_rank_raster(zone_ids, windows, zone_id_ras, dev_patchid_array, dev_patch_suit_array, cell_suit_ras, nodata_value,
+                            workers=1):
+    rank_ras = np.full(zone_id_ras.shape, -1, dtype=np.int32)
+    if workers > 1 and len(zone_ids) > 1:
+        zone_windows = [(zone_id, zi.zone_window(windows, zone_id)) for zone_id in zone_ids]
+        rasters = {'zone_id_ras': zone_id_ras, 'dev_patch_id_ras': dev_patchid_array, 'dev_patch_suit_ras': dev_patch_suit_array,
+                   'cell_suit_ras': cell_suit_ras}
+        with sr.SharedRasterPool() as pool, ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            descriptors = sr.publish_model_rasters(pool, rasters)
+            # Several batches of zones per worker, so a worker with large zones does not hold up the others
+            batches = [zone_windows[i::workers * 4] for i in range(min(len(zone_windows), workers * 4))]
+            for results in executor.map(rank_zones_worker, [descriptors] * len(batches), batches, [nodata_value] * len(batches)):
+                for window, zone_ranks in results:
+                    ranked = zone_ranks >= 0
+                    rank_ras[window][ranked] = zone_ranks[ranked]
+        return rank_ras
+    for zone_id in zone_ids:
+        window = zi.zone_window(windows, zone_id)
+        zone_patchid_array = np.where(zone_id_ras[window] == zone_id, dev_patchid_array[window], 0)
+        rank_one_zone(zone_patchid_array, dev_patch_suit_array[window], cell_suit_ras[window], nodata_value, rank_ras[window])
+    return rank_ras
+
+# Function rank_zones_worker: Rank a batch of zones (zone ID, window) in a worker process on the rasters shared by
+# development_rank_raster; returns the window and window ranks of each zone (-1 outside the zone's patch cells)
+def rank_zones_worker(descriptors, zone_windows, nodata_value):
+    rasters = sr.attach_rasters(descriptors)
+    try:
+        results = []
+        for zone_id, window in zone_windows:
+            zone_ranks = np.full(rasters['zone_id_ras'][window].shape, -1, dtype=np.int32)
+            zone_patchid_array = np.where(rasters['zone_id_ras'][window] == zone_id, rasters['dev_patch_id_ras'][window], 0)
+            rank_one_zone(zone_patchid_array, rasters['dev_patch_suit_ras'][window], rasters['cell_suit_ras'][window], nodata_value, zone_ranks)
+            results.append((window, zone_ranks))
+        return results
+    finally:
+        # The views must be dropped before the blocks are detached
+        rasters.clear()
+        sr.detach_rasters(descriptors)
+
+# Function allocate_from_rank: New development raster for the given number of required cells per zone - the current
+# development plus the cells ranked below their zone's required cells, in one vectorised comparison. A demand sweep is one
+# call per demand level on the same rank raster (which run_model writes to raster_files['cell_rank_ras']).
+def allocate_from_rank(rank_ras, zone_id_ras, current_dev_ras, zone_ids, required_cells):
+    required = zone_value_raster(zone_id_ras, zone_ids, required_cells)
+    new_development = initialize_development_raster(current_dev_ras)
+    new_development[(rank_ras >= 0) & (rank_ras < required)] = 1
+    return new_development
+
+
+# Function zone_value_raster: Raster of a value per zone (values in the order of zone_ids) over the cells of each zone,
+# 0 outside the zones, in one vectorised lookup
+def zone_value_raster(zone_id_ras, zone_ids, values):
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    order = np.argsort(zone_ids)
+    sorted_ids = zone_ids[order]
+    sorted_values = np.asarray(values, dtype=np.float64)[order]
+    positions = np.clip(np.searchsorted(sorted_ids, zone_id_ras), 0, len(sorted_ids) - 1)
+    return np.where(sorted_ids[positions] == zone_id_ras, sorted_values[positions], 0)
+
+
+####################################################################################################################
+# Functions related to variable density
+####################################################################################################################
+
+# Density calculation types using the per-cell dwelling capacity of the density raster
+VARIABLE_DENSITY_TYPES = {2, 4}
+
+# Function cell_dwelling_capacity: Dwellings each cell can hold - the density raster, in dwellings per hectare, times the cell
+# area in hectares (NoData and negative densities hold none)
+def cell_dwelling_capacity(density_ras, header_values):
+    return np.where(density_ras > 0, density_ras, 0) * header_values[4] ** 2 / 10000
+
+# Function variable_density_required_cells: Number of cells each zone develops to meet its dwellings increase, from the
+# cumulative dwelling capacity of its cells in development order (ranks 0, 1, ... of the rank raster): the fewest cells whose
+# capacity meets the increase, or all of its patch cells when their capacity falls short (an overflow zone).
+# Returns the required cells, the overflow flags and the number of patch cells of each zone.
+def variable_density_required_cells(rank_ras, zone_id_ras, cell_capacity, zone_ids, dwellings_increase, windows):
+    num_req_cells, overflow, num_suitCells = [], [], []
+    for zone_id in zone_ids:
+        window = zi.zone_window(windows, zone_id)
+        zone_ranks = rank_ras[window]
+        zone_cells = (zone_id_ras[window] == zone_id) & (zone_ranks >= 0)
+        # Capacity of the zone's patch cells in development order, and its running total
+        capacity = np.empty(int(zone_cells.sum()))
+        capacity[zone_ranks[zone_cells]] = cell_capacity[window][zone_cells]
+        cumulative_capacity = np.cumsum(capacity)
+
+        dwellings_required = dwellings_increase[zone_id]
+        # searchsorted gives len(capacity) when the capacity of every cell falls short
+        num_cells = int(np.searchsorted(cumulative_capacity, dwellings_required)) + 1 if dwellings_required > 0 else 0
+        num_suitCells.append(len(capacity))
+        overflow.append(num_cells > len(capacity))
+        num_req_cells.append(min(num_cells, len(capacity)))
+    return num_req_cells, np.array(overflow), num_suitCells
+
+# Function development_density: Population and dwelling density (people and dwellings per cell, rounded up) of the newly
+# developed cells, 0 elsewhere - as written by the legacy model:
+#   type 1 - the zone's current population per developed cell; overflow zones spread the population change over their cells
+#   type 3 - the zone's dwellings per hectare; overflow zones spread the dwellings increase over their cells
+#   types 2 and 4 - the density raster of each cell
+# Population and dwellings convert through people_per_dwelling. current_dev_mask is the current development as a PackedMask.
+def development_density(density_calculation_type, people_per_dwelling, new_development, current_dev_mask, zone_id_ras, zone_ids,
+                        overFlow_array, num_suitCells, zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare, density_ras=None):
+    current_dev = current_dev_mask.to_bool()
+    new_cells = (new_development == 1) & ~current_dev
+    suit_cells = np.maximum(np.asarray(num_suitCells, dtype=np.float64), 1)
+    if density_ras is not None:
+        dph = np.where(density_ras > 0, density_ras, 0)
+        pph = dph * people_per_dwelling
+    elif density_calculation_type == 1:
+        current_cells = np.array([np.count_nonzero((zone_id_ras == zone_id) & current_dev) for zone_id in zone_ids], dtype=np.float64)
+        zone_pph = np.where(overFlow_array, (zone_fut_pop - zone_cur_pop) / suit_cells, zone_cur_pop / np.maximum(current_cells, 1))
+        pph = zone_value_raster(zone_id_ras, zone_ids, zone_pph)
+        dph = pph / people_per_dwelling
+    else:
+        zone_dph = np.where(overFlow_array, dwellings_increase / suit_cells, dwellings_per_hectare)
+        dph = zone_value_raster(zone_id_ras, zone_ids, zone_dph)
+        pph = dph * people_per_dwelling
+    return np.where(new_cells, np.ceil(pph), 0), np.where(new_cells, np.ceil(dph), 0)
+
+# Function write_development_density: Write out_cell_pph and out_cell_dph (raster_files['cell_pph_ras'], ['cell_dph_ras']) with
+# NODATA_value 0, as the legacy model does, and return them keyed as in raster_files (None when they are not outputs of the run)
+def write_development_density(raster_files, parameters, header_values, new_development, current_dev_mask, zone_id_ras, zone_ids,
+                              overFlow_array, num_suitCells, zone_cur_pop, zone_fut_pop, dwellings_increase, dwellings_per_hectare,
+                              density_ras=None):
+    if 'cell_pph_ras' not in raster_files or 'cell_dph_ras' not in raster_files:
+        return None
+    pph, dph = development_density(parameters['density_calculation_type'], parameters.get('people_per_dwelling', 1),
+                                   new_development, current_dev_mask, zone_id_ras, zone_ids, overFlow_array, num_suitCells,
+                                   np.asarray(zone_cur_pop, dtype=np.float64), np.asarray(zone_fut_pop, dtype=np.float64),
+                                   np.asarray(dwellings_increase, dtype=np.float64), dwellings_per_hectare, density_ras)
+    header_text = rt.header_lines(header_values[:5] + [0])
+    rio.write_raster(pph, raster_files['cell_pph_ras'], header_text)
+    rio.write_raster(dph, raster_files['cell_dph_ras'], header_text)
+    return {'cell_pph_ras': pph, 'cell_dph_ras': dph}
+
+
+####################################################################################################################
+# Functions related to the coarse-to-fine allocation
+####################################################################################################################
+
+# Function coarse_patch_table: Per-patch table (index = patch ID) of size, zone, patch suitability and extent in blocks of
+# factor x factor cells (row start, row stop, column start, column stop), from one vectorised pass over the fine grid.
+# zone_patches holds the patch IDs of each zone in increasing order, as get_patch_indices gives them for the zone.
+def coarse_patch_table(dev_patchid_array, zone_id_ras, dev_patch_suit_array, factor):
+    patch_ids = np.where(dev_patchid_array > 0, dev_patchid_array, 0).astype(np.int32)
+    num_patches = int(patch_ids.max())
+    sizes = kn.patch_sizes(patch_ids.ravel(), num_patches)
+    # Zone and patch suitability are constant over a patch, so any cell of the patch gives them
+    zones = np.zeros(num_patches + 1)
+    suitability = np.zeros(num_patches + 1)
+    zones[patch_ids] = zone_id_ras
+    suitability[patch_ids] = dev_patch_suit_array
+    zones[0] = np.nan
+
+    blocks = np.zeros((num_patches + 1, 4), dtype=np.int64)
+    for patch_id, extent in enumerate(find_objects(patch_ids, max_label=num_patches), start=1):
+        if extent is not None:
+            rows, cols = extent
+            blocks[patch_id] = [rows.start // factor, -(-rows.stop // factor), cols.start // factor, -(-cols.stop // factor)]
+
+    order = np.argsort(zones[1:], kind='stable') + 1
+    zone_values, starts = np.unique(zones[order], return_index=True)
+    bounds = np.append(starts, len(order))
+    zone_patches = {zone: order[bounds[i]:bounds[i + 1]] for i, zone in enumerate(zone_values) if not np.isnan(zone)}
+    return {'factor': factor, 'shape': patch_ids.shape, 'sizes': sizes, 'suitability': suitability,
+            'blocks': blocks, 'zone_patches': zone_patches}
+
+# Function find_overflow_zones_coarse: find_overflow_zones from the patch table - a zone's suitable cells are the cells of its patches
+def find_overflow_zones_coarse(patch_table, adminzone_idx, num_req_cells_zones):
+    num_suitCells = [int(patch_table['sizes'][patch_table['zone_patches'].get(float(zone_label), [])].sum()) for zone_label in adminzone_idx]
+    overFlow_array = np.asarray(num_suitCells) < np.asarray(num_req_cells_zones)
+    return overFlow_array, num_suitCells
+
+# Function select_zone_patches: The patches a non-overflow zone develops, in development order, with their cumulative cells and the
+# window of their coarse blocks - from the patch table alone. Patches are developed in decreasing patch suitability until the
+# required cells are met: all but the last in full, the last grown if needed. Returns None when the zone develops no patch.
+def select_zone_patches(patch_table, zone_id, zone_required_cells):
+    patch_idx = patch_table['zone_patches'].get(float(zone_id), np.array([], dtype=np.int64))
+    if len(patch_idx) == 0 or zone_required_cells <= 0:
+        return None
+    patch_idx = sort_patch_indices_by_suitability(patch_idx, patch_table['suitability'][patch_idx])[::-1]
+    cumulative_cells = np.cumsum(patch_table['sizes'][patch_idx])
+    num_selected = min(int(np.searchsorted(cumulative_cells, zone_required_cells)) + 1, len(patch_idx))
+
+    factor = patch_table['factor']
+    nrows, ncols = patch_table['shape']
+    blocks = patch_table['blocks'][patch_idx[:num_selected]]
+    window = (slice(int(blocks[:, 0].min()) * factor, min(int(blocks[:, 1].max()) * factor, nrows)),
+              slice(int(blocks[:, 2].min()) * factor, min(int(blocks[:, 3].max()) * factor, ncols)))
+    return patch_idx[:num_selected], cumulative_cells[:num_selected], window
+
+# Function develop_selected_patches: Develop the patches of select_zone_patches in their window of the fine grid.
+# The development is identical to that of develop_one_non_overflow_zone: the patch order sorts the same patch IDs on the same
+# patch suitabilities, and the last patch is grown in a window that contains it whole, from the same cells in the same order.
+def develop_selected_patches(selection, zone_required_cells, dev_patchid_array, cell_suit_ras, new_development_ras):
+    selected, cumulative_cells, window = selection
+    window_patch_ids = dev_patchid_array[window]
+    window_development = new_development_ras[window]
+    if cumulative_cells[-1] <= zone_required_cells:
+        window_development[np.isin(window_patch_ids, selected)] = 1
+    else:
+        window_development[np.isin(window_patch_ids, selected[:-1])] = 1
+        num_new_dev_cells = int(cumulative_cells[-2]) if len(selected) > 1 else 0
+        patch_cells = np.flatnonzero(window_patch_ids == selected[-1]).astype(np.int32)
+        grow_patch(window_development, patch_cells, cell_suit_ras[window], num_new_dev_cells, int(zone_required_cells - num_new_dev_cells))
     return new_development_ras
 
 
@@ -404,10 +783,11 @@ def develop_one_non_overflow_zone(current_dev_ras, zone_required_cells, dev_patc
 # Functions related to developing Overflow zones
 ####################################################################################################################
 
-# Develop all patch cells in an overflow zone
-def develop_one_overflow_zone(current_dev_ras,dev_patchid_array, zone_id_ras, zone_label):
+# Develop all patch cells in an overflow zone; new_development_ras, if given, is developed in place
+def develop_one_overflow_zone(current_dev_ras,dev_patchid_array, zone_id_ras, zone_label, new_development_ras=None):
     # Initialize new development raster to be the copy of current development raster
-    new_development_ras = initialize_development_raster(current_dev_ras)
+    if new_development_ras is None:
+        new_development_ras = initialize_development_raster(current_dev_ras)
 
     # Develop all patch cells in the overflow zone and with patch id > 0
     new_development_ras[(dev_patchid_array > 0) & (zone_id_ras == zone_label)] = 1
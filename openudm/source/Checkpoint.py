@@ -0,0 +1,97 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+############################################################################################################
+# Checkpoint and resume for long runs
+# A checkpoint directory in the output directory holds:
+#   manifest.json              - hash of the run inputs the checkpoint belongs to
+#   stages/<stage>.npz         - marker and compact outputs of each completed pipeline stage
+#   zones/<stage>/<zone>.npz   - result of each completed zone of a per-zone stage
+# Every file is written to a temporary name, flushed and renamed, so an interrupted write never leaves a
+# partial checkpoint behind and a restarted run loses at most the zone that was in progress.
+############################################################################################################
+
+# Function input_hash: SHA-256 over the contents of the input files (and the parameter values given as extra)
+def input_hash(file_paths, extra=None, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    for file_path in sorted(set(file_paths)):
+        digest.update(os.path.basename(file_path).encode())
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    if extra is not None:
+        digest.update(json.dumps(extra, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+# Function atomic_savez: Save arrays to an .npz file atomically
+def atomic_savez(file_path, **arrays):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+class Checkpoint:
+    # path_to_output: output directory; inputs_hash: input_hash of the run; resume: keep matching earlier work
+    def __init__(self, path_to_output, inputs_hash, resume=False):
+        self.path = os.path.join(path_to_output, 'checkpoint')
+        self.inputs_hash = inputs_hash
+        manifest_path = os.path.join(self.path, 'manifest.json')
+
+        previous_hash = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                previous_hash = json.load(f).get('input_hash')
+        if resume and previous_hash is not None and previous_hash != inputs_hash:
+            print('Checkpoint inputs have changed, starting from the beginning.')
+        if not resume or previous_hash != inputs_hash:
+            shutil.rmtree(self.path, ignore_errors=True)
+        elif resume:
+            print('Resuming from checkpoint in', self.path)
+
+        os.makedirs(os.path.join(self.path, 'stages'), exist_ok=True)
+        os.makedirs(os.path.join(self.path, 'zones'), exist_ok=True)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'input_hash': inputs_hash}, f)
+        os.replace(tmp_path, manifest_path)
+
+    def _stage_path(self, stage):
+        return os.path.join(self.path, 'stages', stage + '.npz')
+
+    def _zone_path(self, stage, zone_id):
+        return os.path.join(self.path, 'zones', stage, f'{int(zone_id)}.npz')
+
+    # Method stage_done: True if the stage completed and the output files it produced still exist
+    def stage_done(self, stage, output_files=()):
+        return os.path.exists(self._stage_path(stage)) and all(os.path.exists(f) for f in output_files)
+
+    # Method complete_stage: mark a stage completed, storing its compact outputs
+    def complete_stage(self, stage, **arrays):
+        atomic_savez(self._stage_path(stage), **arrays)
+        # Per-zone results are not needed once their stage completed
+        shutil.rmtree(os.path.join(self.path, 'zones', stage), ignore_errors=True)
+
+    # Method load_stage: compact outputs stored by complete_stage
+    def load_stage(self, stage):
+        with np.load(self._stage_path(stage)) as data:
+            return {key: data[key] for key in data.files}
+
+    # Method zone_done / save_zone / load_zone: per-zone results of a stage
+    def zone_done(self, stage, zone_id):
+        return os.path.exists(self._zone_path(stage, zone_id))
+
+    def save_zone(self, stage, zone_id, **arrays):
+        os.makedirs(os.path.join(self.path, 'zones', stage), exist_ok=True)
+        atomic_savez(self._zone_path(stage, zone_id), **arrays)
+
+    def load_zone(self, stage, zone_id):
+        with np.load(self._zone_path(stage, zone_id)) as data:
+            return {key: data[key] for key in data.files}
@@ -0,0 +1,90 @@
+import os
+import hashlib
+import numpy as np
+import source.RasterIO as rio
+import source.RasterToolkit as rt
+import source.Checkpoint as cp
+import source.VectorInput as vi
+
+############################################################################################################
+# Critical constraint thresholds
+# A cell is constrained when the summed coverage of the constraint layers exceeds coverage_threshold percent of
+# the cell area, or when any layer exceeds its layer_threshold. Both tests only depend on two numbers per cell:
+#   coverage_area - summed coverage of all layers (the coverage as a percentage is 100 * coverage_area / cell area)
+#   layer_ratio   - largest ratio of a layer to its threshold area, the limiting layer of the cell
+# (dev_ratio is the same ratio over the layers flagged as current development). They are computed once, cached in
+# an .npz keyed on the constraint table and layer files, and any coverage threshold - or scaling of the layer
+# thresholds - then gives the constraint and current development layers by one vectorised comparison.
+# Patch labelling is cached by the constraint mask it was labelled from (see DevZones.find_zone_dev_patches), so a
+# threshold sweep labels each distinct constraint mask once.
+############################################################################################################
+
+
+# Function exceedance_ratio: Ratio of a layer to its threshold area, with ratio > 1 exactly where layer > threshold_area
+# (a zero threshold gives an infinite ratio for any coverage)
+def exceedance_ratio(layer, threshold_area):
+    over_threshold = layer > threshold_area
+    if threshold_area > 0:
+        ratio = layer / threshold_area
+    else:
+        ratio = np.where(over_threshold, np.inf, 0.0)
+    # Division may round a ratio just above 1 down to 1 (or just below 1 up to it); keep the exact comparison at 1
+    ratio[over_threshold] = np.maximum(ratio[over_threshold], np.nextafter(1.0, 2.0))
+    ratio[~over_threshold] = np.minimum(ratio[~over_threshold], 1.0)
+    return ratio
+
+# Function compute_critical_thresholds: coverage_area, layer_ratio and dev_ratio of every cell, folding the constraint
+# layers in as they are read concurrently (RasterIO.iter_rasters)
+# Raises ValueError if any constraint layer does not have the same dimensions as the zone identity raster
+def compute_critical_thresholds(path_to_data, layer_name_list, current_development_flag_list, layer_threshold_area_list, zone_id_ras_shape,
+                                layer_reader=None):
+    coverage_area = np.zeros(zone_id_ras_shape)
+    layer_ratio = np.zeros(zone_id_ras_shape)
+    dev_ratio = np.zeros(zone_id_ras_shape)
+    layer_paths = [os.path.join(path_to_data, layer_name) for layer_name in layer_name_list]
+    for i, layer in enumerate(rt.read_constraint_layers(layer_paths, zone_id_ras_shape, layer_reader)):
+        if layer.shape != zone_id_ras_shape:
+            raise ValueError(f"{layer_name_list[i]} does not have the same dimension as zone identity raster")
+        coverage_area += layer
+        ratio = exceedance_ratio(layer, layer_threshold_area_list[i])
+        np.maximum(layer_ratio, ratio, out=layer_ratio)
+        if current_development_flag_list[i] == 1:
+            np.maximum(dev_ratio, ratio, out=dev_ratio)
+    return {'coverage_area': coverage_area, 'layer_ratio': layer_ratio, 'dev_ratio': dev_ratio}
+
+# Function thresholds_key: Cache key of the critical thresholds - the constraint table, the fingerprints of its layers and the
+# settings of the layer reader (its key attribute, e.g. the supersampling of vector layers)
+def thresholds_key(path_to_data, constraints_tbl, layer_name_list, layer_reader=None):
+    digest = hashlib.sha256(str(getattr(layer_reader, 'key', '')).encode())
+    with open(constraints_tbl, 'rb') as f:
+        digest.update(f.read())
+    for layer_name in layer_name_list:
+        digest.update(f'{layer_name}|{vi.layer_fingerprint(os.path.join(path_to_data, layer_name))}'.encode())
+    return digest.hexdigest()
+
+# Function load_critical_thresholds: Critical thresholds from cache_path when it holds those of the current constraint
+# table and layers; otherwise computed and written to cache_path
+def load_critical_thresholds(cache_path, path_to_data, constraints_tbl, layer_name_list, current_development_flag_list,
+                             layer_threshold_area_list, zone_id_ras_shape, layer_reader=None):
+    key = thresholds_key(path_to_data, constraints_tbl, layer_name_list, layer_reader)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if str(cached['key']) == key and cached['coverage_area'].shape == tuple(zone_id_ras_shape):
+                print('Critical constraint thresholds read from', cache_path)
+                return {name: cached[name] for name in ['coverage_area', 'layer_ratio', 'dev_ratio']}
+    thresholds = compute_critical_thresholds(path_to_data, layer_name_list, current_development_flag_list,
+                                             layer_threshold_area_list, zone_id_ras_shape, layer_reader)
+    cp.atomic_savez(cache_path, key=np.array(key), **thresholds)
+    return thresholds
+
+# Function constraint_layers: Boolean constraint layer (True = developable) and current development layer for a coverage
+# threshold area and a scaling of the layer thresholds of the constraint table
+def constraint_layers(thresholds, constraint_threshold_area, layer_threshold_scale=1.0):
+    output_constraint_layer = ~(thresholds['layer_ratio'] > layer_threshold_scale) & ~(thresholds['coverage_area'] > constraint_threshold_area)
+    current_dev_layer = thresholds['dev_ratio'] > layer_threshold_scale
+    return output_constraint_layer, current_dev_layer
+
+# Function constraint_layer_sweep: Constraint layers for each coverage threshold (percent of the cell area)
+def constraint_layer_sweep(thresholds, cellsize, coverage_thresholds, layer_threshold_scale=1.0):
+    return [constraint_layers(thresholds, (coverage_threshold / 100) * (cellsize ** 2), layer_threshold_scale)[0]
+            for coverage_threshold in coverage_thresholds]
@@ -1,5 +1,13 @@
+import os
+import hashlib
 import numpy as np
 from scipy.ndimage import label
+import source.Kernels as kn
+import source.RasterIO as rio
+import source.ZoneIndex as zi
+import source.RasterToolkit as rt
+import source.Checkpoint as cp
+from source.PackedMask import read_mask
 
 ############################################################################################################
 # Functions related find_zone_dev_patches
@@ -8,7 +16,7 @@ from scipy.ndimage import label
 # Function remove_patch_smaller_than_minimum_development_area
 def remove_patch_smaller_than_minimum_development_area(zone_patches, num_zone_patches, minimum_development_area,zone_id):
     # Calculate the size of each patch
-    patch_sizes = np.array([np.sum(zone_patches == i) for i in range(1, num_zone_patches + 1)])
+    patch_sizes = kn.patch_sizes(np.ascontiguousarray(zone_patches, dtype=np.int32).ravel(), num_zone_patches)[1:]
     
     # Find the patche ids that are smaller than the minimum development
     patches_to_remove = np.where(patch_sizes < minimum_development_area)[0] + 1
@@ -20,22 +28,21 @@ def remove_patch_smaller_than_minimum_development_area(zone_patches, num_zone_pa
             print('No patches larger than the minimum development area')
         else:
             print('Removing patches smaller than the minimum development area in zone', zone_id)
-            zone_patches_cp = zone_patches.copy()
-            # Remove the patches smaller than the minimum development area by setting the patch cells to 0 and adjusting the patch IDs given the removal
-            for patch_id in patches_to_remove:
-                zone_patches_cp[zone_patches == patch_id] = 0
-                zone_patches_cp[zone_patches > patch_id] -= 1
-            return zone_patches_cp, num_zone_patches - len(patches_to_remove)
+        # Remove the patches smaller than the minimum development area by setting the patch cells to 0 and renumbering the
+        # remaining patches consecutively, through a single lookup table over the old patch IDs
+        keep = np.concatenate(([False], patch_sizes >= minimum_development_area))
+        new_ids = np.where(keep, np.cumsum(keep), 0)
+        return new_ids[zone_patches], num_zone_patches - len(patches_to_remove)
     else:
         return zone_patches, num_zone_patches
 
 
 # Helper Function - label_patches_in_zone: Label patches in a zone and filter out patches smaller than the minimum development area
-def label_patches_in_zone(constraint_array, zone_id_ras, zone_id, minimum_development_area):
-    array_tolabel = constraint_array.copy()
-
-    # Prepare the array to be labeled SciPy's label function - set all cells not in the current zone to 0
-    array_tolabel[zone_id_ras != zone_id] = 0
+# constraint_mask is the constraint raster as a boolean array (True = developable); constraint_mask and zone_id_ras may be
+# the zone's window of the grid (see ZoneIndex.zone_windows and PackedMask.window_bool), giving the zone's patches in that window
+def label_patches_in_zone(constraint_mask, zone_id_ras, zone_id, minimum_development_area):
+    # Prepare the array to be labeled SciPy's label function - developable cells of the current zone
+    array_tolabel = constraint_mask & (zone_id_ras == zone_id)
     
     # Run scipy's label function - zone_patches is the labeled array, numPatches is the number of patches found
     zone_patches, num_zone_patches = label(array_tolabel)
@@ -56,37 +63,79 @@ def adjust_zonal_patch_ids(zone_patches, zone_patch_initial_id,num_zone_patches,
 
     return zone_patches, zone_patch_initial_id 
 
+# Function patch_cache_path: File of the patch labelling of a constraint mask in patch_cache - keyed on the mask, the zone
+# identity raster and the minimum development area, so each distinct constraint (e.g. of a threshold sweep) is labelled once
+def patch_cache_path(patch_cache, constraint_mask, zone_id_ras, minimum_development_area):
+    digest = hashlib.sha256(constraint_mask.bits.tobytes())
+    if constraint_mask.nodata is not None:
+        digest.update(constraint_mask.nodata.tobytes())
+    digest.update(f'{constraint_mask.shape}|{rt.file_fingerprint(zone_id_ras)}|{minimum_development_area}'.encode())
+    return os.path.join(patch_cache, digest.hexdigest() + '.npz')
+
 # Function find_zone_dev_patches: Generate zonal development patches ID raster
+# checkpoint: optional Checkpoint; each labelled zone is stored and skipped when resuming
+# patch_cache: optional directory of patch labellings by constraint mask (see patch_cache_path)
 def find_zone_dev_patches(minimum_development_area, constraint_ras, num_zones,
-                          dev_patch_id_ras, header_text, header_values, zone_id_ras):
-    # Load the constraint raster
-    constraint_array = np.loadtxt(constraint_ras, skiprows=6)
+                          dev_patch_id_ras, header_text, header_values, zone_id_ras, checkpoint=None, patch_cache=None):
+    # Load the constraint raster as a packed mask; each zone's window of it is unpacked for labelling
+    constraint_mask = read_mask(constraint_ras, header_values[-1])
+
+    # Reuse the labelling of the same constraint mask
+    cache_path = None
+    if patch_cache is not None:
+        os.makedirs(patch_cache, exist_ok=True)
+        cache_path = patch_cache_path(patch_cache, constraint_mask, zone_id_ras, minimum_development_area)
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                patchID = np.zeros(constraint_mask.shape)
+                patchID.flat[cached['cells']] = cached['labels']
+            print('Development patches read from', cache_path)
+            patchID[constraint_mask.nodata_bool()]=header_values[-1]
+            rio.write_raster(patchID, dev_patch_id_ras, header_text, fmt='%d')
+            return
+
     # Load the zone ID raster
-    zone_id_ras = np.loadtxt(zone_id_ras, skiprows=6)
+    zone_id_ras = rio.read_raster(zone_id_ras)
     
     # Check if the zone ID starts from 0 and change to start from 1
     if np.min(zone_id_ras[zone_id_ras!=header_values[-1]])==0:
         zone_id_ras += 1
 
     num_patches_allzones = 0
-    allzones_patches_list = []
+    # Each zone's patches are merged into a single patch id raster as they are labelled
+    patchID = np.zeros(constraint_mask.shape)
+    # Zones are labelled within their bounding box windows, so the cost of a zone scales with its extent
+    windows = zi.raster_zone_windows(zone_id_ras, header_values[-1])
 
     for id in range(1, num_zones+1):
-        # Label the patches in the current zone
-        zone_patches, num_zone_patches = label_patches_in_zone(constraint_array, zone_id_ras, id, minimum_development_area)
+        if checkpoint is not None and checkpoint.zone_done('patches', id):
+            zone_result = checkpoint.load_zone('patches', id)
+            patchID.flat[zone_result['cells']] = zone_result['labels']
+            num_patches_allzones = int(zone_result['num_patches_allzones'])
+            continue
+
+        # Label the patches in the current zone's window
+        window = zi.zone_window(windows, id)
+        zone_patches, num_zone_patches = label_patches_in_zone(constraint_mask.window_bool(window), zone_id_ras[window], id, minimum_development_area)
         
         # Adjust the patch IDs to be unique across all zones
         zone_patches, num_patches_allzones = adjust_zonal_patch_ids(zone_patches, num_patches_allzones,num_zone_patches,header_values[-1])
         
-        allzones_patches_list.append(zone_patches)
+        # Write the zone's patches back through the window
+        local_cells = np.flatnonzero(zone_patches)
+        labels = zone_patches.flat[local_cells]
+        patchID[window].flat[local_cells] = labels
+        if checkpoint is not None:
+            cells = zi.window_cells(local_cells, window, patchID.shape)
+            checkpoint.save_zone('patches', id, cells=cells.astype(np.int64), labels=labels.astype(np.int32),
+                                 num_patches_allzones=num_patches_allzones)
     
-    # Merge each zone's patches into a single patch id raster    
-    patchID = sum(allzones_patches_list)
-    patchID[constraint_array==header_values[-1]]=header_values[-1]
+    if cache_path is not None:
+        cells = np.flatnonzero(patchID)
+        cp.atomic_savez(cache_path, cells=cells.astype(np.int64), labels=patchID.flat[cells].astype(np.int32))
+    patchID[constraint_mask.nodata_bool()]=header_values[-1]
     # Save the patch ID raster
-    with open(dev_patch_id_ras, 'w') as f:
-        f.write(''.join(header_text))
-        np.savetxt(f, patchID, fmt='%d')
+    rio.write_raster(patchID, dev_patch_id_ras, header_text, fmt='%d')
     
 
 
@@ -94,23 +143,20 @@ def find_zone_dev_patches(minimum_development_area, constraint_ras, num_zones,
 # Functions DevZoneAVGSuit
 ############################################################################################################
 # Function patch_avg_suitability: Compute average patch suitability
+# Returns the mean suitability by patch ID (index 0 is the background)
 def patch_avg_suitability(dev_patch_id_ras, cell_suit_ras, dev_patch_suit_ras, header_text, header_values):
 
     # Load the zonal development patches ID raster and cell suitability raster
-    dev_patchid_array = np.loadtxt(dev_patch_id_ras, skiprows=6)
-    cell_suit_array = np.loadtxt(cell_suit_ras, skiprows=6)
-    # Initialize the avg patch suitability array
-    patch_avg_suit_array = np.zeros((header_values[1],header_values[0]))
-    
-    # Find unique patch IDs 
-    unique_patchids = np.unique(dev_patchid_array)
-    unique_patchids = unique_patchids[(unique_patchids != header_values[-1]) & (unique_patchids != 0)]
-
-    # Calculate the average suitability for each patch and assign it to the corresponding cells in the patch_avg_suit_array
-    for zone_id in unique_patchids:
-        patch_avg_suit_array[dev_patchid_array==zone_id] = np.mean(cell_suit_array[dev_patchid_array==zone_id])
-
-    with open(dev_patch_suit_ras, 'w') as f:
-        f.write(''.join(header_text))
-        np.savetxt(f, patch_avg_suit_array, fmt='%1.3f')
+    dev_patchid_array = rio.read_raster(dev_patch_id_ras)
+    cell_suit_array = rio.read_raster(cell_suit_ras)
+    # Patch IDs with nodata and background cells both mapped to 0
+    patch_ids = np.where((dev_patchid_array != header_values[-1]) & (dev_patchid_array > 0), dev_patchid_array, 0).astype(np.int32)
+
+    # Calculate the average suitability for each patch in one pass and assign it to the corresponding cells in the patch_avg_suit_array
+    patch_means = kn.patch_means(patch_ids, cell_suit_array, int(patch_ids.max()))
+    patch_means[0] = 0
+    patch_avg_suit_array = patch_means[patch_ids]
+
+    rio.write_raster(patch_avg_suit_array, dev_patch_suit_ras, header_text, fmt='%1.3f')
+    return patch_means
 
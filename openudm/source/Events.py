@@ -0,0 +1,146 @@
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+############################################################################################################
+# Pipeline events
+# The pipeline emits structured events to the registered handlers: a dictionary with the time, the scope
+# ('stage', 'zone' or 'patches'), the phase ('start', 'progress' or 'end'), the name of the stage and counters
+# such as zones done and remaining, cells developed, the elapsed time and an ETA. Handlers are plain callables
+# taking the event; ConsoleProgress draws a throttled progress bar and JsonLinesLog appends each event to a
+# JSON-lines file for a job monitor. With no handler registered emit returns at once, and the hot loops check
+# enabled() once before the loop, so events cost nothing when unused.
+############################################################################################################
+
+_handlers = []
+_lock = threading.Lock()
+
+
+# Function subscribe: Register an event handler (a callable taking the event dictionary); returns the handler
+def subscribe(handler):
+    with _lock:
+        _handlers.append(handler)
+    return handler
+
+# Function unsubscribe: Remove a registered event handler
+def unsubscribe(handler):
+    with _lock:
+        if handler in _handlers:
+            _handlers.remove(handler)
+
+# Function enabled: Whether any event handler is registered
+def enabled():
+    return bool(_handlers)
+
+# Function emit: Send an event to every registered handler
+def emit(scope, phase, name, **counters):
+    if not _handlers:
+        return
+    event = {'time': time.time(), 'scope': scope, 'phase': phase, 'name': name}
+    event.update(counters)
+    for handler in list(_handlers):
+        handler(event)
+
+# Function stage: Context manager emitting the start and end events of a stage; the end event carries the elapsed
+# time and status 'done' or 'error'
+@contextmanager
+def stage(name, **counters):
+    start = time.perf_counter()
+    emit('stage', 'start', name, **counters)
+    status = 'error'
+    try:
+        yield
+        status = 'done'
+    finally:
+        emit('stage', 'end', name, status=status, elapsed=time.perf_counter() - start, **counters)
+
+
+class Progress:
+    # Progress over a known number of items of a stage (zones, patches): start, progress events with the items done
+    # and remaining, elapsed time and ETA, and end. Inactive (no events, no timing) when no handler is registered.
+    def __init__(self, scope, name, total, **counters):
+        self.scope = scope
+        self.name = name
+        self.total = int(total)
+        self.done = 0
+        self.active = enabled()
+        self.start_time = time.perf_counter()
+        if self.active:
+            emit(scope, 'start', name, total=self.total, **counters)
+
+    def counters(self):
+        elapsed = time.perf_counter() - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else None
+        return {'done': self.done, 'total': self.total, 'remaining': self.total - self.done, 'elapsed': elapsed, 'eta': eta}
+
+    # Method advance: count items as done and emit a progress event
+    def advance(self, num_items=1, **counters):
+        self.done += num_items
+        if self.active:
+            emit(self.scope, 'progress', self.name, **self.counters(), **counters)
+
+    # Method end: emit the end event
+    def end(self, **counters):
+        if self.active:
+            emit(self.scope, 'end', self.name, **self.counters(), **counters)
+
+
+def _format_seconds(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}h{seconds // 60 % 60:02d}m' if seconds >= 3600 else f'{seconds // 60}m{seconds % 60:02d}s'
+
+
+class ConsoleProgress:
+    # Console handler: one line per stage start and end, and a progress bar of the progress events of the given scopes
+    # redrawn at most every min_interval seconds
+    def __init__(self, stream=None, min_interval=0.5, width=30, scopes=('zone',)):
+        self.stream = stream or sys.stderr
+        self.scopes = scopes
+        self.min_interval = min_interval
+        self.width = width
+        self.last_draw = 0.0
+
+    def __call__(self, event):
+        if event['scope'] == 'stage' and event['phase'] in ('start', 'end'):
+            self._line(f"{event['name']}: {'started' if event['phase'] == 'start' else event.get('status', 'done')}"
+                       + (f" in {_format_seconds(event['elapsed'])}" if 'elapsed' in event else '') + '\n')
+        elif event['phase'] == 'progress' and event['scope'] in self.scopes and 'total' in event:
+            now = time.monotonic()
+            if now - self.last_draw < self.min_interval and event['done'] < event['total']:
+                return
+            self.last_draw = now
+            fraction = event['done'] / event['total'] if event['total'] else 1.0
+            filled = int(round(fraction * self.width))
+            eta = f" ETA {_format_seconds(event['eta'])}" if event.get('eta') is not None else ''
+            self._line(f"\r{event['name']} [{'#' * filled}{'-' * (self.width - filled)}] {100 * fraction:5.1f}% "
+                       f"{event['done']}/{event['total']} {event['scope']}{eta}" + ('\n' if event['done'] >= event['total'] else ''))
+
+    def _line(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable")
+
+
+class JsonLinesLog:
+    # Event log handler: each event appended to file_path as one JSON line, flushed so a monitor can follow the file
+    def __init__(self, file_path):
+        self.file = open(file_path, 'a')
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=_json_default) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
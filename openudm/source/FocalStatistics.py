@@ -0,0 +1,78 @@
+import numpy as np
+from scipy import ndimage
+from scipy.signal import fftconvolve
+
+############################################################################################################
+# Focal (moving window) statistics for neighbourhood attractors
+# Neighbourhood sums are computed by FFT convolution, or by separable Gaussian filtering, so the cost does not
+# grow with the kernel radius. NoData cells are left out of both the weighted sum and the kernel weight, so a
+# focal mean near the edge of the study area or next to NoData is the mean over the valid cells only.
+############################################################################################################
+
+# Kernel types
+KERNELS = ['circular', 'gaussian', 'annulus']
+
+
+# Function kernel_distance: Distance in map units from the centre of a kernel of the given radius to each kernel cell.
+# The kernel is limited to the extent of a grid of shape grid_shape, as cells beyond it never overlap the grid,
+# so the FFT size is bounded by twice the grid size whatever the radius.
+def kernel_distance(radius, cellsize, grid_shape=None):
+    r = int(radius // cellsize)
+    r_rows, r_cols = (r, r) if grid_shape is None else (min(r, grid_shape[0] - 1), min(r, grid_shape[1] - 1))
+    rows, cols = np.ogrid[-r_rows:r_rows + 1, -r_cols:r_cols + 1]
+    return np.hypot(rows * cellsize, cols * cellsize)
+
+# Function circular_kernel: 1 on cells whose centre lies within radius (map units) of the centre cell, else 0
+def circular_kernel(radius, cellsize, grid_shape=None):
+    return (kernel_distance(radius, cellsize, grid_shape) <= radius).astype(np.float64)
+
+# Function annulus_kernel: 1 on cells whose centre lies between inner_radius (exclusive) and radius (inclusive)
+def annulus_kernel(inner_radius, radius, cellsize, grid_shape=None):
+    if inner_radius >= radius:
+        raise ValueError(f"Annulus inner radius {inner_radius} must be smaller than its radius {radius}")
+    distance = kernel_distance(radius, cellsize, grid_shape)
+    return ((distance > inner_radius) & (distance <= radius)).astype(np.float64)
+
+
+# Function _convolve: Neighbourhood weighted sum of array, zero outside the grid. Negligible FFT round-off
+# is removed, as sums of non-negative values must stay non-negative and exactly zero where nothing is near.
+def _convolve(array, kernel):
+    result = fftconvolve(array, kernel, mode='same')
+    result[np.abs(result) < 1e-9 * max(kernel.sum(), 1.0) * max(np.abs(array).max(), 1.0)] = 0
+    return result
+
+
+# Function focal_sums: Weighted neighbourhood sum of the valid values and of the valid kernel weight
+def focal_sums(values, valid, kernel_type, radius, cellsize, inner_radius=0.0):
+    masked = np.where(valid, values, 0).astype(np.float64)
+    weight = valid.astype(np.float64)
+    if kernel_type == 'gaussian':
+        # Separable: two 1-D passes per array, with zero padding like the FFT path
+        sigma = radius / cellsize
+        return (ndimage.gaussian_filter(masked, sigma, mode='constant', cval=0.0) * (2 * np.pi * sigma ** 2),
+                ndimage.gaussian_filter(weight, sigma, mode='constant', cval=0.0) * (2 * np.pi * sigma ** 2))
+    if kernel_type == 'circular':
+        kernel = circular_kernel(radius, cellsize, values.shape)
+    elif kernel_type == 'annulus':
+        kernel = annulus_kernel(inner_radius, radius, cellsize, values.shape)
+    else:
+        raise ValueError(f"Unknown focal kernel {kernel_type}, expected one of {', '.join(KERNELS)}")
+    return _convolve(masked, kernel), _convolve(weight, kernel)
+
+# Function focal_statistic: Focal statistic of values over the kernel, ignoring cells equal to nodata_value
+#   mean - weighted mean of the valid cells in the neighbourhood, e.g. the share of developed land within radius
+#   sum  - weighted sum, e.g. a kernel density of services
+# Cells with no valid neighbour, and NoData cells, are set to nodata_value.
+def focal_statistic(values, nodata_value, kernel_type, radius, cellsize, statistic='mean', inner_radius=0.0):
+    valid = values != nodata_value
+    value_sum, weight_sum = focal_sums(values, valid, kernel_type, radius, cellsize, inner_radius)
+    if statistic == 'sum':
+        result = value_sum
+    elif statistic == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = value_sum / weight_sum
+        result[weight_sum <= 0] = nodata_value
+    else:
+        raise ValueError(f"Unknown focal statistic {statistic}, expected mean or sum")
+    result[~valid] = nodata_value
+    return result
@@ -0,0 +1,172 @@
+import os
+import gzip
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import source.RasterIO as rio
+import source.RasterToolkit as rt
+import source.RasterCatalog as rc
+import source.VectorInput as vi
+
+############################################################################################################
+# On-the-fly grid alignment
+# An input layer whose grid differs from the zone identity grid (another extent, cell size, alignment or
+# NODATA value) is accepted as long as it covers the extent of the zone grid. Only the rows and columns of the
+# layer overlapping the zone grid are parsed, and the window is resampled onto the zone grid with the method of
+# the layer - the resampling column of constraints.csv or attractors.csv:
+#   nearest - the value of the layer cell under the centre of each zone grid cell
+#   mean    - the mean of the layer cells overlapping each cell, weighted by their overlap area
+#   sum     - the layer cells shared out by the fraction of their area in each cell, so the total is preserved
+#             (coverage areas; the default for constraint layers)
+# The overlap weights are separable (rows x columns), so resampling is two sparse matrix products. Resampled
+# layers are cached as .npy files in the output directory, keyed on the layer fingerprint, the zone grid and the
+# method; a layer already on the zone grid is read as it is.
+############################################################################################################
+
+RESAMPLING_METHODS = ['nearest', 'mean', 'sum']
+
+# Default resampling of constraint layers (coverage areas) and attractor layers
+CONSTRAINT_RESAMPLING = 'sum'
+ATTRACTOR_RESAMPLING = 'mean'
+
+# Tolerance on grid coordinates, as a fraction of the cell size
+GRID_TOLERANCE = 1e-6
+
+
+# Function grid_header: Header dictionary (as RasterCatalog.read_header) of the header values [ncols, nrows, xllcorner, yllcorner,
+# cellsize, nodata]
+def grid_header(header_values):
+    return dict(zip(rc.HEADER_KEYS, [int(header_values[0]), int(header_values[1])] + [float(value) for value in header_values[2:]]))
+
+# Function grid_matches: Whether a layer header describes the same grid and NODATA value as the reference header
+def grid_matches(header, reference):
+    return all(np.isclose(header[key], reference[key], rtol=0, atol=GRID_TOLERANCE * max(1.0, abs(reference[key]))) for key in rc.HEADER_KEYS)
+
+# Function covers: Whether the extent of a layer header contains the extent of the reference header
+def covers(header, reference):
+    tolerance = GRID_TOLERANCE * reference['cellsize']
+    return (header['xllcorner'] <= reference['xllcorner'] + tolerance
+            and header['yllcorner'] <= reference['yllcorner'] + tolerance
+            and header['xllcorner'] + header['ncols'] * header['cellsize'] >= reference['xllcorner'] + reference['ncols'] * reference['cellsize'] - tolerance
+            and header['yllcorner'] + header['nrows'] * header['cellsize'] >= reference['yllcorner'] + reference['nrows'] * reference['cellsize'] - tolerance)
+
+# Function resampling_method: Resampling method of a table row - its resampling column, or default when absent or empty
+def resampling_method(row, default):
+    method = row.get('resampling')
+    if not isinstance(method, str) or not method.strip():
+        return default
+    method = method.strip().lower()
+    if method not in RESAMPLING_METHODS:
+        raise ValueError(f"{row.get('layer_name')}: resampling must be one of {', '.join(RESAMPLING_METHODS)}, got {method}")
+    return method
+
+# Function layer_methods: Resampling method of each layer of a constraint or attractor table, keyed on its path
+def layer_methods(path_to_data, layer_tbl, default):
+    return {os.path.join(path_to_data, row['layer_name']): resampling_method(row, default)
+            for row in pd.read_csv(layer_tbl).to_dict(orient='records')}
+
+
+# Function axis_offsets: Offset of the first zone grid cell from the first layer cell along columns (x) and rows (down from the top)
+def axis_offsets(header, reference):
+    layer_top = header['yllcorner'] + header['nrows'] * header['cellsize']
+    reference_top = reference['yllcorner'] + reference['nrows'] * reference['cellsize']
+    return layer_top - reference_top, reference['xllcorner'] - header['xllcorner']
+
+# Function layer_window: Rows and columns (row0, row1, col0, col1) of the layer overlapping the reference grid
+def layer_window(header, reference):
+    row_offset, col_offset = axis_offsets(header, reference)
+    cellsize, tolerance = header['cellsize'], GRID_TOLERANCE
+    row0 = max(0, int(np.floor(row_offset / cellsize + tolerance)))
+    row1 = min(header['nrows'], int(np.ceil((row_offset + reference['nrows'] * reference['cellsize']) / cellsize - tolerance)))
+    col0 = max(0, int(np.floor(col_offset / cellsize + tolerance)))
+    col1 = min(header['ncols'], int(np.ceil((col_offset + reference['ncols'] * reference['cellsize']) / cellsize - tolerance)))
+    return row0, row1, col0, col1
+
+# Function read_window: Values of the rows row0:row1 and columns col0:col1 of an ESRI ASCII grid; the rows before the window
+# are skipped unparsed and the rows after it are not read
+def read_window(file_path, window):
+    row0, row1, col0, col1 = window
+    with (gzip.open(file_path, 'rt') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
+        lines = itertools.islice(f, 6 + row0, 6 + row1)
+        return np.loadtxt(lines, usecols=range(col0, col1), ndmin=2)
+
+# Function axis_weights: Sparse matrix (target cells x window cells) of the overlap lengths along one axis between num_target
+# cells of target_size starting offset from the layer origin, and the layer cells first:first + num_window of layer_size
+def axis_weights(offset, target_size, num_target, layer_size, first, num_window):
+    starts = offset + np.arange(num_target) * target_size
+    first_overlap = np.floor(starts / layer_size + GRID_TOLERANCE).astype(np.int64)
+    targets, cells, lengths = [], [], []
+    for k in range(int(np.ceil(target_size / layer_size)) + 1):
+        cell = first_overlap + k
+        length = np.minimum(starts + target_size, (cell + 1) * layer_size) - np.maximum(starts, cell * layer_size)
+        keep = (length > GRID_TOLERANCE * layer_size) & (cell >= first) & (cell < first + num_window)
+        targets.append(np.nonzero(keep)[0])
+        cells.append(cell[keep] - first)
+        lengths.append(length[keep])
+    return sparse.csr_matrix((np.concatenate(lengths), (np.concatenate(targets), np.concatenate(cells))), shape=(num_target, num_window))
+
+# Function nearest_cells: Window cell under the centre of each target cell along one axis
+def nearest_cells(offset, target_size, num_target, layer_size, first, num_window):
+    centres = offset + (np.arange(num_target) + 0.5) * target_size
+    return np.clip(np.floor(centres / layer_size).astype(np.int64) - first, 0, num_window - 1)
+
+# Function resample_window: Resample a window of a layer (header) onto the reference grid with method; cells without data are
+# the NODATA value of the reference grid (0 with sum, which counts them as no coverage)
+def resample_window(values, header, window, reference, method):
+    row0, row1, col0, col1 = window
+    row_offset, col_offset = axis_offsets(header, reference)
+    rows = (row_offset, reference['cellsize'], reference['nrows'], header['cellsize'], row0, row1 - row0)
+    cols = (col_offset, reference['cellsize'], reference['ncols'], header['cellsize'], col0, col1 - col0)
+    valid = values != header['nodata_value']
+    if method == 'nearest':
+        cells = np.ix_(nearest_cells(*rows), nearest_cells(*cols))
+        return np.where(valid[cells], values[cells], reference['nodata_value'])
+
+    row_weights, col_weights = axis_weights(*rows), axis_weights(*cols)
+    # Row weights applied first, then column weights: (row_weights @ values) @ col_weights.T
+    def weighted_sum(array):
+        return (col_weights @ (row_weights @ array).T).T
+    total = weighted_sum(np.where(valid, values, 0))
+    if method == 'sum':
+        return total / header['cellsize'] ** 2
+    area = weighted_sum(valid.astype(np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(area > 0, total / area, reference['nodata_value'])
+
+# Function aligned_layer: A layer read onto the reference grid - as it is when already on the grid, otherwise its overlapping
+# window resampled with method
+# Raises ValueError if the layer does not cover the extent of the reference grid
+def aligned_layer(file_path, reference, method):
+    header = rc.read_header(file_path)
+    if grid_matches(header, reference):
+        return rio.read_raster(file_path)
+    if not covers(header, reference):
+        raise ValueError(f"{file_path} does not cover the extent of the zone identity raster")
+    window = layer_window(header, reference)
+    return resample_window(read_window(file_path, window), header, window, reference, method)
+
+# Function cached_aligned_layer: aligned_layer of a layer off the reference grid, read from cache_dir when resampled there for
+# the same layer file, grid and method
+def cached_aligned_layer(file_path, reference, cache_dir, method):
+    if grid_matches(rc.read_header(file_path), reference):
+        return rio.read_raster(file_path)
+    cache_path = os.path.join(cache_dir, f'{os.path.basename(file_path)}.{method}.npy')
+    key = vi.cache_key({'layer': rt.file_fingerprint(file_path), 'grid': reference, 'method': method})
+    if vi.cache_valid(cache_path, key):
+        return np.load(cache_path)
+    layer = aligned_layer(file_path, reference, method)
+    vi.write_npy_cache(cache_path, layer, key)
+    print(f"Layer {file_path} resampled onto the zone identity grid ({method}).")
+    return layer
+
+# Function aligned_reader: Reader of layers for RasterIO.iter_rasters, aligning each layer onto the grid of header_values with
+# its method in methods (keyed on path; default otherwise) and caching resampled layers in cache_dir. Its key attribute holds
+# the methods, which change the layers read.
+def aligned_reader(header_values, cache_dir, methods=None, default=ATTRACTOR_RESAMPLING):
+    reference = grid_header(header_values)
+    methods = methods or {}
+    def read_layer(file_path):
+        return cached_aligned_layer(file_path, reference, cache_dir, methods.get(file_path, default))
+    read_layer.key = 'resampling=' + ';'.join(f'{os.path.basename(path)}:{method}' for path, method in sorted(methods.items()))
+    return read_layer
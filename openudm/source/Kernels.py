@@ -0,0 +1,199 @@
+import os
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+############################################################################################################
+# Kernel backend for the cellular growth and patch loops
+# Kernels work on flat arrays: int32 flat cell indices / patch IDs and float64 suitability values.
+# When Numba is installed the kernels are JIT-compiled, otherwise the pure-Python/NumPy versions are used.
+# Set OPENUDM_KERNEL_BACKEND=python to force the Python path.
+############################################################################################################
+
+# 8-connected neighbourhood offsets (row, column) used by the patch growth
+NEIGHBOUR_OFFSETS = np.array([(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)], dtype=np.int32)
+
+# Cell states during the patch growth
+_POTENTIAL = 0
+_FRONTIER = 1
+_DEVELOPED = 2
+
+
+# Helpers of grow_patch: binary max-heap of patch positions ordered by suitability, ties going to the lower position
+def _heap_better(cell_suit, a, b):
+    return cell_suit[a] > cell_suit[b] or (cell_suit[a] == cell_suit[b] and a < b)
+
+def _heap_push(heap, size, cell_suit, position):
+    i = size
+    heap[i] = position
+    while i > 0:
+        parent = (i - 1) // 2
+        if not _heap_better(cell_suit, heap[i], heap[parent]):
+            break
+        heap[i], heap[parent] = heap[parent], heap[i]
+        i = parent
+    return size + 1
+
+def _heap_pop(heap, size, cell_suit):
+    top = heap[0]
+    size -= 1
+    heap[0] = heap[size]
+    i = 0
+    while True:
+        best = i
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < size and _heap_better(cell_suit, heap[child], heap[best]):
+                best = child
+        if best == i:
+            break
+        heap[i], heap[best] = heap[best], heap[i]
+        i = best
+    return top, size
+
+
+# Kernel grow_patch: Develop num_required cells of one patch and write the developed flat indices to order,
+# in development order. cells holds the patch's flat cell indices in increasing order and cell_suit their
+# suitability. A seed is the most suitable undeveloped cell; development then spreads to the most suitable
+# cell on the frontier (8-connected neighbours of developed cells) until the frontier is exhausted, when a
+# new seed is taken. Ties are broken by the lowest flat index. Returns the number of cells developed.
+# The frontier is a heap and seeds are taken from the cells sorted by suitability, so growing a whole patch
+# costs O(n log n). The order only depends on the patch, so growing fewer cells gives a prefix of it.
+# The same source is run by the Python backend and compiled by Numba, so both give identical orders.
+def _grow_patch(cells, cell_suit, ncols, nrows, num_required, order):
+    num_cells = cells.shape[0]
+    state = np.zeros(num_cells, dtype=np.int8)
+    target = min(num_required, num_cells)
+    # Seed candidates: positions by decreasing suitability, ties by position (stable sort)
+    seeds = np.argsort(-cell_suit, kind='mergesort')
+    next_seed = 0
+    heap = np.empty(num_cells, dtype=np.int64)
+    heap_size = 0
+    num_developed = 0
+    while num_developed < target:
+        # Seed from the remaining patch cells when the frontier is empty, else develop the best frontier cell
+        if heap_size == 0:
+            while state[seeds[next_seed]] != _POTENTIAL:
+                next_seed += 1
+            best = seeds[next_seed]
+        else:
+            best, heap_size = _heap_pop(heap, heap_size, cell_suit)
+        state[best] = _DEVELOPED
+        order[num_developed] = cells[best]
+        num_developed += 1
+        # Add the undeveloped neighbours of the new cell to the frontier
+        row = cells[best] // ncols
+        col = cells[best] % ncols
+        for k in range(NEIGHBOUR_OFFSETS.shape[0]):
+            nrow = row + NEIGHBOUR_OFFSETS[k, 0]
+            ncol = col + NEIGHBOUR_OFFSETS[k, 1]
+            if nrow < 0 or nrow >= nrows or ncol < 0 or ncol >= ncols:
+                continue
+            neighbour = nrow * ncols + ncol
+            j = np.searchsorted(cells, neighbour)
+            if j < num_cells and cells[j] == neighbour and state[j] == _POTENTIAL:
+                state[j] = _FRONTIER
+                heap_size = _heap_push(heap, heap_size, cell_suit, j)
+    return num_developed
+
+
+# Kernel patch_sizes: number of cells with each patch ID in 0..num_patches
+def _patch_sizes_python(patch_ids, num_patches):
+    return np.bincount(patch_ids, minlength=num_patches + 1)
+
+def _patch_sizes_loop(patch_ids, num_patches):
+    sizes = np.zeros(num_patches + 1, dtype=np.int64)
+    for i in range(patch_ids.shape[0]):
+        sizes[patch_ids[i]] += 1
+    return sizes
+
+
+# Kernel segment_means: mean of each segment values[starts[p]:starts[p + 1]] (NaN for empty segments), summed as np.mean sums
+# a contiguous float64 array, so the means are bit-identical to np.mean of the segments
+def _segment_means_python(values, starts):
+    sizes = np.diff(starts)
+    means = np.full(sizes.shape[0], np.nan)
+    for p in np.flatnonzero(sizes):
+        means[p] = np.add.reduce(values[starts[p]:starts[p + 1]]) / sizes[p]
+    return means
+
+# Helper of segment_means: NumPy's pairwise summation of values[start:start + n] - blocks of up to 128 values summed in eight
+# interleaved partial sums, longer runs split in halves (rounded to a multiple of 8) and summed recursively
+def _pairwise_sum(values, start, n):
+    if n < 8:
+        total = 0.0
+        for i in range(n):
+            total += values[start + i]
+        return total
+    if n <= 128:
+        partial = np.empty(8, dtype=np.float64)
+        for j in range(8):
+            partial[j] = values[start + j]
+        i = 8
+        while i < n - n % 8:
+            for j in range(8):
+                partial[j] += values[start + i + j]
+            i += 8
+        total = ((partial[0] + partial[1]) + (partial[2] + partial[3])) + ((partial[4] + partial[5]) + (partial[6] + partial[7]))
+        while i < n:
+            total += values[start + i]
+            i += 1
+        return total
+    half = n // 2
+    half -= half % 8
+    return _pairwise_sum(values, start, half) + _pairwise_sum(values, start + half, n - half)
+
+def _segment_means_loop(values, starts):
+    means = np.empty(starts.shape[0] - 1, dtype=np.float64)
+    for p in range(means.shape[0]):
+        n = starts[p + 1] - starts[p]
+        means[p] = _pairwise_sum(values, starts[p], n) / n if n > 0 else np.nan
+    return means
+
+
+# Backend selection
+PYTHON_KERNELS = {
+    'grow_patch': _grow_patch,
+    'patch_sizes': _patch_sizes_python,
+    'segment_means': _segment_means_python,
+}
+
+if numba is not None and os.environ.get('OPENUDM_KERNEL_BACKEND', 'numba') != 'python':
+    BACKEND = 'numba'
+    # The helpers are compiled first, so the compiled grow_patch and segment_means call their compiled versions
+    _heap_better = numba.njit(cache=True)(_heap_better)
+    _heap_push = numba.njit(cache=True)(_heap_push)
+    _heap_pop = numba.njit(cache=True)(_heap_pop)
+    grow_patch = numba.njit(cache=True)(_grow_patch)
+    patch_sizes = numba.njit(cache=True)(_patch_sizes_loop)
+    _pairwise_sum = numba.njit(cache=True)(_pairwise_sum)
+    segment_means = numba.njit(cache=True)(_segment_means_loop)
+else:
+    BACKEND = 'python'
+    grow_patch = _grow_patch
+    patch_sizes = _patch_sizes_python
+    segment_means = _segment_means_python
+
+
+####################################################################################################################
+# Patch helpers built on the kernels
+####################################################################################################################
+
+# Function patch_means: mean of values over the cells of each patch ID in 0..num_patches (NaN for empty IDs), bit-identical to
+# np.mean over the cells of each patch: the values are grouped by patch in flat index order and each group is summed as np.mean does
+def patch_means(patch_ids, values, num_patches):
+    cells, starts = group_patch_cells(patch_ids, num_patches)
+    values = np.ascontiguousarray(values, dtype=np.float64).ravel()[cells]
+    return segment_means(values, starts)
+
+# Function group_patch_cells: flat cell indices grouped by patch ID - cells of patch p are
+# cells[starts[p]:starts[p + 1]], in increasing flat index order as required by grow_patch
+def group_patch_cells(patch_ids, num_patches):
+    patch_ids = np.ascontiguousarray(patch_ids, dtype=np.int32).ravel()
+    cells = np.argsort(patch_ids, kind='stable').astype(np.int32)
+    starts = np.zeros(num_patches + 2, dtype=np.int64)
+    starts[1:] = np.cumsum(patch_sizes(patch_ids, num_patches))
+    return cells, starts
+
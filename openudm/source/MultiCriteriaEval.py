@@ -1,30 +1,76 @@
 import pandas as pd
 import numpy as np
 import os
+import source.RasterIO as rio
+import source.SuitabilityExpression as se
 
 
 #Function: MaskedWeightedSum
+# attractor_layers: optional dictionary of standardised attractor layers held in memory, keyed on layer name;
+# the other attractors are read from their std_ files in output_path
+# expression: optional suitability expression (SuitabilityExpression.py) replacing the weighted sum, evaluated a tile of
+# tile_rows rows at a time
 def multi_criteria_eval(constraint_ras, num_attractors, attractors_tbl, cell_suit_ras, 
-                      header_text,header_values, output_path, rval):
+                      header_text,header_values, output_path, rval, attractor_layers=None, expression=None, tile_rows=rio.WRITE_BLOCK_ROWS):
+    if expression is not None:
+        suitability_layer = expression_suitability(expression, constraint_ras, num_attractors, attractors_tbl, header_values, output_path,
+                                                   rval, attractor_layers, tile_rows)
+        rio.write_raster(suitability_layer, cell_suit_ras, header_text, fmt='%1.3f')
+        return
     # Read the attractors table - names and weights
     attractor_name_list, attractor_weight_list = pd.read_csv(attractors_tbl, usecols=[0, 2]).values.T
     # Normalise the weights
     sum_weight = sum(attractor_weight_list)
     normalised_weight_list = attractor_weight_list / sum_weight
-    # Load the attractor layers
-    attractor_layers = [np.loadtxt(os.path.join(output_path,'std_' + attractor_name_list[i]), skiprows=6) for i in range(num_attractors)]
+    # Load the attractor layers - std_ files are read concurrently and added to the weighted sum as they arrive
+    attractor_layers = attractor_layers or {}
+    file_layers = rio.iter_rasters([os.path.join(output_path, 'std_' + attractor_name_list[i]) for i in range(num_attractors)
+                                    if attractor_name_list[i] not in attractor_layers])
     # Calculate the weighted sum
-    summed_attractor_layer = sum(attractor_layers[i] * normalised_weight_list[i] for i in range(num_attractors))
+    summed_attractor_layer = sum((attractor_layers[attractor_name_list[i]] if attractor_name_list[i] in attractor_layers else next(file_layers))
+                                 * normalised_weight_list[i] for i in range(num_attractors))
     if rval:
         summed_attractor_layer = np.ones((header_values[1],header_values[0]))-summed_attractor_layer
     # Load the constraint layer
-    constraint_layer = np.loadtxt(constraint_ras, skiprows=6)
+    constraint_layer = rio.read_raster(constraint_ras)
     # Calculate the suitability layer
     suitability_layer = constraint_layer * summed_attractor_layer
     # Mask the suitability layer
     suitability_layer[constraint_layer == header_values[-1]] = header_values[-1]
     # Save the suitability layer
-    with open(cell_suit_ras, 'w') as f:
-        f.write(''.join(header_text))
-        np.savetxt(f, suitability_layer, fmt='%1.3f')
-    
\ No newline at end of file
+    rio.write_raster(suitability_layer, cell_suit_ras, header_text, fmt='%1.3f')
+    
+# Function expression_suitability: Suitability raster of a suitability expression over the standardised attractors, masked by
+# the constraint raster as the weighted sum is. It is evaluated a tile of tile_rows rows at a time: the constraint raster and
+# the std_ files of the attractors the expression uses are streamed tile by tile (attractors held in memory are sliced), so the
+# suitability raster is the only array of the size of the grid.
+def expression_suitability(expression, constraint_ras, num_attractors, attractors_tbl, header_values, output_path, rval,
+                           attractor_layers=None, tile_rows=rio.WRITE_BLOCK_ROWS):
+    attractor_name_list, attractor_weight_list = pd.read_csv(attractors_tbl, usecols=[0, 2]).values.T
+    compiled = se.SuitabilityExpression(expression, attractor_name_list[:num_attractors], attractor_weight_list[:num_attractors])
+    nrows, ncols, nodata_value = int(header_values[1]), int(header_values[0]), header_values[-1]
+    attractor_layers = attractor_layers or {}
+    # Tiles of the attractors the expression uses, keyed on their alias
+    attractor_tiles = {}
+    for attractor_name in attractor_name_list[:num_attractors]:
+        alias = se.layer_alias(attractor_name)
+        if alias not in compiled.layers:
+            continue
+        if attractor_name in attractor_layers:
+            attractor_tiles[alias] = row_tiles(attractor_layers[attractor_name], tile_rows)
+        else:
+            attractor_tiles[alias] = rio.iter_row_blocks(os.path.join(output_path, 'std_' + attractor_name), tile_rows)
+
+    suitability_layer = np.empty((nrows, ncols))
+    for start, constraint_tile in zip(range(0, nrows, tile_rows), rio.iter_row_blocks(constraint_ras, tile_rows)):
+        value = compiled.evaluate({alias: next(tiles) for alias, tiles in attractor_tiles.items()})
+        if rval:
+            value = 1 - value
+        suitability_tile = constraint_tile * value
+        suitability_tile[constraint_tile == nodata_value] = nodata_value
+        suitability_layer[start:start + tile_rows] = suitability_tile
+    return suitability_layer
+
+# Function row_tiles: Tiles of tile_rows rows of an array held in memory, in the order rio.iter_row_blocks yields the tiles of a file
+def row_tiles(array, tile_rows):
+    return (array[start:start + tile_rows] for start in range(0, array.shape[0], tile_rows))
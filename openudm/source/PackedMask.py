@@ -0,0 +1,158 @@
+import numpy as np
+import source.RasterIO as rio
+
+############################################################################################################
+# Bit-packed boolean raster for constraint and development masks
+# A mask holds one bit per cell for its value plus one bit per cell for NoData, packed eight cells per byte,
+# i.e. 2 bits per cell instead of the 64 of a float64 raster. Value bits are always 0 on NoData cells and on
+# the padding at the end, so counts are plain popcounts.
+# Mask rasters are packed as their rows are read (read_mask), and unpacked a window of the grid at a time
+# (window_bool), so the constraint and current development masks are never held as full dense rasters.
+############################################################################################################
+
+# Rows per block when a mask raster is read: a multiple of 8, so every block but the last packs into whole bytes
+READ_BLOCK_ROWS = 256
+
+# Number of set bits in each byte value, for NumPy versions without np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# Function popcount: Number of set bits in a uint8 array
+def popcount(packed):
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(packed).sum(dtype=np.int64))
+    return int(_POPCOUNT_TABLE[packed].sum(dtype=np.int64))
+
+
+class PackedMask:
+    # bits: packed value bits, nodata: packed NoData bits, shape: raster shape
+    def __init__(self, bits, nodata, shape):
+        self.bits = bits
+        self.nodata = nodata
+        self.shape = tuple(shape)
+
+    # Constructor from_bool: mask of a boolean array, with an optional boolean NoData array
+    @classmethod
+    def from_bool(cls, values, nodata=None):
+        values = np.asarray(values, dtype=bool)
+        if nodata is None:
+            nodata_bits = np.zeros((values.size + 7) // 8, dtype=np.uint8)
+        else:
+            nodata = np.asarray(nodata, dtype=bool)
+            values = values & ~nodata
+            nodata_bits = np.packbits(nodata.ravel())
+        return cls(np.packbits(values.ravel()), nodata_bits, values.shape)
+
+    # Constructor from_array: mask of a 0/1 raster array; cells equal to nodata_value are NoData, other non-zero cells are set
+    @classmethod
+    def from_array(cls, array, nodata_value=None):
+        nodata = None if nodata_value is None else array == nodata_value
+        return cls.from_bool(array != 0, nodata)
+
+    # Constructor from_row_blocks: mask of a 0/1 raster given as blocks of rows (e.g. RasterIO.iter_row_blocks), packed block by
+    # block; every block but the last must hold a multiple of 8 cells
+    @classmethod
+    def from_row_blocks(cls, blocks, nodata_value=None):
+        bits, nodata, nrows, ncols = [], [], 0, 0
+        for block in blocks:
+            if (nrows * ncols) % 8:
+                raise ValueError("Mask row blocks must hold a multiple of 8 cells, except the last")
+            mask = cls.from_array(block, nodata_value)
+            bits.append(mask.bits)
+            nodata.append(mask.nodata)
+            nrows, ncols = nrows + block.shape[0], block.shape[1]
+        empty = np.zeros(0, dtype=np.uint8)
+        return cls(np.concatenate(bits) if bits else empty, np.concatenate(nodata) if nodata else empty, (nrows, ncols))
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    # Method to_bool: boolean NumPy array of the mask values (False on NoData)
+    def to_bool(self):
+        return np.unpackbits(self.bits, count=self.size).view(bool).reshape(self.shape)
+
+    # Method nodata_bool: boolean NumPy array of the NoData cells
+    def nodata_bool(self):
+        return np.unpackbits(self.nodata, count=self.size).view(bool).reshape(self.shape)
+
+    # Method window_bool: boolean NumPy array of the mask values in a window (row slice, column slice) of the raster, unpacking
+    # only the bytes of its rows
+    def window_bool(self, window):
+        return self._unpack_rows(self.bits, window)
+
+    # Method window_nodata: boolean NumPy array of the NoData cells in a window of the raster
+    def window_nodata(self, window):
+        return self._unpack_rows(self.nodata, window)
+
+    def _unpack_rows(self, packed, window):
+        rows, cols = window
+        start_row, stop_row, _ = rows.indices(self.shape[0])
+        start, stop = start_row * self.shape[1], max(stop_row, start_row) * self.shape[1]
+        values = np.unpackbits(packed[start // 8:(stop + 7) // 8])[start % 8:start % 8 + stop - start]
+        return values.view(bool).reshape(-1, self.shape[1])[:, cols]
+
+    # Method to_array: raster array with 1 for set cells, 0 for unset cells and nodata_value on NoData cells
+    def to_array(self, nodata_value=-1, dtype=np.float64):
+        array = self.to_bool().astype(dtype)
+        array[self.nodata_bool()] = nodata_value
+        return array
+
+    # Method count: number of set cells
+    def count(self):
+        return popcount(self.bits)
+
+    # Method count_nodata: number of NoData cells
+    def count_nodata(self):
+        return popcount(self.nodata)
+
+    def _check_shape(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f"Mask shape mismatch: {self.shape} and {other.shape}")
+
+    # Operators: a cell is NoData in the result if it is NoData in either operand
+    def __and__(self, other):
+        self._check_shape(other)
+        nodata = self.nodata | other.nodata
+        return PackedMask(self.bits & other.bits & ~nodata, nodata, self.shape)
+
+    def __or__(self, other):
+        self._check_shape(other)
+        nodata = self.nodata | other.nodata
+        return PackedMask((self.bits | other.bits) & ~nodata, nodata, self.shape)
+
+    def __invert__(self):
+        return PackedMask(~self.bits & ~self.nodata & self._padding_mask(), self.nodata.copy(), self.shape)
+
+    # Helper: byte mask that clears the padding bits after the last cell
+    def _padding_mask(self):
+        padding = np.full(len(self.bits), 0xFF, dtype=np.uint8)
+        if self.size % 8:
+            padding[-1] = (0xFF << (8 - self.size % 8)) & 0xFF
+        return padding
+
+    def __eq__(self, other):
+        return (isinstance(other, PackedMask) and self.shape == other.shape
+                and np.array_equal(self.bits, other.bits) and np.array_equal(self.nodata, other.nodata))
+
+    # Method save: compact on-disk form - the packed bits and the raster header values in one .npz file
+    def save(self, file_path, header_values=None):
+        header_values = np.asarray(header_values if header_values is not None else [], dtype=np.float64)
+        with open(file_path, 'wb') as f:
+            np.savez_compressed(f, bits=self.bits, nodata=self.nodata, shape=np.asarray(self.shape), header_values=header_values)
+
+    # Constructor load: read a mask saved with save; returns the mask and the header values
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data['bits'], data['nodata'], data['shape']), data['header_values'].tolist()
+
+
+# Function packed_mask_path: Path of the compact form of a mask raster, e.g. constraint.asc -> constraint.mask.npz
+def packed_mask_path(raster_path):
+    return raster_path.rsplit('.', 1)[0] + '.mask.npz'
+
+# Function read_mask: Mask of a 0/1 ESRI ASCII grid (cells equal to nodata_value are NoData), packed block by block as its rows
+# are read, so the raster is never parsed in full
+def read_mask(file_path, nodata_value, block_rows=READ_BLOCK_ROWS):
+    return PackedMask.from_row_blocks(rio.iter_row_blocks(file_path, block_rows), nodata_value)
@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import source.RasterIO as rio
+import source.RasterToolkit as rt
+
+############################################################################################################
+# Multi-resolution outputs
+# Aggregated copies of the development and suitability outputs at coarser cell sizes (factor x factor blocks
+# of the base grid), for each factor:
+#   out_cell_dev_count_<f>x.asc     - number of developed cells (current and new) in the block
+#   out_new_dev_fraction_<f>x.asc   - fraction of the block's valid cells newly developed
+#   out_cell_suit_mean_<f>x.asc     - mean cell suitability over the block's valid cells
+# Blocks are aligned on the top-left corner of the grid; edge blocks cover the cells left over, and blocks
+# without valid cells are NoData. The base rasters are reduced once, in bands of rows, to per-block sums at the
+# finest factor; each coarser factor is reduced from the finest level it is a multiple of, so every level comes
+# from the same pass over the base grid.
+############################################################################################################
+
+# Blocks of rows reduced per band of the base grid
+BAND_BLOCKS = 64
+
+# Sums kept per block: valid cells, developed cells, newly developed cells and the suitability of the valid cells
+SUM_NAMES = ['valid', 'developed', 'new', 'suitability']
+
+
+# Function parse_factors: Pyramid factors from the pyramid_factors parameter - an integer or integers separated by
+# spaces or semicolons (e.g. '2;10;50') - sorted and without duplicates; no factors when empty
+def parse_factors(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return []
+    factors = sorted({int(float(factor)) for factor in str(value).replace(';', ' ').split()})
+    if any(factor < 2 for factor in factors):
+        raise ValueError(f"pyramid_factors must be integers of at least 2, got {value}")
+    return factors
+
+# Function block_reduce: Sums of factor x factor blocks of the last two axes of array (edge blocks may be partial)
+def block_reduce(array, factor):
+    rows = np.arange(0, array.shape[-2], factor)
+    cols = np.arange(0, array.shape[-1], factor)
+    return np.add.reduceat(np.add.reduceat(array, rows, axis=-2), cols, axis=-1)
+
+# Function base_block_sums: Block sums (stacked as SUM_NAMES) of the new development, current development and cell
+# suitability rasters at factor, one band of rows at a time; current_dev_mask is the current development as a PackedMask,
+# unpacked a band at a time
+def base_block_sums(new_development, current_dev_mask, cell_suit_ras, nodata_value, factor):
+    nrows, ncols = new_development.shape
+    sums = np.zeros((len(SUM_NAMES), -(-nrows // factor), -(-ncols // factor)))
+    band_rows = factor * BAND_BLOCKS
+    for start in range(0, nrows, band_rows):
+        rows = slice(start, start + band_rows)
+        valid = new_development[rows] != nodata_value
+        developed = valid & (new_development[rows] == 1)
+        new = developed & ~current_dev_mask.window_bool((rows, slice(None)))
+        suitability = np.where(valid, cell_suit_ras[rows], 0)
+        band = np.stack([valid, developed, new, suitability]).astype(np.float64)
+        sums[:, start // factor:start // factor + -(-band.shape[1] // factor)] = block_reduce(band, factor)
+    return sums
+
+# Function pyramid_sums: Block sums at each factor, each level reduced from the finest computed level it is a multiple of
+def pyramid_sums(new_development, current_dev_mask, cell_suit_ras, nodata_value, factors):
+    levels = {}
+    for factor in sorted(factors):
+        finer = [f for f in levels if factor % f == 0]
+        if finer:
+            levels[factor] = block_reduce(levels[max(finer)], factor // max(finer))
+        else:
+            levels[factor] = base_block_sums(new_development, current_dev_mask, cell_suit_ras, nodata_value, factor)
+    return levels
+
+# Function pyramid_header_values: Header values of the grid of factor x factor blocks, top-left aligned with the base grid
+def pyramid_header_values(header_values, factor):
+    ncols, nrows, xllcorner, yllcorner, cellsize, nodata_value = header_values
+    block_rows, block_cols = -(-int(nrows) // factor), -(-int(ncols) // factor)
+    top = yllcorner + nrows * cellsize
+    return [block_cols, block_rows, xllcorner, top - block_rows * factor * cellsize, cellsize * factor, nodata_value]
+
+# Function write_pyramids: Write the aggregated outputs at each factor to path_to_output; returns the file paths written
+def write_pyramids(new_development, current_dev_mask, cell_suit_ras, header_values, factors, path_to_output):
+    nodata_value = header_values[-1]
+    file_paths = []
+    for factor, sums in pyramid_sums(new_development, current_dev_mask, cell_suit_ras, nodata_value, factors).items():
+        valid, developed, new, suitability = sums
+        has_data = valid > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            outputs = {'out_cell_dev_count': (np.where(has_data, developed, nodata_value), '%d'),
+                       'out_new_dev_fraction': (np.where(has_data, new / valid, nodata_value), '%1.4f'),
+                       'out_cell_suit_mean': (np.where(has_data, suitability / valid, nodata_value), '%1.3f')}
+        header_text = rt.header_lines(pyramid_header_values(header_values, factor))
+        for name, (array, fmt) in outputs.items():
+            file_path = os.path.join(path_to_output, f'{name}_{factor}x.asc')
+            rio.write_raster(array, file_path, header_text, fmt)
+            file_paths.append(file_path)
+    return file_paths
+
+# Function pyramid_file_paths: Files written by write_pyramids for the given factors
+def pyramid_file_paths(path_to_output, factors):
+    return [os.path.join(path_to_output, f'{name}_{factor}x.asc') for factor in factors
+            for name in ['out_cell_dev_count', 'out_new_dev_fraction', 'out_cell_suit_mean']]
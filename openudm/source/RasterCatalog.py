@@ -0,0 +1,152 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import source.RasterToolkit as rt
+import source.Attractors as at
+import source.VectorInput as vi
+import source.GridAlignment as ga
+
+############################################################################################################
+# Raster catalog - header-only validation of the input layers and cached layer statistics
+# Every layer named in the input tables is checked against the zone identity raster from its six header lines,
+# so a misconfigured run fails before any layer is parsed. Constraint and attractor layers read from file may be
+# on another grid if they cover the extent of the zone identity raster; they are resampled onto it as they are
+# read (GridAlignment.py). Masked statistics (min, max and count of the layer
+# over the valid zone cells) are cached in a JSON file keyed on the fingerprints of the layer and the zone
+# identity raster, so standardisation can reuse them instead of rescanning the layer.
+############################################################################################################
+
+# Header keys compared against the reference raster
+HEADER_KEYS = ['ncols', 'nrows', 'xllcorner', 'yllcorner', 'cellsize', 'nodata_value']
+
+
+# Function read_header: Header of an ESRI ASCII grid as a dictionary with the keys of HEADER_KEYS.
+# Cell-centre origins (xllcenter/yllcenter) are converted to corners; NODATA_value defaults to -9999.
+def read_header(file_path):
+    header = {}
+    with open(file_path, 'r') as f:
+        for _ in range(6):
+            fields = f.readline().split()
+            if len(fields) != 2:
+                break
+            header[fields[0].lower()] = float(fields[1])
+    if not {'ncols', 'nrows', 'cellsize'} <= set(header):
+        raise ValueError(f"{file_path} is not an ESRI ASCII grid: incomplete header")
+    for axis in ['x', 'y']:
+        if axis + 'llcenter' in header:
+            header[axis + 'llcorner'] = header.pop(axis + 'llcenter') - header['cellsize'] / 2
+    header.setdefault('nodata_value', -9999.0)
+    header['ncols'], header['nrows'] = int(header['ncols']), int(header['nrows'])
+    return {key: header.get(key) for key in HEADER_KEYS}
+
+
+class RasterCatalog:
+    # reference_path: zone identity raster every layer must match; stats_cache_path: JSON statistics cache (optional)
+    def __init__(self, reference_path, stats_cache_path=None):
+        self.reference_path = reference_path
+        self.reference = read_header(reference_path)
+        self.layers = {}
+        self.stats_cache_path = stats_cache_path
+        self._stats = {}
+        if stats_cache_path is not None and os.path.exists(stats_cache_path):
+            with open(stats_cache_path) as f:
+                self._stats = json.load(f)
+
+    # Method add: register a layer by name; its header is read, not its values. A layer with a resampling method may be on
+    # another grid covering the reference extent.
+    def add(self, name, file_path, resampling=None):
+        if not os.path.exists(file_path):
+            self.layers[name] = {'path': file_path, 'header': None, 'resampling': resampling}
+        else:
+            self.layers[name] = {'path': file_path, 'header': read_header(file_path), 'resampling': resampling}
+
+    # Method resampled: whether a layer is off the reference grid and resampled onto it as it is read
+    def resampled(self, name):
+        layer = self.layers[name]
+        return (layer['resampling'] is not None and layer['header'] is not None
+                and not ga.grid_matches(layer['header'], self.reference))
+
+    # Method problems: list of mismatches between each layer's header and the reference header
+    def problems(self):
+        problems = []
+        for name, layer in self.layers.items():
+            if layer['header'] is None:
+                problems.append(f"{name}: file {layer['path']} not found")
+                continue
+            if self.resampled(name):
+                if not ga.covers(layer['header'], self.reference):
+                    problems.append(f"{name}: does not cover the extent of the zone identity raster")
+                continue
+            for key in HEADER_KEYS:
+                expected, found = self.reference[key], layer['header'][key]
+                if not np.isclose(found, expected, rtol=0, atol=1e-6 * max(1.0, abs(expected))):
+                    problems.append(f"{name}: {key} is {rt.header_number(found)}, expected {rt.header_number(expected)} as in the zone identity raster")
+        return problems
+
+    # Method validate: raise ValueError listing every mismatched or missing layer
+    def validate(self):
+        problems = self.problems()
+        if problems:
+            raise ValueError("Input rasters do not match the zone identity raster:\n  " + "\n  ".join(problems))
+
+    def _stats_key(self, name):
+        key = f"{name}|{rt.file_fingerprint(self.layers[name]['path'])}|{rt.file_fingerprint(self.reference_path)}"
+        return key + f"|{self.layers[name]['resampling']}" if self.resampled(name) else key
+
+    # Method cached_stats: cached masked statistics of a layer, or None when the layer or the zone raster changed
+    def cached_stats(self, name):
+        if name not in self.layers or self.layers[name]['header'] is None:
+            return None
+        return self._stats.get(self._stats_key(name))
+
+    # Method layer_stats: masked statistics {'min', 'max', 'count'} of a layer over the valid cells of the zone
+    # identity raster (mask_valid), computed from array and cached when not already cached
+    def layer_stats(self, name, array, mask_valid):
+        stats = self.cached_stats(name)
+        if stats is None:
+            stats = masked_stats(array, mask_valid)
+            if name in self.layers and self.layers[name]['header'] is not None:
+                self._stats[self._stats_key(name)] = stats
+        return stats
+
+    # Method save: write the statistics cache, keeping only the entries of the current files
+    def save(self):
+        if self.stats_cache_path is None:
+            return
+        current = {self._stats_key(name) for name, layer in self.layers.items() if layer['header'] is not None}
+        stats = {key: value for key, value in self._stats.items() if key in current}
+        tmp_path = self.stats_cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(stats, f, indent=1)
+        os.replace(tmp_path, self.stats_cache_path)
+
+
+# Function masked_stats: min, max and count of array over the cells where mask_valid is True
+def masked_stats(array, mask_valid):
+    valid_data = array[mask_valid]
+    return {'min': float(valid_data.min()), 'max': float(valid_data.max()), 'count': int(valid_data.size)}
+
+
+# Function build_catalog: Catalog of every raster named in the input tables - the constraint layers, the attractor
+# layers read from file and the source and cost rasters of generated attractors - validated from their headers.
+# Constraint layers given as vector files are rasterised onto the grid (VectorInput.py) and only checked to exist. Constraint
+# and attractor layers read from file take the resampling method of their table row (GridAlignment.resampling_method).
+def build_catalog(path_to_data, zone_id_ras, constraints_tbl, attractors_tbl, stats_cache_path=None):
+    catalog = RasterCatalog(zone_id_ras, stats_cache_path)
+    for constraint in pd.read_csv(constraints_tbl).to_dict(orient='records'):
+        name = constraint['layer_name']
+        if vi.is_vector_file(name):
+            if not os.path.exists(os.path.join(path_to_data, name)):
+                raise ValueError(f"Input rasters do not match the zone identity raster:\n  {name}: file {os.path.join(path_to_data, name)} not found")
+            continue
+        catalog.add(name, os.path.join(path_to_data, name), ga.resampling_method(constraint, ga.CONSTRAINT_RESAMPLING))
+    for attractor in pd.read_csv(attractors_tbl).to_dict(orient='records'):
+        if at.generator_name(attractor) is None:
+            catalog.add(attractor['layer_name'], os.path.join(path_to_data, attractor['layer_name']),
+                        ga.resampling_method(attractor, ga.ATTRACTOR_RESAMPLING))
+        for column in ['source', 'cost']:
+            if isinstance(attractor.get(column), str):
+                catalog.add(attractor[column], os.path.join(path_to_data, attractor[column]))
+    catalog.validate()
+    return catalog
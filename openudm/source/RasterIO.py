@@ -0,0 +1,312 @@
+import os
+import re
+import gzip
+import itertools
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+############################################################################################################
+# Concurrent raster input
+# Layers are read and parsed on a bounded thread pool (file reads and the NumPy text parser release the GIL)
+# and handed to the caller in list order, so computation on the first layers overlaps with reading the later
+# ones. Backpressure: a layer is only started while the parsed size of the layers in flight or waiting to be
+# consumed stays within the memory budget (at least one layer is always allowed).
+# OPENUDM_IO_WORKERS and OPENUDM_IO_MEMORY_MB override the default number of threads and memory budget.
+############################################################################################################
+
+MAX_WORKERS = int(os.environ.get('OPENUDM_IO_WORKERS', min(4, os.cpu_count() or 1)))
+MEMORY_BUDGET = int(os.environ.get('OPENUDM_IO_MEMORY_MB', 2048)) * 2 ** 20
+
+
+# Function read_raster: Read the values of an ESRI ASCII grid, after any pending background write of the file
+def read_raster(file_path):
+    if _active_writer is not None:
+        _active_writer.wait(file_path)
+    return np.loadtxt(file_path, skiprows=6)
+
+# Function raster_nbytes: Size of the parsed float64 array of an ESRI ASCII grid, from its header
+def raster_nbytes(file_path):
+    with (gzip.open(file_path, 'rt') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
+        ncols = int(f.readline().split()[1])
+        nrows = int(f.readline().split()[1])
+    return ncols * nrows * 8
+
+
+class _MemoryBudget:
+    # Counting semaphore over bytes; a request larger than the whole budget waits until nothing else is held
+    def __init__(self, budget):
+        self.budget = budget
+        self.held = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.held == 0 or self.held + nbytes <= self.budget)
+            self.held += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.held -= nbytes
+            self.condition.notify_all()
+
+
+# Function iter_rasters: Yield the arrays of file_paths in order while later layers load in the background.
+# A layer's memory is released to the budget when the caller asks for the next layer, so the caller should not
+# keep every layer if the budget is to hold. Errors raised while reading are raised by the iterator.
+# reader: function reading one file (read_raster by default); nbytes: parsed sizes of the layers, for files without an
+# ESRI ASCII header
+def iter_rasters(file_paths, max_workers=None, memory_budget=None, reader=read_raster, nbytes=None):
+    file_paths = list(file_paths)
+    if not file_paths:
+        return
+    wait_for_writes(file_paths)
+    budget = _MemoryBudget(memory_budget or MEMORY_BUDGET)
+    sizes = list(nbytes) if nbytes is not None else [raster_nbytes(file_path) for file_path in file_paths]
+    workers = max(1, min(max_workers or MAX_WORKERS, len(file_paths)))
+
+    # Layers are admitted in list order by a feeder thread, so the budget never lets a later layer starve the next one
+    with ThreadPoolExecutor(max_workers=workers + 1) as executor:
+        futures = [None] * len(file_paths)
+        admitted = [threading.Event() for _ in file_paths]
+        cancelled = threading.Event()
+        slots = threading.Semaphore(workers)
+
+        def load(i):
+            try:
+                return reader(file_paths[i])
+            finally:
+                slots.release()
+
+        def feed():
+            for i, nbytes in enumerate(sizes):
+                budget.acquire(nbytes)
+                slots.acquire()
+                if cancelled.is_set():
+                    slots.release()
+                    budget.release(nbytes)
+                    return
+                futures[i] = executor.submit(load, i)
+                admitted[i].set()
+
+        feeder = executor.submit(feed)
+        try:
+            for i in range(len(file_paths)):
+                admitted[i].wait()
+                array = futures[i].result()
+                try:
+                    yield array
+                finally:
+                    del array
+                    budget.release(sizes[i])
+        finally:
+            # Stop admitting layers when the caller stops early or a read failed, then let the feeder finish
+            cancelled.set()
+            with budget.condition:
+                budget.held = 0
+                budget.condition.notify_all()
+            feeder.result()
+
+# Function iter_row_blocks: Yield the values of an ESRI ASCII grid a block of block_rows rows at a time, after any pending
+# background write of the file
+def iter_row_blocks(file_path, block_rows):
+    wait_for_writes([file_path])
+    with (gzip.open(file_path, 'rt') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
+        for _ in range(6):
+            f.readline()
+        while True:
+            lines = list(itertools.islice(f, block_rows))
+            if not lines:
+                return
+            yield np.loadtxt(lines, ndmin=2)
+
+# Function read_rasters: Read several rasters concurrently; returns the list of arrays in the order of file_paths
+def read_rasters(file_paths, max_workers=None, memory_budget=None):
+    return list(iter_rasters(file_paths, max_workers, memory_budget or float('inf')))
+
+
+############################################################################################################
+# Raster output
+# Values are formatted a block of rows at a time with vectorised NumPy string operations, giving the same text
+# as np.savetxt for the '%d' and '%<width>.<precision>f' formats (other formats go through np.savetxt). Files
+# ending in .gz are gzip-compressed. Within a background_writer block, writes are queued to a writer thread so
+# output I/O overlaps with the next stage; read_raster waits for a pending write of the file it reads.
+# Every file is written to a temporary name, flushed, fsynced and renamed, so a file is complete or absent.
+############################################################################################################
+
+# Rows formatted per block
+WRITE_BLOCK_ROWS = 256
+
+_FIXED_FORMAT = re.compile(r'^%(\d*)\.(\d+)f$')
+
+
+
+# Function _text_bytes: ASCII text of non-negative integer units with a decimal point before the last precision digits,
+# a '-' before the negative ones, and each value followed by a space or, at the end of a row, a newline. The text is
+# laid out right-aligned in a fixed-width byte matrix, digit by digit with integer arithmetic, and the unused bytes
+# of each value are dropped at the end.
+def _text_bytes(units, negative, precision, ncols):
+    num_values = units.shape[0]
+    num_digits = max(len(str(int(units.max()))) if num_values else 1, precision + 1)
+    point = 1 if precision else 0
+    width = num_digits + point + 2
+    text = np.zeros((num_values, width), dtype=np.uint8)
+
+    # Digit k (from the right) is written if the value has more than k digits, or if it is needed for '0.xxx'
+    powers = 10 ** np.arange(num_digits, dtype=np.int64)
+    value_digits = np.maximum((units[:, None] >= powers[None, :]).sum(axis=1), precision + 1)
+    remainder = units.copy()
+    for k in range(num_digits):
+        column = width - 2 - k - (point if k >= precision else 0)
+        digit = (remainder % 10).astype(np.uint8) + ord('0')
+        text[:, column] = np.where(k < value_digits, digit, 0)
+        remainder //= 10
+    if precision:
+        text[:, width - 2 - precision] = ord('.')
+    rows = np.flatnonzero(negative)
+    text[rows, width - 2 - value_digits[rows] - point] = ord('-')
+    text[:, width - 1] = ord(' ')
+    text[ncols - 1::ncols, width - 1] = ord('\n')
+    return text[text != 0].tobytes()
+
+# Function format_rows_bytes: ASCII text of a 2D array in np.savetxt layout - values separated by spaces, one row
+# per line - for the '%d' and '%<width>.<precision>f' formats with width at most 1. Returns None for other formats
+# and for blocks holding values that printf could round differently (half-way points within the rounding error
+# of the scaling, non-finite or very large values), which are then formatted by np.savetxt.
+def format_rows_bytes(array, fmt='%d'):
+    values = np.asarray(array, dtype=np.float64).ravel()
+    fixed = _FIXED_FORMAT.match(fmt)
+    if fmt == '%d':
+        if not (np.isfinite(values).all() and (np.abs(values) < 2 ** 62).all()):
+            return None
+        truncated = np.trunc(values)
+        return _text_bytes(np.abs(truncated).astype(np.int64), truncated < 0, 0, array.shape[1])
+    if not fixed or int(fixed.group(1) or 0) > 1:
+        return None
+    precision = int(fixed.group(2))
+    with np.errstate(invalid='ignore'):
+        scaled = np.abs(values) * 10 ** precision
+        if not (np.isfinite(scaled).all() and (scaled < 2 ** 53).all()):
+            return None
+        if (np.abs(scaled - np.floor(scaled) - 0.5) <= 1e-6).any():
+            return None
+    return _text_bytes(np.rint(scaled).astype(np.int64), np.signbit(values), precision, array.shape[1])
+
+# Function format_rows: Text of a 2D array in np.savetxt layout
+def format_rows(array, fmt='%d'):
+    text = format_rows_bytes(array, fmt)
+    if text is not None:
+        return text.decode()
+    return ''.join(' '.join(fmt % value for value in row) + '\n' for row in np.asarray(array))
+
+# Function write_raster_now: Write an ESRI ASCII grid (header lines and values) atomically
+def write_raster_now(array, file_path, header_text, fmt='%d'):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as raw:
+        f = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) if file_path.endswith('.gz') else raw
+        f.write(''.join(header_text).encode())
+        for start in range(0, array.shape[0], WRITE_BLOCK_ROWS):
+            block = array[start:start + WRITE_BLOCK_ROWS]
+            text = format_rows_bytes(block, fmt)
+            f.write(text if text is not None else format_rows(block, fmt).encode())
+        if f is not raw:
+            f.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, file_path)
+
+
+class RasterWriter:
+    # Background writer: one thread writes queued rasters in order; at most max_pending rasters wait in the queue
+    def __init__(self, max_pending=4):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = {}
+        self._lock = threading.Condition()
+        self._errors = []
+        self._directories = set()
+        self._thread = threading.Thread(target=self._run, name='RasterWriter', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            array, file_path, header_text, fmt = job
+            try:
+                write_raster_now(array, file_path, header_text, fmt)
+            except Exception as err:
+                self._errors.append(err)
+            finally:
+                with self._lock:
+                    self._pending[file_path] -= 1
+                    if self._pending[file_path] == 0:
+                        del self._pending[file_path]
+                    self._lock.notify_all()
+
+    # Method submit: queue a raster; the array is copied unless copy=False, so the caller may reuse it
+    def submit(self, array, file_path, header_text, fmt='%d', copy=True):
+        self._raise_errors()
+        file_path = os.path.abspath(file_path)
+        with self._lock:
+            self._pending[file_path] = self._pending.get(file_path, 0) + 1
+        self._directories.add(os.path.dirname(file_path))
+        self._queue.put((np.array(array, copy=True) if copy else array, file_path, list(header_text), fmt))
+
+    # Method wait: block until the pending writes of file_path (or of all files) have finished
+    def wait(self, file_path=None):
+        file_path = None if file_path is None else os.path.abspath(file_path)
+        with self._lock:
+            self._lock.wait_for(lambda: not self._pending if file_path is None else file_path not in self._pending)
+        self._raise_errors()
+
+    # Method close: finish all writes, stop the thread and fsync the output directories so the renames are durable
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for directory in self._directories:
+            if hasattr(os, 'O_DIRECTORY'):
+                fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors.pop(0)
+
+
+_active_writer = None
+
+# Function background_writer: Context manager within which write_raster queues writes to a RasterWriter.
+# Leaving the block waits for every write to finish; write errors are raised there at the latest.
+@contextmanager
+def background_writer(max_pending=4):
+    global _active_writer
+    previous = _active_writer
+    writer = RasterWriter(max_pending)
+    _active_writer = writer
+    try:
+        yield writer
+    finally:
+        _active_writer = previous
+        writer.close()
+
+# Function wait_for_writes: Wait for the pending background writes of file_paths
+def wait_for_writes(file_paths):
+    if _active_writer is not None:
+        for file_path in file_paths:
+            _active_writer.wait(file_path)
+
+# Function write_raster: Write a raster, in the background inside a background_writer block
+def write_raster(array, file_path, header_text, fmt='%d'):
+    if _active_writer is not None:
+        _active_writer.submit(array, file_path, header_text, fmt)
+    else:
+        write_raster_now(array, file_path, header_text, fmt)
@@ -1,89 +1,138 @@
 import numpy as np
 import pandas as pd
 import os
+from source.PackedMask import PackedMask, packed_mask_path
+import source.RasterIO as rio
+import source.ConstraintThresholds as ct
 
 ############################################################################################################
 # Functions related find_zone_dev_patches
 ############################################################################################################
-def Standardise(ras_2darray, mask_2darray,novalue_data):
+def Standardise(ras_2darray, mask_2darray,novalue_data, stats=None):
     #standardise the values of matrix to a range of 0 to 1
-    valid_data = ras_2darray[mask_2darray != novalue_data]
-    min_val = np.min(valid_data)
-    max_val = np.max(valid_data)
+    #stats: optional masked min/max of the layer (see RasterCatalog), which saves scanning the layer for them
+    min_val, max_val = _masked_min_max(ras_2darray, mask_2darray, novalue_data, stats)
     standardised_array = (ras_2darray - min_val) / (max_val - min_val)
     return standardised_array
 
 #Function RevPolarityStandardise
-def RevPolarityStandardise(ras_2darray, mask_2darray,novalue_data):
+def RevPolarityStandardise(ras_2darray, mask_2darray,novalue_data, stats=None):
     #standardise the values of matrix to a range of 0 to 1
-    valid_data = ras_2darray[mask_2darray != novalue_data]
-    min_val = np.min(valid_data)
-    max_val = np.max(valid_data)
+    min_val, max_val = _masked_min_max(ras_2darray, mask_2darray, novalue_data, stats)
     standardised_array = (max_val - ras_2darray) / (max_val - min_val)
     return standardised_array
 
+def _masked_min_max(ras_2darray, mask_2darray, novalue_data, stats):
+    if stats is not None:
+        return stats['min'], stats['max']
+    valid_data = ras_2darray[mask_2darray != novalue_data]
+    return np.min(valid_data), np.max(valid_data)
+
 ############################################################################################################
 #Function create_constraint_ras_and_current_dev_ras: Create constraint raster and current development raster
 ############################################################################################################
+# Returns the constraint and current development masks as PackedMask; with write_packed_masks their compact form is written
+# next to the rasters (see PackedMask.packed_mask_path)
+# threshold_cache: optional .npz path of the critical constraint thresholds (ConstraintThresholds.py); the layers are then
+# derived from the cached thresholds, which are only recomputed when the constraint table or layers change
+# layer_reader: optional function reading a constraint layer by path (e.g. VectorInput.constraint_layer_reader, for layers
+# given as vector files); by default the layers are ESRI ASCII grids
 def create_constraint_ras_and_current_dev_ras(path_to_data, header_values, header_text, constraint_ras, current_dev_ras, zone_id_ras,
-                                              constraints_tbl, num_constraints, coverage_threshold):
-    # Read Constraint layers
-    current_development_flag_list, layer_threshold_list, constraint_layers = read_constraint_layers(constraints_tbl, path_to_data, num_constraints)
-    
-    # Calculate Threshold Areas
+                                              constraints_tbl, num_constraints, coverage_threshold, write_packed_masks=False,
+                                              threshold_cache=None, layer_reader=None):
+    # Read the constraints table and calculate Threshold Areas
+    layer_name_list, current_development_flag_list, layer_threshold_list = pd.read_csv(constraints_tbl, usecols=[0, 1, 2]).values.T
     constraint_threshold_area, layer_threshold_area_list = calculate_threshold_areas(header_values, coverage_threshold, layer_threshold_list, num_constraints)
     
-    # Generate Binary Constraint Layer
-    output_constraint_layer = generate_binary_constraint_layer(constraint_layers, layer_threshold_area_list, constraint_threshold_area, num_constraints)
-    # Mask NoData Value
-    zone_id_ras_data = np.loadtxt(zone_id_ras, skiprows=6)
-    output_constraint_layer = mask_nodatavalue(output_constraint_layer, zone_id_ras_data, header_values)
-    # Write Binary Constraint Layer to File
-    write_raster_to_file(output_constraint_layer, constraint_ras, header_text)
-    
-    # Create Current Development Layer
-    current_dev_layer = create_current_development_layer(constraint_layers, current_development_flag_list, layer_threshold_area_list, zone_id_ras_data, header_values, num_constraints)
-    # Write Current Development Layer to File
-    write_raster_to_file(current_dev_layer, current_dev_ras, header_text)
+    # Generate the Binary Constraint Layer and the Current Development Layer, one constraint layer at a time as they load
+    zone_id_ras_data = rio.read_raster(zone_id_ras)
+    if threshold_cache is not None:
+        thresholds = ct.load_critical_thresholds(threshold_cache, path_to_data, constraints_tbl, layer_name_list, current_development_flag_list,
+                                                 layer_threshold_area_list, zone_id_ras_data.shape, layer_reader)
+        output_constraint_layer, current_dev_layer = ct.constraint_layers(thresholds, constraint_threshold_area)
+    else:
+        output_constraint_layer, current_dev_layer = accumulate_constraint_layers(path_to_data, layer_name_list, current_development_flag_list,
+                                                                                  layer_threshold_area_list, constraint_threshold_area, zone_id_ras_data.shape,
+                                                                                  layer_reader)
+    # Pack the boolean layers with the NoData cells of the zone identity raster
+    nodata = zone_id_ras_data == header_values[-1]
+    constraint_mask = PackedMask.from_bool(output_constraint_layer, nodata)
+    current_dev_mask = PackedMask.from_bool(current_dev_layer, nodata)
+    del output_constraint_layer, current_dev_layer, zone_id_ras_data, nodata
+    # Write Binary Constraint Layer and Current Development Layer to File, from the masks in the smallest dtype holding NODATA
+    write_raster_to_file(constraint_mask.to_array(header_values[-1], state_dtype(header_values[-1])), constraint_ras, header_text)
+    write_raster_to_file(current_dev_mask.to_array(header_values[-1], state_dtype(header_values[-1])), current_dev_ras, header_text)
+    if write_packed_masks:
+        constraint_mask.save(packed_mask_path(constraint_ras), header_values)
+        current_dev_mask.save(packed_mask_path(current_dev_ras), header_values)
+    return constraint_mask, current_dev_mask
 
-# Function read_constraint_layers: Read constraint layers
-# Raises ValueError if any constraint layer does not have the same dimensions as zone_id_ras
-def read_constraint_layers(constraints_tbl, path_to_data, num_constraints):
-    layer_name_list, current_development_flag_list, layer_threshold_list = pd.read_csv(constraints_tbl, usecols=[0, 1, 2]).values.T
-    constraint_layers = [np.loadtxt(os.path.join(path_to_data, layer_name_list[i]), skiprows=6) for i in range(num_constraints)]
-    # Check if all constraint layers have the same dimensions as zone_id_ras
-    zone_id_ras_shape = constraint_layers[0].shape
-    for layer in constraint_layers:
+# Function accumulate_constraint_layers: Build the binary constraint layer and the current development layer from the
+# constraint layers while they are read concurrently (RasterIO.iter_rasters), so each layer is folded in as soon as it is
+# parsed and only a few layers are held in memory at once.
+# A cell is constrained if any layer exceeds its threshold area or the sum of all layers exceeds constraint_threshold_area;
+# it is currently developed if a layer flagged as current development exceeds its threshold area. Both layers are boolean
+# (True = developable, True = developed).
+# Raises ValueError if any constraint layer does not have the same dimensions as the zone identity raster
+def accumulate_constraint_layers(path_to_data, layer_name_list, current_development_flag_list, layer_threshold_area_list,
+                                 constraint_threshold_area, zone_id_ras_shape, layer_reader=None):
+    summed_value_all_layers = np.zeros(zone_id_ras_shape)
+    output_constraint_layer = np.ones(zone_id_ras_shape, dtype=bool)
+    current_dev_layer = np.zeros(zone_id_ras_shape, dtype=bool)
+    layer_paths = [os.path.join(path_to_data, layer_name) for layer_name in layer_name_list]
+    for i, layer in enumerate(read_constraint_layers(layer_paths, zone_id_ras_shape, layer_reader)):
         if layer.shape != zone_id_ras_shape:
-            raise ValueError(f"{layer_name_list[constraint_layers.index(layer)]} does not have the same dimension as zone identity raster")
-    return current_development_flag_list, layer_threshold_list, constraint_layers
+            raise ValueError(f"{layer_name_list[i]} does not have the same dimension as zone identity raster")
+        summed_value_all_layers += layer
+        over_threshold = layer > layer_threshold_area_list[i]
+        output_constraint_layer[over_threshold] = False
+        if current_development_flag_list[i] == 1:
+            current_dev_layer[over_threshold] = True
+    output_constraint_layer[summed_value_all_layers > constraint_threshold_area] = False
+    return output_constraint_layer, current_dev_layer
+
+# Function read_constraint_layers: Iterator over the constraint layers, read concurrently with layer_reader (RasterIO.read_raster
+# by default) and budgeted at the size of the zone identity raster
+def read_constraint_layers(layer_paths, zone_id_ras_shape, layer_reader=None):
+    if layer_reader is None:
+        return rio.iter_rasters(layer_paths)
+    return rio.iter_rasters(layer_paths, reader=layer_reader, nbytes=[int(np.prod(zone_id_ras_shape)) * 8] * len(layer_paths))
 
 def calculate_threshold_areas(header_values, coverage_threshold, layer_threshold_list, num_constraints):
     constraint_threshold_area = (coverage_threshold / 100) * (header_values[4] ** 2)
     layer_threshold_area_list = [layer_threshold_list[i] / 100 * header_values[4] ** 2 for i in range(num_constraints)]
     return constraint_threshold_area, layer_threshold_area_list
 
-def generate_binary_constraint_layer(constraint_layers, layer_threshold_area_list, constraint_threshold_area, num_constraints):
-    summed_value_all_layers = sum(constraint_layers)
-    output_constraint_layer = np.ones(summed_value_all_layers.shape)
-    for i in range(num_constraints):
-        output_constraint_layer[constraint_layers[i] > layer_threshold_area_list[i]] = 0
-    output_constraint_layer[summed_value_all_layers > constraint_threshold_area] = 0
-    return output_constraint_layer
-
+# Function write_raster_to_file: Write a raster with the fast writer of RasterIO (in the background inside a
+# RasterIO.background_writer block)
 def write_raster_to_file(raster, file_path, header_text, fmt='%d'):
-    with open(file_path, 'w') as f:
-        f.write(''.join(header_text))
-        np.savetxt(f, raster, fmt=fmt)
+    rio.write_raster(raster, file_path, header_text, fmt)
 
-def create_current_development_layer(constraint_layers, current_development_flag_list, layer_threshold_area_list, zone_id_ras, header_values, num_constraints):
-    current_dev_layer = np.zeros(constraint_layers[0].shape)
-    for i in range(num_constraints):
-        if current_development_flag_list[i] == 1:
-            current_dev_layer[constraint_layers[i] > layer_threshold_area_list[i]] = 1
-    current_dev_layer[zone_id_ras == header_values[-1]] = header_values[-1]
-    return current_dev_layer
+# Function header_lines: Raster header lines for the header values [ncols, nrows, xllcorner, yllcorner, cellsize, nodatavalue]
+def header_lines(header_values):
+    ncols, nrows, xllcorner, yllcorner, cellsize, nodatavalue = header_values
+    return [f'ncols {int(ncols)}\n', f'nrows {int(nrows)}\n', f'xllcorner {header_number(xllcorner)}\n',
+            f'yllcorner {header_number(yllcorner)}\n', f'cellsize {header_number(cellsize)}\n', f'NODATA_value {header_number(nodatavalue)}\n']
+
+# Function header_number: Text of a header value that reads back as the same float - the shortest round-trip repr, without
+# the '.0' of whole numbers (240000, -9999, 0.5, 654321.123456789)
+def header_number(value):
+    text = repr(float(value))
+    return text[:-2] if text.endswith('.0') else text
+
+# Function state_dtype: Smallest signed integer dtype holding the cell states of a development raster (0, 1) and its NODATA value,
+# used to keep development rasters compact (checkpoint, result store); float64 when the NODATA value is not an integer
+def state_dtype(nodata_value):
+    for dtype in (np.int8, np.int16, np.int32):
+        if float(nodata_value).is_integer() and np.iinfo(dtype).min <= nodata_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.float64
 
 def mask_nodatavalue(ras,mask_layer,header_values):
     ras[mask_layer == header_values[-1]] = header_values[-1]
-    return ras
\ No newline at end of file
+    return ras
+
+# Function file_fingerprint: Cheap fingerprint of a file (size and modification time) used as a cache key
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
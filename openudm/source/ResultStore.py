@@ -0,0 +1,277 @@
+import os
+import json
+import zlib
+import numpy as np
+import pandas as pd
+import source.RasterToolkit as rt
+
+############################################################################################################
+# Multi-scenario result store - chunked, compressed arrays in the Zarr (version 2) directory layout
+# Each run appends one scenario:
+#   rasters/<name>           - array (scenario, row, column), chunked (1, CHUNK_ROWS, CHUNK_COLS), zlib-compressed
+#   zone_diagnostic/<column> - one 1-D array per column of the zone diagnostic table, plus a 'scenario' column
+#   .zattrs                  - list of scenarios with their names and parameters
+# The layout is plain JSON metadata and zlib chunk files, so the store can be opened by zarr/xarray, but it is
+# read and written here with NumPy only. Queries read only the chunks of the windows they ask for.
+############################################################################################################
+
+CHUNK_ROWS = 512
+CHUNK_COLS = 512
+TABLE_CHUNK = 65536
+COMPRESSION_LEVEL = 5
+
+
+def _write_json(file_path, value):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=1, default=_json_default)
+    os.replace(tmp_path, file_path)
+
+def _read_json(file_path, default=None):
+    if not os.path.exists(file_path):
+        return default
+    with open(file_path) as f:
+        return json.load(f)
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serialisable")
+
+
+class ChunkedArray:
+    # One array of the store in a directory: .zarray metadata and one zlib-compressed file per chunk,
+    # named by chunk indices joined with '.'
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_json(os.path.join(path, '.zarray'))
+
+    @classmethod
+    def create(cls, path, shape, chunks, dtype, fill_value, attrs=None):
+        os.makedirs(path, exist_ok=True)
+        _write_json(os.path.join(path, '.zarray'), {
+            'zarr_format': 2, 'shape': list(shape), 'chunks': list(chunks), 'dtype': np.dtype(dtype).str,
+            'compressor': {'id': 'zlib', 'level': COMPRESSION_LEVEL}, 'fill_value': fill_value,
+            'order': 'C', 'filters': None, 'dimension_separator': '.'})
+        if attrs is not None:
+            _write_json(os.path.join(path, '.zattrs'), attrs)
+        return cls(path)
+
+    @property
+    def shape(self):
+        return tuple(self.meta['shape'])
+
+    @property
+    def chunks(self):
+        return tuple(self.meta['chunks'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta['dtype'])
+
+    def resize(self, shape):
+        self.meta['shape'] = list(shape)
+        _write_json(os.path.join(self.path, '.zarray'), self.meta)
+
+    def _chunk_path(self, index):
+        return os.path.join(self.path, '.'.join(str(i) for i in index))
+
+    def read_chunk(self, index):
+        chunk_path = self._chunk_path(index)
+        if not os.path.exists(chunk_path):
+            fill = self.meta['fill_value']
+            return np.full(self.chunks, fill if fill is not None else 0, dtype=self.dtype)
+        with open(chunk_path, 'rb') as f:
+            return np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(self.chunks)
+
+    def write_chunk(self, index, chunk):
+        tmp_path = self._chunk_path(index) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(chunk, dtype=self.dtype).tobytes(), COMPRESSION_LEVEL))
+        os.replace(tmp_path, self._chunk_path(index))
+
+    # Method write: write values at the position start (one index per dimension); chunks only partly covered by values
+    # are read first so their other values are kept
+    def write(self, start, values):
+        values = np.asarray(values)
+        first = [s // c for s, c in zip(start, self.chunks)]
+        last = [(s + n - 1) // c for s, n, c in zip(start, values.shape, self.chunks)]
+        for index in np.ndindex(*[l - f + 1 for f, l in zip(first, last)]):
+            index = tuple(f + i for f, i in zip(first, index))
+            chunk_start = [i * c for i, c in zip(index, self.chunks)]
+            lo = [max(s, cs) for s, cs in zip(start, chunk_start)]
+            hi = [min(s + n, cs + c) for s, n, cs, c in zip(start, values.shape, chunk_start, self.chunks)]
+            covered = all(l == cs and h == cs + c for l, h, cs, c in zip(lo, hi, chunk_start, self.chunks))
+            chunk = np.empty(self.chunks, dtype=self.dtype) if covered else self.read_chunk(index).copy()
+            chunk[tuple(slice(l - cs, h - cs) for l, h, cs in zip(lo, hi, chunk_start))] = \
+                values[tuple(slice(l - s, h - s) for l, h, s in zip(lo, hi, start))]
+            self.write_chunk(index, chunk)
+
+    # Method read: values of the region given by one slice per dimension (steps of 1), reading only its chunks
+    def read(self, region=None):
+        region = region or tuple(slice(None) for _ in self.shape)
+        bounds = [s.indices(n)[:2] for s, n in zip(region, self.shape)]
+        result = np.empty([hi - lo for lo, hi in bounds], dtype=self.dtype)
+        if result.size == 0:
+            return result
+        first = [lo // c for (lo, _), c in zip(bounds, self.chunks)]
+        last = [(hi - 1) // c for (_, hi), c in zip(bounds, self.chunks)]
+        for index in np.ndindex(*[l - f + 1 for f, l in zip(first, last)]):
+            index = tuple(f + i for f, i in zip(first, index))
+            chunk_start = [i * c for i, c in zip(index, self.chunks)]
+            lo = [max(b[0], cs) for b, cs in zip(bounds, chunk_start)]
+            hi = [min(b[1], cs + c) for b, cs, c in zip(bounds, chunk_start, self.chunks)]
+            result[tuple(slice(l - b[0], h - b[0]) for l, h, b in zip(lo, hi, bounds))] = \
+                self.read_chunk(index)[tuple(slice(l - cs, h - cs) for l, h, cs in zip(lo, hi, chunk_start))]
+        return result
+
+
+class ResultStore:
+    # path: store directory, created when missing
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, 'rasters'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'zone_diagnostic'), exist_ok=True)
+        for group in ['', 'rasters', 'zone_diagnostic']:
+            if not os.path.exists(os.path.join(path, group, '.zgroup')):
+                _write_json(os.path.join(path, group, '.zgroup'), {'zarr_format': 2})
+
+    @property
+    def scenarios(self):
+        return _read_json(os.path.join(self.path, '.zattrs'), {}).get('scenarios', [])
+
+    @property
+    def num_scenarios(self):
+        return len(self.scenarios)
+
+    def scenario_index(self, name):
+        names = [scenario['name'] for scenario in self.scenarios]
+        if name not in names:
+            raise KeyError(f"Scenario {name} is not in the result store {self.path}")
+        return names.index(name)
+
+    # Method append_scenario: add a scenario - rasters is a dictionary name -> 2D array, header_values the raster header,
+    # parameters a dictionary stored as the scenario's attributes, zone_diagnostic an optional DataFrame.
+    # The scenario list is updated last, so an interrupted append leaves the store at its previous scenarios.
+    def append_scenario(self, name, rasters, header_values, parameters=None, zone_diagnostic=None):
+        scenarios = self.scenarios
+        if name in [scenario['name'] for scenario in scenarios]:
+            raise ValueError(f"Scenario {name} is already in the result store {self.path}")
+        index = len(scenarios)
+        for raster_name, raster in rasters.items():
+            self._append_raster(raster_name, np.asarray(raster), index, header_values)
+        if zone_diagnostic is not None:
+            self._append_table(zone_diagnostic, index)
+        scenarios.append({'name': name, 'parameters': dict(parameters or {})})
+        _write_json(os.path.join(self.path, '.zattrs'), {'scenarios': scenarios})
+        return index
+
+    def _append_raster(self, raster_name, raster, index, header_values):
+        array_path = os.path.join(self.path, 'rasters', raster_name)
+        if os.path.exists(os.path.join(array_path, '.zarray')):
+            array = ChunkedArray(array_path)
+            if array.shape[1:] != raster.shape:
+                raise ValueError(f"Raster {raster_name} has shape {raster.shape}, the store holds {array.shape[1:]}")
+            if not np.array_equal(raster.astype(array.dtype), raster):
+                # Values the array's dtype cannot hold (e.g. a NODATA value of -9999 in int8): rewrite it with a wider dtype
+                existing = array.read()
+                wider = ChunkedArray.create(array_path + '.tmp', existing.shape, array.chunks, np.promote_types(array.dtype, raster.dtype),
+                                            array.meta['fill_value'], _read_json(os.path.join(array_path, '.zattrs')))
+                wider.write((0, 0, 0), existing)
+                array = self._replace_array(array_path, wider)
+        else:
+            with np.errstate(invalid='ignore'):
+                fill_value = np.asarray(header_values[-1]).astype(raster.dtype)[()]
+            if fill_value != header_values[-1]:
+                raise ValueError(f"Raster {raster_name} of dtype {raster.dtype} cannot hold its NODATA value {header_values[-1]}")
+            attrs = {'_ARRAY_DIMENSIONS': ['scenario', 'y', 'x'], 'header_values': list(header_values)}
+            array = ChunkedArray.create(array_path, (0,) + raster.shape, (1, CHUNK_ROWS, CHUNK_COLS), raster.dtype,
+                                        _json_default(fill_value), attrs)
+        array.write((index, 0, 0), raster[None])
+        array.resize((max(array.shape[0], index + 1),) + raster.shape)
+
+    def _append_table(self, table, index):
+        table = table.assign(scenario=index)
+        num_rows = self._table_rows()
+        for column in table.columns:
+            values = table[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            array_path = os.path.join(self.path, 'zone_diagnostic', column)
+            if not os.path.exists(os.path.join(array_path, '.zarray')):
+                fill = '' if values.dtype.kind == 'U' else 0
+                array = ChunkedArray.create(array_path, (num_rows,), (TABLE_CHUNK,), values.dtype, fill)
+            else:
+                array = ChunkedArray(array_path)
+                if values.dtype.kind == 'U' and values.dtype.itemsize > array.dtype.itemsize:
+                    # Wider strings than the column holds: rewrite the column with the wider type
+                    existing = array.read().astype(values.dtype)
+                    array = ChunkedArray.create(array_path + '.tmp', existing.shape, (TABLE_CHUNK,), values.dtype, '')
+                    array.write((0,), existing)
+                    array = self._replace_array(array_path, array)
+            array.write((num_rows,), values.astype(array.dtype))
+            array.resize((num_rows + len(values),))
+
+    def _replace_array(self, array_path, new_array):
+        old_path = array_path + '.old'
+        os.replace(array_path, old_path)
+        os.replace(new_array.path, array_path)
+        for file_name in os.listdir(old_path):
+            os.remove(os.path.join(old_path, file_name))
+        os.rmdir(old_path)
+        return ChunkedArray(array_path)
+
+    def _table_rows(self):
+        scenario_path = os.path.join(self.path, 'zone_diagnostic', 'scenario')
+        return ChunkedArray(scenario_path).shape[0] if os.path.exists(os.path.join(scenario_path, '.zarray')) else 0
+
+    # Method raster: the raster array of a result (all scenarios), e.g. store.raster('cell_dev').read((slice(0, 10), ...))
+    def raster(self, raster_name):
+        return ChunkedArray(os.path.join(self.path, 'rasters', raster_name))
+
+    # Method read_raster: one scenario's raster (by index or name), or a window of it given as (row slice, column slice)
+    def read_raster(self, raster_name, scenario, window=None):
+        index = scenario if isinstance(scenario, (int, np.integer)) else self.scenario_index(scenario)
+        window = window or (slice(None), slice(None))
+        return self.raster(raster_name).read((slice(index, index + 1),) + tuple(window))[0]
+
+    # Method read_table: the zone diagnostic table of all scenarios (or of the given scenario indices)
+    def read_table(self, scenarios=None):
+        table_path = os.path.join(self.path, 'zone_diagnostic')
+        columns = [name for name in os.listdir(table_path) if os.path.exists(os.path.join(table_path, name, '.zarray'))]
+        num_rows = self._table_rows()
+        table = pd.DataFrame({column: ChunkedArray(os.path.join(table_path, column)).read((slice(0, num_rows),)) for column in sorted(columns)})
+        if scenarios is not None:
+            table = table[table['scenario'].isin(scenarios)]
+        return table
+
+    # Method frequency: fraction of scenarios in which each cell of a window equals value, e.g. frequency('cell_dev')
+    # for how often each cell is developed; computed one chunk row at a time. NoData cells are NaN.
+    def frequency(self, raster_name='cell_dev', value=1, window=None, scenarios=None):
+        array = self.raster(raster_name)
+        nodata = array.meta['fill_value']
+        rows, cols = [s.indices(n)[:2] for s, n in zip(window or (slice(None), slice(None)), array.shape[1:])]
+        indices = list(range(array.shape[0])) if scenarios is None else list(scenarios)
+        result = np.empty((rows[1] - rows[0], cols[1] - cols[0]))
+        for start in range(rows[0], rows[1], array.chunks[1]):
+            stop = min(start + array.chunks[1], rows[1])
+            counts = np.zeros((stop - start, cols[1] - cols[0]))
+            valid = np.zeros(counts.shape, dtype=bool)
+            for index in indices:
+                block = array.read((slice(index, index + 1), slice(start, stop), slice(*cols)))[0]
+                counts += block == value
+                valid |= block != nodata
+            result[start - rows[0]:stop - rows[0]] = np.where(valid, counts / max(len(indices), 1), np.nan)
+        return result
+
+
+# Function store_scenario: Append the outputs of a model run to the result store at store_path - the new development
+# (in the smallest integer dtype holding its NODATA value, see RasterToolkit.state_dtype) and cell suitability (float32)
+# rasters, the zone diagnostic table and the run parameters.
+# scenario defaults to 'scenario_<n>'. Returns the scenario index.
+def store_scenario(store_path, scenario, new_development, cell_suit, header_values, parameters, zone_diagnostic_tbl=None):
+    store = ResultStore(store_path)
+    scenario = scenario or f'scenario_{store.num_scenarios}'
+    zone_diagnostic = pd.read_csv(zone_diagnostic_tbl) if zone_diagnostic_tbl and os.path.exists(zone_diagnostic_tbl) else None
+    rasters = {'cell_dev': np.asarray(new_development).astype(rt.state_dtype(header_values[-1])), 'cell_suit': np.asarray(cell_suit).astype(np.float32)}
+    return store.append_scenario(scenario, rasters, header_values, parameters, zone_diagnostic)
@@ -0,0 +1,146 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+############################################################################################################
+# Shared-memory raster pool for multi-process runs
+# The parent process publishes each raster once into a named shared memory block; workers attach to the
+# blocks through picklable descriptors and get zero-copy read-only NumPy views, so memory use does not grow
+# with the number of workers. Blocks are reference counted and unlinked when the last reference is released.
+# CellularModel.development_rank_raster ranks the zones on a pool of workers sharing the model rasters this way.
+############################################################################################################
+
+# Rasters used by the cellular model, keyed as in main.generate_raster_filepaths, with their shared dtypes - integer rasters
+# as int32, which holds their NODATA value (e.g. -9999)
+MODEL_RASTER_DTYPES = {
+    'zone_id_ras': np.int32,
+    'dev_patch_id_ras': np.int32,
+    'dev_patch_suit_ras': np.float64,
+    'cell_suit_ras': np.float64,
+    'current_dev_ras': np.int32,
+}
+
+# Shared memory handles attached in this process: block name -> [SharedMemory, reference count]
+_attached_blocks = {}
+
+
+class SharedRasterPool:
+    # The pool owns the shared memory blocks: key -> [SharedMemory, shape, dtype, reference count]
+    def __init__(self):
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    # Method publish: copy an array into a new shared memory block once; the pool holds the first reference
+    # Raises ValueError if the array does not convert to dtype exactly (e.g. a NODATA value out of its range)
+    def publish(self, key, array, dtype=None):
+        if key in self._blocks:
+            raise ValueError(f"Raster {key} is already published")
+        converted = np.ascontiguousarray(array, dtype=dtype)
+        if dtype is not None and not np.array_equal(converted, array):
+            raise ValueError(f"Raster {key} does not convert to {np.dtype(dtype).name} without loss")
+        array = converted
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        self._blocks[key] = [shm, array.shape, array.dtype.str, 1]
+        return self.descriptor(key)
+
+    # Method descriptor: picklable description of a published block, passed to workers instead of the array
+    def descriptor(self, key):
+        shm, shape, dtype, _ = self._blocks[key]
+        return {'key': key, 'name': shm.name, 'shape': shape, 'dtype': dtype}
+
+    def descriptors(self):
+        return {key: self.descriptor(key) for key in self._blocks}
+
+    # Method acquire: take an extra reference on a block, e.g. one per scenario or ensemble member sharing it
+    def acquire(self, key):
+        self._blocks[key][3] += 1
+        return self.descriptor(key)
+
+    # Method release: drop a reference; the block is unlinked once nothing refers to it anymore
+    def release(self, key):
+        block = self._blocks[key]
+        block[3] -= 1
+        if block[3] <= 0:
+            _close_and_unlink(block[0])
+            del self._blocks[key]
+
+    # Method view: read-only view of a published block in the owning process
+    def view(self, key):
+        shm, shape, dtype, _ = self._blocks[key]
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        view.flags.writeable = False
+        return view
+
+    # Method close: unlink every block regardless of outstanding references
+    def close(self):
+        for shm, _, _, _ in self._blocks.values():
+            _close_and_unlink(shm)
+        self._blocks.clear()
+
+
+# Helper function: unlink a block even if views on it are still alive in this process; the memory is then
+# freed by the operating system once the last mapping goes away
+def _close_and_unlink(shm):
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    shm.unlink()
+
+
+# Function publish_model_rasters: publish the cellular model rasters (arrays keyed as in MODEL_RASTER_DTYPES)
+# and return the descriptors to hand to the workers
+def publish_model_rasters(pool, rasters):
+    return {key: pool.publish(key, rasters[key], MODEL_RASTER_DTYPES.get(key)) for key in rasters}
+
+
+# Function attach_raster: attach to a published block in a worker and return a zero-copy read-only view
+# Attachments are counted per process so that several views of the same block share one handle.
+def attach_raster(descriptor):
+    name = descriptor['name']
+    if name not in _attached_blocks:
+        # Only the owning pool unlinks the block. Before Python 3.13 attaching always registers the block with the worker's
+        # resource tracker, which would unlink it (or warn about a leak) when the worker exits, so it is unregistered again
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            if os.name == 'posix':
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        _attached_blocks[name] = [shm, 0]
+    block = _attached_blocks[name]
+    block[1] += 1
+    view = np.ndarray(descriptor['shape'], dtype=descriptor['dtype'], buffer=block[0].buf)
+    view.flags.writeable = False
+    return view
+
+
+# Function detach_raster: release a worker attachment; the handle is closed when the last view is released
+# The views returned by attach_raster must be dropped before their last detach.
+def detach_raster(descriptor):
+    name = descriptor['name']
+    block = _attached_blocks.get(name)
+    if block is None:
+        return
+    block[1] -= 1
+    if block[1] <= 0:
+        block[0].close()
+        del _attached_blocks[name]
+
+
+# Function attach_rasters / detach_rasters: convenience wrappers over a dictionary of descriptors
+def attach_rasters(descriptors):
+    return {key: attach_raster(descriptor) for key, descriptor in descriptors.items()}
+
+def detach_rasters(descriptors):
+    for descriptor in descriptors.values():
+        detach_raster(descriptor)
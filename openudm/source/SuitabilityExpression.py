@@ -0,0 +1,162 @@
+import os
+import re
+import ast
+import numpy as np
+
+############################################################################################################
+# Suitability expressions
+# The suitability_expression parameter (parameters.csv) replaces the normalised weighted sum of the standardised
+# attractor layers with an expression over them. Each attractor is named by its layer name without extension,
+# non-alphanumeric characters replaced by '_' (development_proximity_100m.asc is development_proximity_100m), and
+# its weight is the layer_weight of attractors.csv. Expressions combine numbers, attractors, + - * / **,
+# comparisons (1 where true, 0 otherwise), and/or/not, and the functions:
+#   wsum(a, ...)       - weighted sum, weights normalised over the attractors given (all attractors when none are)
+#   wprod(a, ...)      - weighted product, the product of each attractor to the power of its normalised weight
+#   owa(v1, v2, ...)   - ordered weighted average of all attractors: at each cell the attractors are ranked from
+#                        the highest value down, and the attractor of rank j is weighted by its weight times the
+#                        order weight vj (normalised at each cell); equal order weights give wsum()
+#   cap(x, high)       - x capped at high
+#   threshold(x, t)    - x where x is at least t, 0 elsewhere
+#   clip(x, low, high), min(x, y, ...), max(x, y, ...), where(condition, x, y), abs(x), sqrt(x)
+# e.g. 'wsum()', '0.7 * wprod() + 0.3 * cap(development_proximity_100m, 0.8)' or 'owa(0.5, 0.3, 0.2)'.
+# The expression is parsed once into a tree of NumPy operations and evaluated a block of rows at a time, so every
+# intermediate is the size of a block rather than of the grid, and a block only needs the rows of the attractors
+# the expression uses - the layers can be streamed from file tile by tile.
+############################################################################################################
+
+# Python operators of the expression language
+_BINARY_OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide, ast.Pow: np.power}
+_COMPARISONS = {ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Eq: np.equal, ast.NotEq: np.not_equal}
+
+# Functions of the expression language taking expressions as arguments, with their numbers of arguments (None: any, at least one)
+_FUNCTIONS = {
+    'cap': (2, lambda x, high: np.minimum(x, high)),
+    'threshold': (2, lambda x, t: np.where(x >= t, x, 0.0)),
+    'clip': (3, lambda x, low, high: np.minimum(np.maximum(x, low), high)),
+    'min': (None, lambda *args: _reduce(np.minimum, args)),
+    'max': (None, lambda *args: _reduce(np.maximum, args)),
+    'where': (3, lambda condition, x, y: np.where(condition != 0, x, y)),
+    'abs': (1, np.abs),
+    'sqrt': (1, np.sqrt),
+}
+
+# Functions of the expression language over attractors (named, or all attractors when none are)
+_AGGREGATES = ['wsum', 'wprod']
+
+
+def _reduce(function, args):
+    result = args[0]
+    for arg in args[1:]:
+        result = function(result, arg)
+    return result
+
+# Function layer_alias: Name of an attractor layer in expressions - its layer name without extension, with the characters
+# other than letters, digits and '_' replaced by '_' (and '_' before a leading digit)
+def layer_alias(layer_name):
+    alias = re.sub(r'\W', '_', os.path.splitext(os.path.basename(layer_name))[0])
+    return '_' + alias if alias[:1].isdigit() else alias
+
+
+class SuitabilityExpression:
+    # A suitability expression compiled against the attractors (layer names and weights of attractors.csv).
+    # layers: aliases of the attractors the expression uses, in table order; evaluate(blocks) evaluates it on a block of
+    # rows given as a dictionary of alias to the block of that attractor.
+    def __init__(self, expression, layer_names, weights):
+        self.expression = expression
+        self.aliases = [layer_alias(name) for name in layer_names]
+        self.weights = dict(zip(self.aliases, np.asarray(weights, dtype=np.float64)))
+        self._used = set()
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as err:
+            raise ValueError(f"suitability_expression '{expression}' is not a valid expression: {err.msg}")
+        self._evaluate = self._compile(tree.body)
+        self.layers = [alias for alias in self.aliases if alias in self._used]
+
+    # Method evaluate: value of the expression on a block (dictionary of alias to block array)
+    def evaluate(self, blocks):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.asarray(self._evaluate(blocks), dtype=np.float64)
+
+    def _error(self, message):
+        return ValueError(f"suitability_expression '{self.expression}': {message}")
+
+    def _attractor(self, name):
+        if name not in self.weights:
+            raise self._error(f"unknown attractor {name}; attractors are {', '.join(self.aliases)}")
+        self._used.add(name)
+        return name
+
+    # Method _compile: function of the blocks evaluating an expression node
+    def _compile(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            value = float(node.value)
+            return lambda blocks: value
+        if isinstance(node, ast.Name):
+            name = self._attractor(node.id)
+            return lambda blocks: blocks[name]
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            function, left, right = _BINARY_OPERATORS[type(node.op)], self._compile(node.left), self._compile(node.right)
+            return lambda blocks: function(left(blocks), right(blocks))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda blocks: np.negative(operand(blocks))
+            if isinstance(node.op, ast.Not):
+                return lambda blocks: np.equal(operand(blocks), 0).astype(np.float64)
+            return operand
+        if isinstance(node, ast.Compare) and all(type(op) in _COMPARISONS for op in node.ops):
+            operands = [self._compile(operand) for operand in [node.left] + node.comparators]
+            functions = [_COMPARISONS[type(op)] for op in node.ops]
+            def compare(blocks):
+                values = [operand(blocks) for operand in operands]
+                return _reduce(np.logical_and, [function(values[i], values[i + 1]) for i, function in enumerate(functions)]).astype(np.float64)
+            return compare
+        if isinstance(node, ast.BoolOp):
+            operands = [self._compile(operand) for operand in node.values]
+            function = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            return lambda blocks: _reduce(function, [np.not_equal(operand(blocks), 0) for operand in operands]).astype(np.float64)
+        if isinstance(node, ast.IfExp):
+            condition, body, orelse = self._compile(node.test), self._compile(node.body), self._compile(node.orelse)
+            return lambda blocks: np.where(condition(blocks) != 0, body(blocks), orelse(blocks))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            return self._compile_call(node.func.id, node.args)
+        raise self._error(f"unsupported element '{ast.unparse(node)}'")
+
+    def _compile_call(self, name, args):
+        if name in _AGGREGATES:
+            if not all(isinstance(arg, ast.Name) for arg in args):
+                raise self._error(f"{name} takes attractor names")
+            aliases = [self._attractor(arg.id) for arg in args] or [self._attractor(alias) for alias in self.aliases]
+            total_weight = sum(self.weights[alias] for alias in aliases)
+            weights = [(alias, self.weights[alias] / total_weight) for alias in aliases]
+            if name == 'wsum':
+                return lambda blocks: sum(blocks[alias] * weight for alias, weight in weights)
+            return lambda blocks: _reduce(np.multiply, [np.power(blocks[alias], weight) for alias, weight in weights])
+        if name == 'owa':
+            return self._compile_owa(args)
+        if name not in _FUNCTIONS:
+            raise self._error(f"unknown function {name}")
+        num_args, function = _FUNCTIONS[name]
+        if (num_args is None and not args) or (num_args is not None and len(args) != num_args):
+            raise self._error(f"{name} takes {num_args or 'at least 1'} arguments, got {len(args)}")
+        arguments = [self._compile(arg) for arg in args]
+        return lambda blocks: function(*[argument(blocks) for argument in arguments])
+
+    # Method _compile_owa: ordered weighted average of all attractors with the order weights args (numbers, one per attractor)
+    def _compile_owa(self, args):
+        if not all(isinstance(arg, ast.Constant) and isinstance(arg.value, (int, float)) for arg in args):
+            raise self._error("owa takes numbers (order weights)")
+        if len(args) != len(self.aliases):
+            raise self._error(f"owa takes one order weight per attractor ({len(self.aliases)}), got {len(args)}")
+        order_weights = np.array([float(arg.value) for arg in args])
+        aliases = [self._attractor(alias) for alias in self.aliases]
+        criterion_weights = np.array([self.weights[alias] for alias in aliases])
+        def owa(blocks):
+            values = np.stack([blocks[alias] for alias in aliases])
+            # Attractors ranked from the highest value down at each cell; rank j carries order weight j
+            order = np.argsort(-values, axis=0, kind='stable')
+            ranked_values = np.take_along_axis(values, order, axis=0)
+            ranked_weights = criterion_weights[order] * order_weights.reshape((-1,) + (1,) * (values.ndim - 1))
+            return (ranked_weights * ranked_values).sum(axis=0) / ranked_weights.sum(axis=0)
+        return owa
@@ -0,0 +1,210 @@
+import os
+import numpy as np
+import pandas as pd
+import source.RasterToolkit as rt
+
+############################################################################################################
+# Urban fabric generation - NumPy port of the UFG functions in the compiled RasterToolkit
+############################################################################################################
+
+# Building types in the order of the columns of types-vs-density.csv; the raster codes are 1..4
+BUILD_TYPES = ['detached', 'semi-detached', 'terraced', 'flats']
+# Tile table per building type
+TILE_TABLES = ['tiles-detached.csv', 'tiles-semi-detached.csv', 'tiles-terraced.csv', 'tiles-flats.csv']
+# Rasters of the coverage from density stage, written as out_cell_<name>.asc
+COVERAGE_OUTPUTS = ['density_band', 'build_type', 'tile_type', 'roads_cov', 'green_cov', 'build_cov']
+# Density band of cells without development, and the NODATA value of out_cell_density_band
+BAND_NODATA = -1
+# Urban fabric cells without development, and the NODATA value of the urban fabric raster (as in the tiles)
+FABRIC_NODATA = -1
+
+DEFAULT_TILES_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Tiles'))
+
+# Tile libraries already loaded in this process, keyed on the absolute tiles path
+_tile_libraries = {}
+
+
+############################################################################################################
+# Tile library
+############################################################################################################
+
+# Function load_tile_library: Load the tile tables, the density band table and the tile rasters once into arrays.
+# The library is a dictionary of arrays indexed by [building type - 1, tile]:
+#   tile_dph, build_cov, roads_cov, green_cov - tile dwellings per hectare and coverages (percentage * 100)
+#   tiles - tile rasters, shape (types, tiles, 2, scale, scale); orientation 0 is the tile, 1 the rotated tile
+# and by density band:
+#   band_dph - band lower bound, band_cards - cumulative number of cards per building type in the band deck
+def load_tile_library(tiles_path=None):
+    tiles_path = os.path.abspath(tiles_path or DEFAULT_TILES_PATH)
+    if tiles_path in _tile_libraries:
+        return _tile_libraries[tiles_path]
+
+    tile_tables = [pd.read_csv(os.path.join(tiles_path, table)) for table in TILE_TABLES]
+    library = {
+        'tile_dph': np.array([table['tile_dph'].values for table in tile_tables], dtype=np.int32),
+        'build_cov': np.array([table['pc_build'].values * 100 for table in tile_tables], dtype=np.int32),
+        'roads_cov': np.array([table['pc_roads'].values * 100 for table in tile_tables], dtype=np.int32),
+        'green_cov': np.array([table['pc_green'].values * 100 for table in tile_tables], dtype=np.int32),
+        'tiles': np.array([[[np.loadtxt(os.path.join(tiles_path, name), skiprows=6) for name in (row.tile_str, row.tile90_str)]
+                            for row in table.itertuples()] for table in tile_tables]).astype(np.int16),
+    }
+    library['tile_scale'] = library['tiles'].shape[-1]
+
+    types_vs_density = pd.read_csv(os.path.join(tiles_path, 'types-vs-density.csv'))
+    library['band_dph'] = types_vs_density['density'].values.astype(np.int32)
+    library['band_cards'] = np.cumsum(types_vs_density[BUILD_TYPES].values, axis=1).astype(np.int32)
+
+    _tile_libraries[tiles_path] = library
+    return library
+
+
+############################################################################################################
+# Coverage from density
+############################################################################################################
+
+# Function find_density_band: Band of each developed cell (dph > 0); the band width is the first band's dph and
+# densities beyond the last band fall in the last band. Cells without development are BAND_NODATA.
+def find_density_band(dph, library):
+    num_bands = len(library['band_dph'])
+    band = np.minimum(dph // library['band_dph'][0], num_bands - 1)
+    return np.where(dph > 0, band, BAND_NODATA).astype(np.int32)
+
+# Function draw_build_type: Draw a building type (1..4) per developed cell from its band's deck of cards,
+# i.e. with the band's building type proportions. Cells without development are 0.
+def draw_build_type(band, library, rng):
+    build_type = np.zeros(band.shape, dtype=np.int32)
+    developed = band >= 0
+    cards = library['band_cards'][band[developed]]
+    draw = rng.integers(0, cards[:, -1])
+    build_type[developed] = (draw[:, None] >= cards).sum(axis=1) + 1
+    return build_type
+
+# Function find_tile_type: For each building type in one vectorised batch, pick the tile with the nearest dph
+# (the first one on ties). Tile type codes are 10 * building type + tile number, e.g. 11..14 for detached.
+def find_tile_type(dph, build_type, library):
+    tile_type = np.zeros(dph.shape, dtype=np.int32)
+    for k in range(1, len(BUILD_TYPES) + 1):
+        cells = build_type == k
+        diff = np.abs(dph[cells][:, None] - library['tile_dph'][k - 1][None, :])
+        tile_type[cells] = 10 * k + np.argmin(diff, axis=1) + 1
+    return tile_type
+
+# Function tile_coverages: Road, green and build coverage of the tile type of each developed cell (build_type 1..4), 0 elsewhere,
+# in one lookup: [building type - 1, tile number - 1]
+def tile_coverages(build_type, tile_type, library):
+    developed = build_type > 0
+    type_idx = np.where(developed, build_type - 1, 0)
+    tile_idx = np.where(developed, tile_type % 10 - 1, 0)
+    return {key: np.where(developed, library[key][type_idx, tile_idx], 0) for key in ['roads_cov', 'green_cov', 'build_cov']}
+
+# Function coverage_from_density: Compute the density band, building type, tile type and the building, road and green
+# coverage rasters from a dwellings per hectare array held in memory. seed makes the building type draw repeatable.
+# As in the legacy UFGCoverageFromDensity, cells without development are -1 (BAND_NODATA) in the density band and 0 in
+# the other rasters; NODATA cells of the dph array are nodata_value in them.
+def coverage_from_density(dph_array, nodata_value, library, seed=None):
+    rng = np.random.default_rng(seed)
+    nodata = dph_array == nodata_value
+    dph = np.where(nodata, 0, dph_array).astype(np.int64)
+
+    band = find_density_band(dph, library)
+    build_type = draw_build_type(band, library, rng)
+    tile_type = find_tile_type(dph, build_type, library)
+    outputs = {'density_band': band, 'build_type': build_type, 'tile_type': tile_type}
+    outputs.update(tile_coverages(build_type, tile_type, library))
+
+    for key in COVERAGE_OUTPUTS[1:]:
+        outputs[key][nodata] = nodata_value
+    return outputs
+
+# Function coverage_file_paths: Paths of the coverage from density rasters (out_cell_<output>.asc) in path_to_output
+def coverage_file_paths(path_to_output):
+    return {key: os.path.join(path_to_output, 'out_cell_' + key + '.asc') for key in COVERAGE_OUTPUTS}
+
+# Function ufg_coverage_from_density: Coverage from density stage. dph is the out_cell_dph array held in memory, or a path to it;
+# header_values are those of the dph raster. Writes out_cell_density_band (NODATA_value BAND_NODATA), out_cell_build_type,
+# out_cell_tile_type, out_cell_roads_cov, out_cell_green_cov and out_cell_build_cov to path_to_output and returns the arrays.
+def ufg_coverage_from_density(dph, path_to_output, header_values, tiles_path=None, seed=None):
+    if isinstance(dph, str):
+        dph = np.loadtxt(dph, skiprows=6)
+    library = load_tile_library(tiles_path)
+    outputs = coverage_from_density(dph, header_values[-1], library, seed)
+    for key, file_path in coverage_file_paths(path_to_output).items():
+        nodata_value = BAND_NODATA if key == 'density_band' else header_values[-1]
+        rt.write_raster_to_file(outputs[key], file_path, rt.header_lines(list(header_values[:5]) + [nodata_value]))
+    return outputs
+
+
+############################################################################################################
+# Fabric from coverage
+############################################################################################################
+
+# Offset between building types in the tile index keys; larger than any coverage value, so the nearest key
+# to a cell's key is always a tile of the cell's own building type
+_TILE_INDEX_OFFSET = 1000000
+
+# Function build_tile_index: Sorted coverage-to-tile index over all tiles of the library. Keys combine the building type
+# and the tile build coverage; values are flat tile numbers into library['tiles'].reshape(-1, 2, scale, scale).
+def build_tile_index(library):
+    num_types, num_tiles = library['build_cov'].shape
+    keys = (np.arange(num_types)[:, None] * _TILE_INDEX_OFFSET + library['build_cov']).ravel()
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order.astype(np.int32)
+
+# Function match_tiles: Nearest-match tile lookup for all developed cells with one searchsorted over the index.
+# Ties between two tiles at the same distance go to the lower coverage tile, and between tiles of equal coverage to the
+# first tile of the table.
+def match_tiles(build_type, build_cov, tile_index):
+    keys, tiles = tile_index
+    cell_keys = (build_type - 1).astype(np.int64) * _TILE_INDEX_OFFSET + build_cov
+    right = np.clip(np.searchsorted(keys, cell_keys), 0, len(keys) - 1)
+    # The left neighbour is the first of the tiles sharing its key, as the right one is
+    left = np.searchsorted(keys, keys[np.maximum(right - 1, 0)])
+    use_left = np.abs(cell_keys - keys[left]) <= np.abs(keys[right] - cell_keys)
+    return tiles[np.where(use_left, left, right)]
+
+# Function scaled_header: Raster header lines of a grid scale times finer than the grid of header_values, with nodata_value
+def scaled_header(header_values, scale, nodata_value):
+    ncols, nrows, xllcorner, yllcorner, cellsize = header_values[:5]
+    return rt.header_lines([ncols * scale, nrows * scale, xllcorner, yllcorner, cellsize / scale, nodata_value])
+
+# Function fabric_from_coverage: Stamp a tile, randomly rotated or not, for every developed cell onto a grid
+# tile_scale times finer. Tiles are matched on building type and build coverage through the tile index, unless
+# a tile type raster (out_cell_tile_type) is given. Cells are stamped in batches of batch_size.
+def fabric_from_coverage(build_type, build_cov, nodata_value, library, tile_type=None, seed=None, batch_size=250000):
+    rng = np.random.default_rng(seed)
+    scale = library['tile_scale']
+    nrows, ncols = build_type.shape
+    tiles = library['tiles'].reshape(-1, 2, scale, scale)
+
+    developed = (build_type >= 1) & (build_type <= len(BUILD_TYPES))
+    rows, cols = np.nonzero(developed)
+    if tile_type is None:
+        tile_numbers = match_tiles(build_type[developed], build_cov[developed], build_tile_index(library))
+    else:
+        num_tiles = library['tile_dph'].shape[1]
+        tile_numbers = (tile_type[developed] // 10 - 1) * num_tiles + tile_type[developed] % 10 - 1
+    rotation = rng.integers(0, 2, size=len(rows))
+
+    fabric = np.full((nrows * scale, ncols * scale), nodata_value, dtype=np.int16)
+    # View of the fabric as (row, column, tile row, tile column) to stamp whole tiles by cell index
+    fabric_cells = fabric.reshape(nrows, scale, ncols, scale).transpose(0, 2, 1, 3)
+    for start in range(0, len(rows), batch_size):
+        batch = slice(start, start + batch_size)
+        fabric_cells[rows[batch], cols[batch]] = tiles[tile_numbers[batch], rotation[batch]]
+    return fabric
+
+# Function ufg_fabric_from_coverage: Fabric from coverage stage. build_type and build_cov are the out_cell_build_type and
+# out_cell_build_cov arrays (or paths to them); tile_type optionally the out_cell_tile_type array or path.
+# Writes the urban fabric raster to output_ras and returns it. As in the legacy UFGFabricFromCoverage, cells without
+# development are -1 (FABRIC_NODATA), which is also the NODATA_value written.
+def ufg_fabric_from_coverage(build_type, build_cov, output_ras, header_values, tile_type=None, tiles_path=None, seed=None):
+    build_type, build_cov, tile_type = [np.loadtxt(ras, skiprows=6) if isinstance(ras, str) else ras
+                                        for ras in (build_type, build_cov, tile_type)]
+    library = load_tile_library(tiles_path)
+    build_type = build_type.astype(np.int64)
+    build_cov = build_cov.astype(np.int64)
+    if tile_type is not None:
+        tile_type = tile_type.astype(np.int64)
+    fabric = fabric_from_coverage(build_type, build_cov, FABRIC_NODATA, library, tile_type, seed)
+    rt.write_raster_to_file(fabric, output_ras, scaled_header(header_values, library['tile_scale'], FABRIC_NODATA))
+    return fabric
@@ -0,0 +1,193 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import source.RasterIO as rio
+import source.RasterToolkit as rt
+import source.RasterCatalog as rc
+
+try:
+    import geopandas as gp
+    from rasterio.features import rasterize
+    from rasterio.transform import from_origin
+    from shapely.geometry import box
+except ImportError:
+    gp = None
+
+############################################################################################################
+# Vector inputs
+# Zones given as a vector file (GeoPackage, shapefile or any format geopandas reads) are rasterised onto the
+# grid of a reference raster with rasterio.features.rasterize - a cell takes the zone covering its centre - and
+# the zone codes of the features are mapped to the zone IDs of population.csv by its zone_code column. The zone
+# raster is written to the output directory with a key of the vector file, code field, grid and zone table, so
+# re-runs with the same inputs skip the rasterisation.
+# Constraint layers given as vector files are turned into coverage area rasters (the area of each cell covered by
+# the polygons): each cell is split into supersample x supersample subcells, the polygons are rasterised on the
+# subcells a tile of rows at a time, and the covered subcells of each cell are summed. Coverage rasters are cached
+# as .npy files in the output directory, keyed on the vector file, the grid and the supersampling, and read in
+# place of the layer by constraint_layer_reader, so they feed the constraint stage without an intermediate grid.
+# geopandas and rasterio are only needed when a vector input is used.
+############################################################################################################
+
+# Files of a shapefile besides the .shp, part of its fingerprint
+SHAPEFILE_PARTS = ['.shx', '.dbf', '.prj', '.cpg']
+
+
+def _require_vector_support():
+    if gp is None:
+        raise ImportError("Vector inputs need geopandas and rasterio (see requirements.txt)")
+
+# Function vector_fingerprint: Fingerprint of a vector file - with the other files of a shapefile
+def vector_fingerprint(vector_path):
+    file_paths = [vector_path]
+    if vector_path.lower().endswith('.shp'):
+        stem = vector_path[:-4]
+        file_paths += [stem + part for part in SHAPEFILE_PARTS if os.path.exists(stem + part)]
+    return '|'.join(f'{os.path.basename(file_path)}:{rt.file_fingerprint(file_path)}' for file_path in file_paths)
+
+# Function layer_fingerprint: Fingerprint of a layer file - a vector file or an ESRI ASCII grid
+def layer_fingerprint(file_path):
+    return vector_fingerprint(file_path) if is_vector_file(file_path) else rt.file_fingerprint(file_path)
+
+# Function is_vector_file: Whether a layer name refers to a vector file rather than an ESRI ASCII grid
+def is_vector_file(file_name):
+    return os.path.splitext(file_name)[1].lower() in ['.gpkg', '.shp', '.geojson', '.json', '.fgb', '.gml']
+
+# Function grid_transform: Affine transform of the grid of header_values (top-left origin, square cells)
+def grid_transform(header_values):
+    ncols, nrows, xllcorner, yllcorner, cellsize, _ = header_values
+    return from_origin(xllcorner, yllcorner + nrows * cellsize, cellsize, cellsize)
+
+# Function reference_header_values: Header values [ncols, nrows, xllcorner, yllcorner, cellsize, nodata] of a raster
+def reference_header_values(reference_path, nodata_value=None):
+    header = rc.read_header(reference_path)
+    return [header['ncols'], header['nrows'], header['xllcorner'], header['yllcorner'], header['cellsize'],
+            header['nodata_value'] if nodata_value is None else nodata_value]
+
+# Function cache_key: Key of a cached rasterisation - a hash of its description
+def cache_key(description):
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+# Function cache_valid: Whether the cache file at cache_path was written for key
+def cache_valid(cache_path, key):
+    key_path = cache_path + '.key'
+    if not (os.path.exists(cache_path) and os.path.exists(key_path)):
+        return False
+    with open(key_path) as f:
+        return f.read().strip() == key
+
+# Function write_cache_key: Record the key of a cache file, after the file itself is complete
+def write_cache_key(cache_path, key):
+    tmp_path = cache_path + '.key.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(key)
+    os.replace(tmp_path, cache_path + '.key')
+
+# Function write_npy_cache: Write an array to the .npy cache file at cache_path, then its key
+def write_npy_cache(cache_path, array, key):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, cache_path)
+    write_cache_key(cache_path, key)
+
+
+# Function zone_code_mapping: Mapping of zone code to zone ID from a zone table with zone_identity and zone_code columns
+def zone_code_mapping(zone_tbl):
+    zone_table = pd.read_csv(zone_tbl, usecols=[0, 1])
+    return dict(zip(zone_table.iloc[:, 1].astype(str), zone_table.iloc[:, 0]))
+
+# Function rasterise_zones: Zone ID raster of the zones of a vector file on the grid of header_values. Features whose code
+# is not in code_to_id are left as NoData; zones of the table without a feature are reported.
+def rasterise_zones(vector_path, code_field, code_to_id, header_values, layer=None):
+    _require_vector_support()
+    zones = gp.read_file(vector_path, layer=layer)
+    if code_field not in zones.columns:
+        raise ValueError(f"{vector_path} has no field {code_field}; fields are {', '.join(map(str, zones.columns))}")
+    codes = zones[code_field].astype(str)
+    unknown = sorted(set(codes) - set(code_to_id))
+    if unknown:
+        print(f"{len(unknown)} zone codes of {vector_path} are not in the zone table, left as NoData: {', '.join(unknown[:10])}")
+    missing = sorted(set(code_to_id) - set(codes))
+    if missing:
+        print(f"{len(missing)} zones of the zone table have no feature in {vector_path}: {', '.join(missing[:10])}")
+
+    shapes = [(geometry, code_to_id[code]) for geometry, code in zip(zones.geometry, codes)
+              if code in code_to_id and geometry is not None and not geometry.is_empty]
+    ncols, nrows = int(header_values[0]), int(header_values[1])
+    return rasterize(shapes, out_shape=(nrows, ncols), transform=grid_transform(header_values),
+                     fill=header_values[-1], dtype='float64')
+
+# Function zone_raster_from_vector: Path of the zone identity raster rasterised from a vector file into path_to_output,
+# on the grid of reference_path, with the zone codes in code_field mapped through zone_tbl. The raster is reused while the
+# vector file, code field, grid and zone table are unchanged.
+def zone_raster_from_vector(vector_path, code_field, reference_path, zone_tbl, path_to_output, layer=None, nodata_value=-1):
+    header_values = reference_header_values(reference_path, nodata_value)
+    zone_ras = os.path.join(path_to_output, 'zone_identity.asc')
+    key = cache_key({'vector': vector_fingerprint(vector_path), 'layer': layer, 'code_field': code_field,
+                     'grid': header_values, 'zone_table': rt.file_fingerprint(zone_tbl)})
+    if cache_valid(zone_ras, key):
+        print('Zone identity raster read from', zone_ras)
+        return zone_ras
+
+    zone_id_ras = rasterise_zones(vector_path, code_field, zone_code_mapping(zone_tbl), header_values, layer)
+    os.makedirs(path_to_output, exist_ok=True)
+    rio.write_raster_now(zone_id_ras, zone_ras, rt.header_lines(header_values), fmt='%d')
+    write_cache_key(zone_ras, key)
+    print(f"Zones of {vector_path} rasterised to {zone_ras}.")
+    return zone_ras
+
+
+# Subcells rasterised per tile (bounds the memory of a tile whatever the grid width and supersampling)
+TILE_SUBCELLS = 2 ** 25
+
+# Function coverage_area: Area of each cell of the grid of header_values covered by the polygons of a vector file,
+# from a supersample x supersample subcell rasterisation done a tile of rows at a time
+def coverage_area(vector_path, header_values, supersample=10, layer=None):
+    _require_vector_support()
+    polygons = gp.read_file(vector_path, layer=layer)
+    polygons = polygons[polygons.geometry.notna() & ~polygons.geometry.is_empty]
+    ncols, nrows, xllcorner, yllcorner, cellsize, _ = header_values
+    ncols, nrows = int(ncols), int(nrows)
+    subcell_size = cellsize / supersample
+    top = yllcorner + nrows * cellsize
+
+    coverage = np.zeros((nrows, ncols))
+    tile_rows = max(1, TILE_SUBCELLS // (ncols * supersample * supersample))
+    for row0 in range(0, nrows, tile_rows):
+        rows = min(tile_rows, nrows - row0)
+        tile_top = top - row0 * cellsize
+        # Only the polygons intersecting the tile are rasterised
+        candidates = polygons.geometry.iloc[polygons.sindex.query(box(xllcorner, tile_top - rows * cellsize, xllcorner + ncols * cellsize, tile_top))]
+        if len(candidates) == 0:
+            continue
+        subcells = rasterize(((geometry, 1) for geometry in candidates), out_shape=(rows * supersample, ncols * supersample),
+                             transform=from_origin(xllcorner, tile_top, subcell_size, subcell_size), fill=0, dtype='uint8')
+        counts = subcells.reshape(rows, supersample, ncols, supersample).sum(axis=(1, 3), dtype=np.int64)
+        coverage[row0:row0 + rows] = counts * subcell_size ** 2
+    return coverage
+
+# Function cached_coverage_area: coverage_area of a vector file, read from cache_dir when computed there for the same file,
+# grid and supersampling
+def cached_coverage_area(vector_path, header_values, cache_dir, supersample=10):
+    cache_path = os.path.join(cache_dir, os.path.basename(vector_path) + '.coverage.npy')
+    key = cache_key({'vector': vector_fingerprint(vector_path), 'grid': list(header_values[:5]), 'supersample': supersample})
+    if cache_valid(cache_path, key):
+        return np.load(cache_path)
+    coverage = coverage_area(vector_path, header_values, supersample)
+    write_npy_cache(cache_path, coverage, key)
+    print(f"Constraint layer {vector_path} rasterised to coverage area ({supersample}x{supersample} subcells).")
+    return coverage
+
+# Function constraint_layer_reader: Reader of constraint layers for RasterIO.iter_rasters - coverage areas of vector files
+# (cached in cache_dir) and ESRI ASCII grids read with raster_reader otherwise (e.g. GridAlignment.aligned_reader). Its key
+# attribute holds the settings that change the layers read.
+def constraint_layer_reader(header_values, cache_dir, supersample=10, raster_reader=rio.read_raster):
+    def read_layer(file_path):
+        if is_vector_file(file_path):
+            return cached_coverage_area(file_path, header_values, cache_dir, supersample)
+        return raster_reader(file_path)
+    read_layer.key = f'supersample={supersample}' + (f'|{raster_reader.key}' if hasattr(raster_reader, 'key') else '')
+    return read_layer
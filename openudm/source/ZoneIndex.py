@@ -0,0 +1,91 @@
+import os
+import numpy as np
+from scipy.ndimage import find_objects
+import source.RasterToolkit as rt
+
+############################################################################################################
+# Zone index: per-zone data computed once from the zone identity raster and cached next to the outputs
+#   zone_ids    - sorted zone IDs present in the raster
+#   cell_counts - number of cells of each zone
+#   adj_offsets, adj_zones, adj_lengths - zone adjacency graph in compressed rows: the neighbours of zone_ids[i]
+#                 are adj_zones[adj_offsets[i]:adj_offsets[i + 1]] (positions into zone_ids), sharing a boundary of
+#                 adj_lengths (map units) with it, longest boundary first
+#   bboxes      - bounding box of each zone as (row start, row stop, column start, column stop), so per-zone
+#                 operations can work on the zone's window of the grid instead of the whole grid
+############################################################################################################
+
+# Function zone_adjacency: Shared boundary lengths between zones from vectorised comparisons of the zone raster with
+# itself shifted by one column and by one row. Returns pairs (zone_a, zone_b) with zone_a < zone_b and their lengths.
+def zone_adjacency(zone_id_ras, nodata_value, cellsize):
+    pairs = []
+    for a, b in [(zone_id_ras[:, :-1], zone_id_ras[:, 1:]), (zone_id_ras[:-1, :], zone_id_ras[1:, :])]:
+        boundary = (a != b) & (a != nodata_value) & (b != nodata_value)
+        pairs.append(np.stack([np.minimum(a[boundary], b[boundary]), np.maximum(a[boundary], b[boundary])], axis=1))
+    pairs = np.concatenate(pairs).astype(np.int64)
+    unique_pairs, counts = np.unique(pairs, axis=0, return_counts=True)
+    return unique_pairs.reshape(-1, 2), counts * cellsize
+
+# Function build_zone_index: Build the zone index of a zone identity raster array
+def build_zone_index(zone_id_ras, nodata_value, cellsize):
+    zone_ids, cell_counts = np.unique(zone_id_ras[zone_id_ras != nodata_value], return_counts=True)
+    pairs, lengths = zone_adjacency(zone_id_ras, nodata_value, cellsize)
+
+    # Both directions of each edge, as positions into zone_ids, sorted by zone then longest boundary first
+    src = np.searchsorted(zone_ids, np.concatenate([pairs[:, 0], pairs[:, 1]]))
+    dst = np.searchsorted(zone_ids, np.concatenate([pairs[:, 1], pairs[:, 0]]))
+    lengths = np.concatenate([lengths, lengths])
+    order = np.lexsort((dst, -lengths, src))
+    adj_offsets = np.zeros(len(zone_ids) + 1, dtype=np.int64)
+    adj_offsets[1:] = np.cumsum(np.bincount(src, minlength=len(zone_ids)))
+    return {'zone_ids': zone_ids.astype(np.int64), 'cell_counts': cell_counts,
+            'adj_offsets': adj_offsets, 'adj_zones': dst[order], 'adj_lengths': lengths[order],
+            'bboxes': zone_bounding_boxes(zone_id_ras, nodata_value, zone_ids)}
+
+# Function zone_bounding_boxes: Bounding box (row start, row stop, column start, column stop) of each zone of zone_ids,
+# all found in one pass by scipy.ndimage.find_objects over the zones numbered 1..len(zone_ids)
+def zone_bounding_boxes(zone_id_ras, nodata_value, zone_ids):
+    labels = np.zeros(zone_id_ras.shape, dtype=np.int32)
+    valid = zone_id_ras != nodata_value
+    labels[valid] = np.searchsorted(zone_ids, zone_id_ras[valid]) + 1
+    objects = find_objects(labels, max_label=len(zone_ids))
+    return np.array([[rows.start, rows.stop, cols.start, cols.stop] for rows, cols in objects], dtype=np.int64).reshape(-1, 4)
+
+# Function load_zone_index: Zone index of the zone identity raster file, read from cache_path when it was built from the
+# same file (fingerprint match), otherwise built and saved there
+def load_zone_index(zone_id_ras_path, cache_path, nodata_value, cellsize, zone_id_ras=None):
+    fingerprint = rt.file_fingerprint(zone_id_ras_path)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            # Caches written before a key was added to the index are rebuilt
+            if str(cached['fingerprint']) == fingerprint and 'bboxes' in cached.files:
+                return {key: cached[key] for key in cached.files if key != 'fingerprint'}
+    if zone_id_ras is None:
+        zone_id_ras = np.loadtxt(zone_id_ras_path, skiprows=6)
+    zone_index = build_zone_index(zone_id_ras, nodata_value, cellsize)
+    np.savez(cache_path, fingerprint=fingerprint, **zone_index)
+    return zone_index
+
+# Function zone_neighbours: Neighbour positions and shared boundary lengths of the zone at position i in the index
+def zone_neighbours(zone_index, i):
+    start, end = zone_index['adj_offsets'][i], zone_index['adj_offsets'][i + 1]
+    return zone_index['adj_zones'][start:end], zone_index['adj_lengths'][start:end]
+
+# Function zone_windows: Window (row slice, column slice) of each zone of the zone index, keyed on zone ID.
+# Arrays indexed with a window are views, so results written to them go straight back to the full grid.
+def zone_windows(zone_index):
+    return {int(zone_id): (slice(int(r0), int(r1)), slice(int(c0), int(c1)))
+            for zone_id, (r0, r1, c0, c1) in zip(zone_index['zone_ids'], zone_index['bboxes'])}
+
+# Function raster_zone_windows: Windows of the zones of a zone identity raster array, without the rest of the index
+def raster_zone_windows(zone_id_ras, nodata_value):
+    zone_ids = np.unique(zone_id_ras[zone_id_ras != nodata_value])
+    return zone_windows({'zone_ids': zone_ids, 'bboxes': zone_bounding_boxes(zone_id_ras, nodata_value, zone_ids)})
+
+# Function zone_window: Window of one zone; an empty window for a zone without cells
+def zone_window(windows, zone_id):
+    return windows.get(int(zone_id), (slice(0, 0), slice(0, 0)))
+
+# Function window_cells: Flat indices in the full grid of the flat indices local to a window
+def window_cells(local_cells, window, shape):
+    rows, cols = np.divmod(local_cells, window[1].stop - window[1].start)
+    return np.ravel_multi_index((rows + window[0].start, cols + window[1].start), shape)
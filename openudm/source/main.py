@@ -2,11 +2,24 @@ import os
 import pandas as pd
 import numpy as np
 import source.RasterToolkit as rt
+import source.RasterIO as rio
 import source.MultiCriteriaEval as mce
 import source.DevZones as dz
 import source.CellularModel as cm
+import source.Checkpoint as cp
+import source.Attractors as at
+import source.RasterCatalog as rc
+import source.ResultStore as rs
+import source.Events as ev
+import source.Pyramids as pm
+import source.VectorInput as vi
+import source.GridAlignment as ga
+import source.UrbanFabric as uf
 
-def main(path_to_data, path_to_output):
+# checkpoint: store completed stages and zones in path_to_output/checkpoint
+# resume: skip the stages and zones completed by an earlier run with the same inputs (implies checkpoint)
+# result_store: optional path of a multi-scenario result store (ResultStore.py) the run's outputs are appended to, as scenario
+def main(path_to_data, path_to_output, checkpoint=False, resume=False, result_store=None, scenario=None):
     
     # Set parameters, read rasters and tables, print number of zones, constraints and attractors, and read raster header
     control_params = set_control_params()
@@ -14,38 +27,173 @@ def main(path_to_data, path_to_output):
     table_files = generate_table_filepaths(path_to_data, path_to_output)
     parameters = import_parameters(table_files['parameters_tbl'])
     num_zones, num_constraints, num_attractors = print_zones_constraints_attractors(table_files)
+    # Zones given as a vector file (zones_vector in parameters.csv) are rasterised into the output directory and used as
+    # the zone identity raster
+    if text_parameter(parameters, 'zones_vector') is not None:
+        raster_files['zone_id_ras'] = zone_raster_from_vector(path_to_data, path_to_output, parameters, table_files)
     header_lines, header_values = read_raster_header(raster_files['zone_id_ras'])
 
-    # Standardize attractor layers  
-    standardize_attractor_layers(num_attractors, table_files, path_to_data, path_to_output, header_lines, header_values[-1])
+    ckpt = None
+    if checkpoint or resume:
+        inputs_hash = cp.input_hash(list_input_files(path_to_data, raster_files, table_files), control_params)
+        ckpt = cp.Checkpoint(path_to_output, inputs_hash, resume)
 
-    # Generate the combined constraint layer and the current development rasters   
-    rt.create_constraint_ras_and_current_dev_ras(path_to_data, header_values, header_lines, raster_files['constraint_ras'], 
-                                                 raster_files['current_dev_ras'], raster_files['zone_id_ras'],
-                                                 table_files['constraints_tbl'], num_constraints, parameters['coverage_threshold'])
+    # Validate every input layer against the zone identity raster from the headers alone, before anything is parsed
+    catalog = rc.build_catalog(path_to_data, raster_files['zone_id_ras'], table_files['constraints_tbl'], table_files['attractors_tbl'],
+                               raster_files['raster_stats'])
+    num_resampled = sum(catalog.resampled(name) for name in catalog.layers)
+    print(f"Raster catalog: {len(catalog.layers)} input layers match the zone identity raster ({num_resampled} resampled onto its grid).")
+
+    # Raster outputs are written by a background writer, so writing a stage's outputs overlaps with the next stage;
+    # leaving the block waits for every write to finish
+    with rio.background_writer():
+        # Generate the combined constraint layer and the current development rasters   
+        # The masks are held packed (PackedMask.py), and read back packed by the patch and model stages; write_packed_masks=1 in
+        # parameters.csv writes their compact form as well
+        # The critical constraint thresholds and the patch labellings are cached in the output directory, so a sweep of
+        # coverage_threshold skips the constraint layers and relabels only new constraint masks (threshold_cache=0 turns this off)
+        # Constraint layers given as vector files are rasterised to coverage area with vector_supersample x vector_supersample
+        # subcells per cell (default 10), cached in the output directory
+        # Constraint and attractor layers on another grid covering the zone grid are resampled onto it as they are read
+        # (resampling column of their table; see GridAlignment.py), cached in the output directory
+        threshold_cache = bool(parameters.get('threshold_cache', 1))
+        def constraint_stage():
+            constraint_mask, current_dev_mask = rt.create_constraint_ras_and_current_dev_ras(path_to_data, header_values, header_lines, raster_files['constraint_ras'], 
+                                                         raster_files['current_dev_ras'], raster_files['zone_id_ras'],
+                                                         table_files['constraints_tbl'], num_constraints, parameters['coverage_threshold'],
+                                                         bool(parameters.get('write_packed_masks', 0)),
+                                                         raster_files['constraint_thresholds'] if threshold_cache else None,
+                                                         vi.constraint_layer_reader(header_values, raster_files['vector_coverage'],
+                                                                                    int(parameters.get('vector_supersample', 10)),
+                                                                                    ga.aligned_reader(header_values, raster_files['aligned_layers'],
+                                                                                                      ga.layer_methods(path_to_data, table_files['constraints_tbl'], ga.CONSTRAINT_RESAMPLING),
+                                                                                                      ga.CONSTRAINT_RESAMPLING)))
+            print(f"Constraint mask: {constraint_mask.count()} developable cells, current development: {current_dev_mask.count()} cells.")
+        run_stage(ckpt, 'constraints', [raster_files['constraint_ras'], raster_files['current_dev_ras']], constraint_stage)
+
+        # Standardize attractor layers - after the constraints, as generated attractors may use the current development
+        # Generated attractor layers are kept in memory (and in the checkpoint) and passed straight to the evaluation
+        attractor_table = pd.read_csv(table_files['attractors_tbl'])
+        std_files = [os.path.join(path_to_output, 'std_' + row['layer_name']) for row in attractor_table.to_dict(orient='records')
+                     if at.generator_name(row) is None]
+        generated_layers = run_stage(ckpt, 'standardise', std_files,
+                                     lambda: standardize_attractor_layers(num_attractors, table_files, path_to_data, path_to_output, header_lines,
+                                                                          header_values, raster_files['current_dev_ras'], raster_files['zone_id_ras'], catalog,
+                                                                          ga.aligned_reader(header_values, raster_files['aligned_layers'],
+                                                                                            ga.layer_methods(path_to_data, table_files['attractors_tbl'], ga.ATTRACTOR_RESAMPLING),
+                                                                                            ga.ATTRACTOR_RESAMPLING)))
     
-    # Multi-criteria evaluation
-    # Set rval based upon boolean input (reverse) - it can then be tested in place as function argument
-    rval = 1 if control_params['attractor_reverse'] else 0
-    # Generate suitability raster
-    mce.multi_criteria_eval(raster_files['constraint_ras'], num_attractors, table_files['attractors_tbl'], raster_files['cell_suit_ras'], 
-                      header_lines,header_values, path_to_output, rval)
-    print("Cell suitability raster generated.")
-
-    # Generate zonal development patches ID raster
-    dz.find_zone_dev_patches(parameters['minimum_development_area'], raster_files['constraint_ras'], num_zones,
-                          raster_files['dev_patch_id_ras'], header_lines, header_values, raster_files['zone_id_ras'])
-    # Compute average patch suitability   
-    dz.patch_avg_suitability(raster_files['dev_patch_id_ras'], raster_files['cell_suit_ras'], raster_files['dev_patch_suit_ras'],
-                             header_lines, header_values)
-    print("Average patch suitability computed.")
-
-    # Run the cellular model
-    new_development = cm.run_model(num_zones,parameters, table_files, raster_files,header_values)
-    print("New development areas generated.")
+        # Multi-criteria evaluation
+        # Set rval based upon boolean input (reverse) - it can then be tested in place as function argument
+        rval = 1 if control_params['attractor_reverse'] else 0
+        # Generate suitability raster
+        # suitability_expression in parameters.csv replaces the weighted sum of the attractors (see SuitabilityExpression.py); it
+        # is evaluated suitability_tile_rows rows at a time
+        run_stage(ckpt, 'mce', [raster_files['cell_suit_ras']],
+                  lambda: mce.multi_criteria_eval(raster_files['constraint_ras'], num_attractors, table_files['attractors_tbl'], raster_files['cell_suit_ras'], 
+                                                  header_lines,header_values, path_to_output, rval, generated_layers,
+                                                  text_parameter(parameters, 'suitability_expression'),
+                                                  int(parameters.get('suitability_tile_rows', rio.WRITE_BLOCK_ROWS))))
+        print("Cell suitability raster generated.")
+
+        # Generate zonal development patches ID raster
+        run_stage(ckpt, 'patches', [raster_files['dev_patch_id_ras']],
+                  lambda: dz.find_zone_dev_patches(parameters['minimum_development_area'], raster_files['constraint_ras'], num_zones,
+                                                   raster_files['dev_patch_id_ras'], header_lines, header_values, raster_files['zone_id_ras'], ckpt,
+                                                   os.path.join(path_to_output, 'patch_cache') if threshold_cache else None))
+        # Compute average patch suitability - the patch table of mean suitability by patch ID is kept in the checkpoint
+        run_stage(ckpt, 'patch_suitability', [raster_files['dev_patch_suit_ras']],
+                  lambda: {'patch_suitability': dz.patch_avg_suitability(raster_files['dev_patch_id_ras'], raster_files['cell_suit_ras'],
+                                                                          raster_files['dev_patch_suit_ras'], header_lines, header_values)})
+        print("Average patch suitability computed.")
+
+        # Run the cellular model
+        # pyramid_factors in parameters.csv (e.g. 2;10;50) adds aggregated outputs at those factors (Pyramids.py), reduced
+        # from the rasters already in memory for the model
+        pyramid_factors = pm.parse_factors(parameters.get('pyramid_factors'))
+        rasters = {}
+        def run_model_stage():
+            rasters.update(cm.load_model_rasters(raster_files, header_values[5]))
+            new_development = cm.run_model(num_zones,parameters, table_files, raster_files,header_values, rasters=rasters, checkpoint=ckpt)
+            rt.write_raster_to_file(new_development, raster_files['cell_dev_output_ras'], header_lines)
+            if pyramid_factors:
+                pm.write_pyramids(new_development, rasters['current_dev_mask'], rasters['cell_suit_ras'], header_values, pyramid_factors, path_to_output)
+            # Kept in the checkpoint in the smallest integer dtype holding the NODATA value (int8 would wrap -9999)
+            return {'new_development': new_development.astype(rt.state_dtype(header_values[5]))}
+        new_development = run_stage(ckpt, 'run_model', [raster_files['cell_dev_output_ras'], table_files['zone_diagnostic_tbl'],
+                                     raster_files['cell_dph_ras'], raster_files['cell_pph_ras']]
+                                    + pm.pyramid_file_paths(path_to_output, pyramid_factors),
+                                    run_model_stage)['new_development'].astype(np.float64)
+        print("New development areas generated.")
+
+        # Urban fabric generation (UrbanFabric.py): urban_coverage=1 in parameters.csv derives the density band, building type,
+        # tile type and coverage rasters from the dwelling density of the new development, taken from memory when the model ran
+        # (from out_cell_dph otherwise); urban_fabric=1 also stamps the tiles of those rasters into the urban fabric raster,
+        # tile_scale times finer (out_uf.asc). urban_fabric_tiles names another tile library folder, urban_fabric_seed fixes the
+        # building type draws and tile rotations. urban_fabric_match=coverage stamps the tile matched on building type and build
+        # coverage through the sorted tile index (UrbanFabric.match_tiles) instead of the tile of the tile type raster, e.g. for
+        # build coverage rasters edited after the coverage stage
+        tiles_path = text_parameter(parameters, 'urban_fabric_tiles')
+        tile_match = text_parameter(parameters, 'urban_fabric_match', 'tile_type')
+        if tile_match not in ('tile_type', 'coverage'):
+            raise ValueError(f"urban_fabric_match must be tile_type or coverage, got {tile_match}")
+        seed = None if pd.isna(parameters.get('urban_fabric_seed', np.nan)) else int(parameters['urban_fabric_seed'])
+        coverage = {}
+        def urban_coverage_stage():
+            coverage.update(uf.ufg_coverage_from_density(rasters.get('cell_dph_ras', raster_files['cell_dph_ras']), path_to_output,
+                                                         header_values[:5] + [0], tiles_path, seed))
+        coverage_files = uf.coverage_file_paths(path_to_output)
+        def urban_fabric_stage():
+            uf.ufg_fabric_from_coverage(coverage.get('build_type', coverage_files['build_type']), coverage.get('build_cov', coverage_files['build_cov']),
+                                        raster_files['urban_fabric_ras'], header_values,
+                                        coverage.get('tile_type', coverage_files['tile_type']) if tile_match == 'tile_type' else None,
+                                        tiles_path, seed)
+        if parameters.get('urban_coverage', 0) or parameters.get('urban_fabric', 0):
+            run_stage(ckpt, 'urban_coverage', list(coverage_files.values()), urban_coverage_stage)
+            print("Urban coverage generated.")
+        if parameters.get('urban_fabric', 0):
+            run_stage(ckpt, 'urban_fabric', [raster_files['urban_fabric_ras']], urban_fabric_stage)
+            print("Urban fabric generated.")
+
+    # Append the run to the result store, with its parameters as the scenario attributes
+    if result_store is not None:
+        index = rs.store_scenario(result_store, scenario, new_development, rio.read_raster(raster_files['cell_suit_ras']), header_values,
+                                  parameters, table_files['zone_diagnostic_tbl'])
+        print(f"Results stored as scenario {index} in {result_store}.")
     return new_development
 
 
+# Function run_stage: Run one pipeline stage, unless the checkpoint shows it completed and its output files exist.
+# stage_function may return a dictionary of compact arrays, which are stored in the checkpoint and returned.
+# The stage start and end are emitted as events (Events.py)
+def run_stage(checkpoint, stage, output_files, stage_function):
+    if checkpoint is not None and checkpoint.stage_done(stage, output_files):
+        print(f"Stage {stage} completed in an earlier run, skipping.")
+        ev.emit('stage', 'end', stage, status='skipped', elapsed=0.0)
+        return checkpoint.load_stage(stage)
+    with ev.stage(stage):
+        arrays = stage_function() or {}
+        if checkpoint is not None:
+            # A stage is only marked completed once its outputs are on disk
+            rio.wait_for_writes(output_files)
+            checkpoint.complete_stage(stage, **arrays)
+    return arrays
+
+# Function list_input_files: Input files of a run - the input tables, the zone identity and density rasters, and the
+# constraint and attractor layers named in the tables - hashed to validate a checkpoint
+def list_input_files(path_to_data, raster_files, table_files):
+    input_files = [raster_files['zone_id_ras'], raster_files['density_ras']]
+    input_files += [path for key, path in table_files.items() if key not in ['zone_diagnostic_tbl', 'metadata_tbl']]
+    for tbl in ['constraints_tbl', 'attractors_tbl']:
+        input_files += [os.path.join(path_to_data, name) for name in pd.read_csv(table_files[tbl])['layer_name']]
+    # Source and cost rasters of generated attractors
+    attractor_table = pd.read_csv(table_files['attractors_tbl'])
+    for column in ['source', 'cost']:
+        if column in attractor_table:
+            input_files += [os.path.join(path_to_data, name) for name in attractor_table[column].dropna()]
+    return input_files
+
+
 # Function to set control parameters
 def set_control_params():
     return {
@@ -65,7 +213,14 @@ def generate_raster_filepaths(path_to_data, path_to_output):
         'cell_dev_output_ras': 'out_cell_dev.asc',
         'density_ras': 'density.asc',
         'cell_dph_ras': 'out_cell_dph.asc',
-        'cell_pph_ras': 'out_cell_pph.asc'
+        'cell_pph_ras': 'out_cell_pph.asc',
+        'cell_rank_ras': 'out_cell_rank.asc',
+        'urban_fabric_ras': 'out_uf.asc',
+        'zone_index': 'zone_index.npz',
+        'constraint_thresholds': 'constraint_thresholds.npz',
+        'vector_coverage': 'vector_coverage',
+        'aligned_layers': 'aligned_layers',
+        'raster_stats': 'raster_stats.json'
     }
 
     for key in raster_files:
@@ -95,6 +250,25 @@ def generate_table_filepaths(path_to_data, path_to_output):
             table_files[key] = os.path.join(path_to_data, table_files[key])
     return table_files
 
+# Function text_parameter: Value of an optional text parameter, or default when the column is absent or empty
+def text_parameter(parameters, key, default=None):
+    value = parameters.get(key)
+    return value.strip() if isinstance(value, str) and value.strip() else default
+
+# Function zone_raster_from_vector: Rasterise the zones of the zones_vector file onto the grid of reference_raster (by default
+# the first constraint layer), mapping the zone codes of its zones_code_field field (default zone_code) to the zone IDs of
+# population.csv; zones_layer selects a layer of a multi-layer file. Returns the path of the zone identity raster.
+def zone_raster_from_vector(path_to_data, path_to_output, parameters, table_files):
+    return vi.zone_raster_from_vector(os.path.join(path_to_data, text_parameter(parameters, 'zones_vector')),
+                                      text_parameter(parameters, 'zones_code_field', 'zone_code'),
+                                      zone_reference_raster(path_to_data, parameters, table_files), table_files['population_tbl'], path_to_output,
+                                      layer=text_parameter(parameters, 'zones_layer'))
+
+# Function zone_reference_raster: Path of the raster whose grid vector zones are rasterised onto - reference_raster in parameters.csv,
+# by default the first constraint layer
+def zone_reference_raster(path_to_data, parameters, table_files):
+    return os.path.join(path_to_data, text_parameter(parameters, 'reference_raster', pd.read_csv(table_files['constraints_tbl'])['layer_name'][0]))
+
 def import_parameters(parameters_tbl):
     df = pd.read_csv(parameters_tbl)
     parameters = df.to_dict(orient='records')[0]
@@ -131,27 +305,81 @@ def read_raster_header(zone_id_ras):
 
 # Function to standardize attractor layers
 # This function standardizes the attractor layers by calling the Standardise and RevPolarityStandardise functions from the RasterToolkit module
-# The standardised attractor layers are saved to the output directory with the prefix 'std_'
+# The standardised attractor layers read from file are saved to the output directory with the prefix 'std_'
+# Attractor layers with a generator (see Attractors.py) are computed from current_dev_ras or their source rasters, and
+# returned standardised in a dictionary keyed on layer name instead of being written to file
+# The layers are masked with the zone identity raster zone_id_ras (raster_files['zone_id_ras'], rasterised from vector zones when given)
+# With a raster catalog (RasterCatalog.py) the masked min/max of the layers read from file come from its statistics cache
+# Attractor layers are read with layer_reader (e.g. GridAlignment.aligned_reader, resampling layers onto the zone grid) when given
 # The function raises a ValueError if there is a dimension mismatch between the attractor layer and the mask layer
-def standardize_attractor_layers(num_attractors, table_files, path_to_data, path_to_output, lines, nodatavalue):
-    attractorflag_list = pd.read_csv(table_files['attractors_tbl'])[['layer_name','reverse_polarity_flag']].values.tolist()
-    mask_layer = np.loadtxt(os.path.join(path_to_data, 'zone_identity.asc'), skiprows=6)
+def standardize_attractor_layers(num_attractors, table_files, path_to_data, path_to_output, lines, header_values, current_dev_ras, zone_id_ras,
+                                 catalog=None, layer_reader=None):
+    nodatavalue = header_values[-1]
+    attractor_list = pd.read_csv(table_files['attractors_tbl']).to_dict(orient='records')
+    mask_layer = rio.read_raster(zone_id_ras)
     mask_shape = mask_layer.shape
+    current_dev = None
+    generated_layers = {}
+    # Attractor layers read from file are loaded concurrently, in table order, while earlier layers are standardised
+    file_paths = [os.path.join(path_to_data, attractor['layer_name']) for attractor in attractor_list[:num_attractors]
+                  if at.generator_name(attractor) is None]
+    if layer_reader is None:
+        file_layers = rio.iter_rasters(file_paths)
+    else:
+        file_layers = rio.iter_rasters(file_paths, reader=layer_reader, nbytes=[mask_layer.nbytes] * len(file_paths))
     for i in range(num_attractors):
-        attractor_path = os.path.join(path_to_data, attractorflag_list[i][0])
-        rev_attractor_flag = attractorflag_list[i][1]
-        attractor_layer = np.loadtxt(attractor_path, skiprows=6)
+        attractor_name = attractor_list[i]['layer_name']
+        rev_attractor_flag = attractor_list[i]['reverse_polarity_flag']
+        if at.generator_name(attractor_list[i]) is None:
+            attractor_layer = next(file_layers)
+        else:
+            if current_dev is None:
+                current_dev = rio.read_raster(current_dev_ras)
+            attractor_layer = at.generate_attractor(attractor_list[i], path_to_data, current_dev, header_values)
         
         # Exception handling for dimension mismatch
         if attractor_layer.shape != mask_shape:
-            raise ValueError(f"Dimension mismatch: Attractor layer {attractorflag_list[i][0]} has shape {attractor_layer.shape}, expected {mask_shape}")
+            raise ValueError(f"Dimension mismatch: Attractor layer {attractor_name} has shape {attractor_layer.shape}, expected {mask_shape}")
         
+        stats = None
+        if catalog is not None and at.generator_name(attractor_list[i]) is None:
+            stats = catalog.layer_stats(attractor_name, attractor_layer, mask_layer != nodatavalue)
+
         if rev_attractor_flag == 0:
-            standarised_attractor_layer = rt.Standardise(attractor_layer, mask_layer, nodatavalue)
+            standarised_attractor_layer = rt.Standardise(attractor_layer, mask_layer, nodatavalue, stats)
         elif rev_attractor_flag == 1:
-            standarised_attractor_layer = rt.RevPolarityStandardise(attractor_layer, mask_layer, nodatavalue)
+            standarised_attractor_layer = rt.RevPolarityStandardise(attractor_layer, mask_layer, nodatavalue, stats)
+
+        if at.generator_name(attractor_list[i]) is not None:
+            generated_layers[attractor_name] = standarised_attractor_layer
+            continue
         
-        attractor_output_path = os.path.join(path_to_output, 'std_' + attractorflag_list[i][0])
-        with open(attractor_output_path, 'w') as f:
-            f.write(''.join(lines[:6]))
-            np.savetxt(f, standarised_attractor_layer, fmt='%1.3f')
\ No newline at end of file
+        attractor_output_path = os.path.join(path_to_output, 'std_' + attractor_name)
+        rio.write_raster(standarised_attractor_layer, attractor_output_path, lines[:6], fmt='%1.3f')
+    if catalog is not None:
+        catalog.save()
+    return generated_layers
+
+if __name__ == "__main__":
+    # Usage: python -m source.main path_to_data path_to_output [--checkpoint] [--resume] [--store path [--scenario name]]
+    #        [--progress] [--event-log path]
+    import sys
+    import getopt
+    usage = ('Usage: python -m source.main path_to_data path_to_output [--checkpoint] [--resume] [--store path [--scenario name]] '
+             '[--progress] [--event-log path]')
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["checkpoint", "resume", "store=", "scenario=", "progress", "event-log="])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    if len(args) != 2:
+        print(usage)
+        sys.exit(2)
+    options = dict(opts)
+    # Progress bar on stderr and JSON-lines event log
+    if '--progress' in options:
+        ev.subscribe(ev.ConsoleProgress())
+    if '--event-log' in options:
+        ev.subscribe(ev.JsonLinesLog(options['--event-log']))
+    main(args[0], args[1], checkpoint='--checkpoint' in options, resume='--resume' in options,
+         result_store=options.get('--store'), scenario=options.get('--scenario'))
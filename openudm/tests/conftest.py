@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the pipeline as the source package, as it is imported when run from the openudm directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import source.Attractors as at
+
+NODATA = -9999
+HEADER_VALUES = [30, 20, 0, 0, 100, NODATA]
+
+
+def brute_force_distance(mask, cellsize):
+    rows, cols = np.indices(mask.shape)
+    source_rows, source_cols = np.nonzero(mask)
+    return np.hypot(rows[..., None] - source_rows, cols[..., None] - source_cols).min(axis=-1) * cellsize
+
+
+def test_distance_to_mask_matches_brute_force():
+    mask = np.random.default_rng(0).random((20, 30)) < 0.03
+    assert np.allclose(at.distance_to_mask(mask, 100), brute_force_distance(mask, 100))
+
+
+def test_tiled_distance_matches_capped_distance():
+    mask = np.random.default_rng(1).random((45, 38)) < 0.01
+    expected = np.minimum(brute_force_distance(mask, 50), 400)
+    # Tiles of 8 cells with a halo of the 8 cells within 400 map units
+    assert np.allclose(at.distance_to_mask(mask, 50, max_distance=400, tile_size=8), expected)
+    assert np.array_equal(at.distance_to_mask(np.zeros((5, 5), dtype=bool), 50, max_distance=400), np.full((5, 5), 400.0))
+    with pytest.raises(ValueError):
+        at.distance_to_mask(np.zeros((5, 5), dtype=bool), 50)
+
+
+def test_travel_cost_on_uniform_cost_is_octile_distance():
+    mask = np.zeros((15, 20), dtype=bool)
+    mask[4, 6] = True
+    cost = np.full(mask.shape, 2.0)
+    rows, cols = np.indices(mask.shape)
+    steps = np.abs(rows - 4), np.abs(cols - 6)
+    octile = np.maximum(*steps) + (np.sqrt(2) - 1) * np.minimum(*steps)
+    assert np.allclose(at.travel_cost_to_mask(mask, cost, 100, NODATA), 2.0 * 100 * octile)
+
+
+def test_travel_cost_goes_round_impassable_cells():
+    mask = np.zeros((5, 5), dtype=bool)
+    mask[2, 0] = True
+    cost = np.ones((5, 5))
+    # A wall in column 2 with one gap in the bottom row; NoData and negative costs are impassable
+    cost[:4, 2] = NODATA
+    cost[0, 2] = -1
+    travel_cost = at.travel_cost_to_mask(mask, cost, 1, NODATA)
+    assert travel_cost[2, 4] == pytest.approx(2 * np.sqrt(2) + 2 * np.sqrt(2))
+    # Cells cut off from the sources get max_distance
+    cost[4, 2] = NODATA
+    assert at.travel_cost_to_mask(mask, cost, 1, NODATA, max_distance=50)[2, 4] == 50
+
+
+def test_generate_attractor_from_current_development():
+    current_dev = np.zeros((20, 30))
+    current_dev[5, 5] = 1
+    current_dev[0, :3] = NODATA
+    spec = {'layer_name': 'dev_distance', 'generator': ' distance_to_development ', 'max_distance': np.nan}
+    assert at.generator_name(spec) == 'distance_to_development'
+    assert at.generator_name({'layer_name': 'roads.asc', 'generator': np.nan}) is None
+    distance = at.generate_attractor(spec, '', current_dev, HEADER_VALUES)
+    assert distance[5, 5] == 0 and distance[5, 8] == 300 and distance[9, 8] == 500
+    with pytest.raises(ValueError, match='unknown generator'):
+        at.generate_attractor(dict(spec, generator='gravity'), '', current_dev, HEADER_VALUES)
+    with pytest.raises(ValueError, match="requires a 'source' raster"):
+        at.generate_attractor(dict(spec, generator='distance_to_feature'), '', current_dev, HEADER_VALUES)
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.ndimage import label
+import source.CellularModel as cm
+import source.ZoneIndex as zi
+from source.PackedMask import PackedMask
+
+NODATA = -9999
+
+# The small grids have no current development, so the diagnostic current population density divides by zero
+pytestmark = pytest.mark.filterwarnings('ignore:divide by zero:RuntimeWarning')
+
+
+# Run run_model (density type 3, one dwelling per hectare, so a zone requires its dwellings increase in cells) on small rasters,
+# with patch suitability 0.5 unless dev_patch_suit_ras is given
+def run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, required_cells, dev_patch_suit_ras=None, **parameters):
+    zone_ids = np.arange(len(required_cells))
+    pd.DataFrame({'zone_id': zone_ids, 'zone_code': [f'Z{zone_id}' for zone_id in zone_ids],
+                  'dwellings_increase': required_cells}).to_csv(tmp_path / 'dwellings.csv', index=False)
+    pd.DataFrame({'zone_id': zone_ids, 'zone_code': [f'Z{zone_id}' for zone_id in zone_ids],
+                  'current_population': 100, 'future_population': 200}).to_csv(tmp_path / 'population.csv', index=False)
+    table_files = {'dwellings_tbl': tmp_path / 'dwellings.csv', 'population_tbl': tmp_path / 'population.csv',
+                   'zone_diagnostic_tbl': tmp_path / 'zone_diagnostic.csv'}
+    parameters = dict({'maximum_plot_size': 4, 'density_calculation_type': 3, 'dwellings_per_hectare': 1}, **parameters)
+    if dev_patch_suit_ras is None:
+        dev_patch_suit_ras = np.where(dev_patchid_array > 0, 0.5, 0)
+    rasters = {'zone_id_ras': zone_id_ras.astype(np.float64), 'dev_patch_id_ras': dev_patchid_array.astype(np.float64),
+               'dev_patch_suit_ras': dev_patch_suit_ras, 'cell_suit_ras': cell_suit_ras,
+               'current_dev_mask': PackedMask.from_bool(np.zeros(zone_id_ras.shape, dtype=bool), zone_id_ras == NODATA)}
+    nrows, ncols = zone_id_ras.shape
+    return cm.run_model(len(required_cells), parameters, table_files, {}, [ncols, nrows, 0, 0, 100, NODATA], rasters)
+
+
+def test_grown_patch_develops_required_cells_once(tmp_path):
+    zone_id_ras = np.zeros((6, 6))
+    dev_patchid_array = np.ones((6, 6))
+    cell_suit_ras = np.round(np.random.default_rng(0).random((6, 6)), 3)
+    for required in [1, 5, 17]:
+        new_development = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, [required])
+        assert (new_development == 1).sum() == required
+
+
+def test_grown_patch_ties_go_to_lowest_flat_index(tmp_path):
+    zone_id_ras = np.zeros((4, 5))
+    dev_patchid_array = np.zeros((4, 5))
+    dev_patchid_array[1:, 1:4] = 1
+    new_development = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, np.full((4, 5), 0.5), [2])
+    # Seed at the first patch cell (1, 1), then its first frontier neighbour in flat index order (1, 2)
+    assert list(np.flatnonzero(new_development == 1)) == [6, 7]
+
+
+def test_zones_develop_own_patches_into_one_raster(tmp_path):
+    zone_id_ras = np.repeat([[0, 0, 0, 1, 1, 1]], 4, axis=0)
+    # One patch ID across both zones: each zone only develops the cells of the patch inside it
+    dev_patchid_array = np.ones((4, 6))
+    cell_suit_ras = np.tile(np.array([0.1, 0.2, 0.3, 0.9, 0.8, 0.7]), (4, 1))
+    new_development = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, [3, 2])
+    assert (new_development[zone_id_ras == 0] == 1).sum() == 3
+    assert (new_development[zone_id_ras == 1] == 1).sum() == 2
+
+
+def test_zone_without_cells_develops_nothing(tmp_path):
+    zone_id_ras = np.repeat([[0, 0, 0, 1, 1, 1]], 4, axis=0)
+    # Zone 2 is in the tables but has no cells in the zone identity raster, so its window is empty
+    new_development = run_small_model(tmp_path, zone_id_ras, np.ones((4, 6)), np.full((4, 6), 0.5), [3, 2, 0])
+    assert (new_development == 1).sum() == 5
+
+
+def test_zone_adjacency_boundary_lengths():
+    zone_id_ras = np.array([[0, 0, 1, 1],
+                            [0, 0, 1, 1],
+                            [2, 2, 2, NODATA]])
+    pairs, lengths = zi.zone_adjacency(zone_id_ras, NODATA, 100)
+    assert pairs.tolist() == [[0, 1], [0, 2], [1, 2]]
+    assert lengths.tolist() == [200, 200, 100]
+    zone_index = zi.build_zone_index(zone_id_ras, NODATA, 100)
+    neighbours, neighbour_lengths = zi.zone_neighbours(zone_index, 2)
+    assert neighbours.tolist() == [0, 1] and neighbour_lengths.tolist() == [200, 100]
+
+
+def test_overflow_spills_over_to_neighbours():
+    # Zones in a row: 0 - 1 - 2
+    zone_index = zi.build_zone_index(np.repeat([[0, 0, 1, 1, 2, 2]], 3, axis=0), NODATA, 100)
+    num_dev_cells, unmet, received = cm.redistribute_overflow([0, 1, 2], [8, 1, 0], [2, 3, 10], zone_index, 3)
+    # Zone 1 takes 2 of the 6 unmet cells of zone 0; the other 4 are carried through it to zone 2
+    assert unmet.tolist() == [6, 0, 0]
+    assert received.tolist() == [0, 2, 4]
+    assert num_dev_cells.tolist() == [8, 3, 4]
+    # Demand carried beyond max_rounds is dropped
+    assert cm.redistribute_overflow([0, 1, 2], [8, 1, 0], [2, 3, 10], zone_index, 1)[2].tolist() == [0, 2, 0]
+
+
+def test_overflow_keeps_demand_of_zones_without_cells():
+    # Zone 1 is in the tables but not in the zone raster, so it cannot take the slot of zone 2
+    zone_index = zi.build_zone_index(np.repeat([[0, 0, 2, 2]], 3, axis=0), NODATA, 100)
+    num_dev_cells, unmet, received = cm.redistribute_overflow([0, 1, 2], [5, 4, 1], [2, 0, 10], zone_index, 3)
+    assert unmet.tolist() == [3, 4, 0]
+    assert received.tolist() == [0, 0, 3]
+    assert num_dev_cells.tolist() == [5, 4, 4]
+
+
+def zone_patches(seed, shape=(30, 40)):
+    rng = np.random.default_rng(seed)
+    zone_id_ras = np.repeat(np.repeat([[0, 1, 2, 3]], shape[0], axis=0), shape[1] // 4, axis=1).astype(np.float64)
+    zone_id_ras[:5, :5] = NODATA
+    # Patches are labelled zone by zone, so no patch crosses a zone boundary
+    patch_cells = rng.random(shape) < 0.55
+    dev_patchid_array = np.zeros(shape)
+    for zone_id in range(4):
+        labels, _ = label(patch_cells & (zone_id_ras == zone_id))
+        dev_patchid_array[labels > 0] = labels[labels > 0] + dev_patchid_array.max()
+    patch_suitability = np.round(rng.random(int(dev_patchid_array.max()) + 1), 2)
+    dev_patch_suit_ras = np.where(dev_patchid_array > 0, patch_suitability[dev_patchid_array.astype(int)], 0)
+    cell_suit_ras = np.where(zone_id_ras == NODATA, NODATA, np.round(rng.random(shape), 3))
+    return zone_id_ras, dev_patchid_array, dev_patch_suit_ras, cell_suit_ras
+
+
+@pytest.mark.parametrize('coarse_factor', [2, 3, 8])
+def test_coarse_mode_matches_full_resolution(tmp_path, coarse_factor):
+    zone_id_ras, dev_patchid_array, dev_patch_suit_ras, cell_suit_ras = zone_patches(coarse_factor)
+    # Zone 3 requires more cells than its patches hold, so it is an overflow zone
+    required_cells = [7, 60, 1, 10 ** 4]
+    expected = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, required_cells, dev_patch_suit_ras)
+    coarse = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, required_cells, dev_patch_suit_ras,
+                             coarse_factor=coarse_factor)
+    assert np.array_equal(coarse, expected)
+    assert [(expected[zone_id_ras == zone_id] == 1).sum() for zone_id in range(3)] == required_cells[:3]
+
+
+def test_coarse_patch_table_extents():
+    zone_id_ras, dev_patchid_array, dev_patch_suit_ras, _ = zone_patches(0)
+    patch_table = cm.coarse_patch_table(dev_patchid_array, zone_id_ras, dev_patch_suit_ras, 4)
+    for patch_id in range(1, int(dev_patchid_array.max()) + 1):
+        rows, cols = np.nonzero(dev_patchid_array == patch_id)
+        assert patch_table['sizes'][patch_id] == len(rows)
+        assert patch_table['blocks'][patch_id].tolist() == [rows.min() // 4, rows.max() // 4 + 1, cols.min() // 4, cols.max() // 4 + 1]
+    zone_patch_ids = np.unique(dev_patchid_array[(zone_id_ras == 2) & (dev_patchid_array > 0)])
+    assert patch_table['zone_patches'][2.0].tolist() == zone_patch_ids.tolist()
+
+
+def test_rank_allocation_matches_zone_by_zone_development(tmp_path):
+    zone_id_ras, dev_patchid_array, dev_patch_suit_ras, cell_suit_ras = zone_patches(1)
+    required_cells = [7, 60, 1, 10 ** 4]
+    expected = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, required_cells, dev_patch_suit_ras)
+    ranked = run_small_model(tmp_path, zone_id_ras, dev_patchid_array, cell_suit_ras, required_cells, dev_patch_suit_ras,
+                             rank_allocation=1)
+    assert np.array_equal(ranked, expected)
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import source.ConstraintThresholds as ct
+import source.RasterToolkit as rt
+
+CELLSIZE = 10
+LAYER_NAMES = ['roads.asc', 'water.asc', 'buildings.asc']
+DEVELOPMENT_FLAGS = [0, 0, 1]
+# Layer thresholds as areas of the 100 m2 cell, one of them zero
+THRESHOLD_AREAS = [30.0, 0.0, 50.0]
+
+
+def constraint_data(tmp_path, seed=0):
+    rng = np.random.default_rng(seed)
+    header = ''.join(rt.header_lines([12, 9, 0, 0, CELLSIZE, -1])).rstrip('\n')
+    for name in LAYER_NAMES:
+        # Whole-number coverages, so many cells lie exactly on a threshold
+        layer = rng.integers(0, 8, (9, 12)) * 10.0
+        layer[rng.random(layer.shape) < 0.5] = 0
+        np.savetxt(tmp_path / name, layer, fmt='%g', header=header, comments='')
+    constraints_tbl = str(tmp_path / 'constraints.csv')
+    pd.DataFrame({'layer_name': LAYER_NAMES, 'current_development': DEVELOPMENT_FLAGS,
+                  'threshold': [area / CELLSIZE ** 2 * 100 for area in THRESHOLD_AREAS]}).to_csv(constraints_tbl, index=False)
+    return str(tmp_path), constraints_tbl
+
+
+@pytest.mark.parametrize('coverage_area', [0.0, 40.0, 70.0, 100.0])
+@pytest.mark.parametrize('scale', [1.0, 0.5, 1.6])
+def test_cached_thresholds_reproduce_accumulated_layers(tmp_path, coverage_area, scale):
+    path_to_data, _ = constraint_data(tmp_path)
+    thresholds = ct.compute_critical_thresholds(path_to_data, LAYER_NAMES, DEVELOPMENT_FLAGS, THRESHOLD_AREAS, (9, 12))
+    expected = rt.accumulate_constraint_layers(path_to_data, LAYER_NAMES, DEVELOPMENT_FLAGS, [area * scale for area in THRESHOLD_AREAS],
+                                               coverage_area, (9, 12))
+    constraint_layer, current_dev_layer = ct.constraint_layers(thresholds, coverage_area, scale)
+    assert np.array_equal(constraint_layer, expected[0])
+    assert np.array_equal(current_dev_layer, expected[1])
+    assert 0 < constraint_layer.sum() < constraint_layer.size or coverage_area == 0
+
+
+def test_threshold_cache_is_recomputed_when_a_layer_changes(tmp_path, capsys):
+    path_to_data, constraints_tbl = constraint_data(tmp_path)
+    cache_path = str(tmp_path / 'thresholds.npz')
+    first = ct.load_critical_thresholds(cache_path, path_to_data, constraints_tbl, LAYER_NAMES, DEVELOPMENT_FLAGS, THRESHOLD_AREAS, (9, 12))
+    assert 'read from' not in capsys.readouterr().out
+    cached = ct.load_critical_thresholds(cache_path, path_to_data, constraints_tbl, LAYER_NAMES, DEVELOPMENT_FLAGS, THRESHOLD_AREAS, (9, 12))
+    assert 'read from' in capsys.readouterr().out
+    assert all(np.array_equal(first[name], cached[name]) for name in first)
+
+    constraint_data(tmp_path, seed=1)
+    os.utime(tmp_path / 'roads.asc', ns=(0, 0))
+    changed = ct.load_critical_thresholds(cache_path, path_to_data, constraints_tbl, LAYER_NAMES, DEVELOPMENT_FLAGS, THRESHOLD_AREAS, (9, 12))
+    assert 'read from' not in capsys.readouterr().out
+    assert np.array_equal(changed['coverage_area'], ct.compute_critical_thresholds(path_to_data, LAYER_NAMES, DEVELOPMENT_FLAGS,
+                                                                                   THRESHOLD_AREAS, (9, 12))['coverage_area'])
+
+
+def test_constraint_layer_sweep(tmp_path):
+    path_to_data, _ = constraint_data(tmp_path)
+    thresholds = ct.compute_critical_thresholds(path_to_data, LAYER_NAMES, DEVELOPMENT_FLAGS, THRESHOLD_AREAS, (9, 12))
+    sweep = ct.constraint_layer_sweep(thresholds, CELLSIZE, [10, 50, 90])
+    assert [layer.sum() for layer in sweep] == sorted(layer.sum() for layer in sweep)
+    assert np.array_equal(sweep[1], ct.constraint_layers(thresholds, 50.0)[0])
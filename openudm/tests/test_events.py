@@ -0,0 +1,57 @@
+import io
+import json
+import numpy as np
+import pytest
+import source.Events as ev
+
+
+@pytest.fixture
+def events():
+    received = []
+    handler = ev.subscribe(received.append)
+    yield received
+    ev.unsubscribe(handler)
+
+
+def test_no_events_without_handlers():
+    assert not ev.enabled()
+    progress = ev.Progress('zone', 'run_model', 3)
+    progress.advance()
+    progress.end()
+    assert not progress.active and progress.done == 1
+
+
+def test_stage_end_carries_status(events):
+    with ev.stage('constraints'):
+        pass
+    with pytest.raises(RuntimeError):
+        with ev.stage('suitability'):
+            raise RuntimeError('failed')
+    assert [(event['name'], event['phase'], event.get('status')) for event in events] == [
+        ('constraints', 'start', None), ('constraints', 'end', 'done'), ('suitability', 'start', None), ('suitability', 'end', 'error')]
+    assert all(event['elapsed'] >= 0 for event in events if event['phase'] == 'end')
+
+
+def test_progress_counts_and_eta(events):
+    progress = ev.Progress('zone', 'run_model', 4, scenario='base')
+    for zone_id in range(4):
+        progress.advance(zone_id=zone_id, cells=np.int64(zone_id))
+    progress.end()
+    assert [event['phase'] for event in events] == ['start'] + ['progress'] * 4 + ['end']
+    assert events[0]['total'] == 4 and events[0]['scenario'] == 'base'
+    assert [(event['done'], event['remaining']) for event in events[1:5]] == [(1, 3), (2, 2), (3, 1), (4, 0)]
+    assert events[-1]['eta'] == 0
+
+
+def test_console_and_json_lines_handlers(tmp_path):
+    stream = io.StringIO()
+    console = ev.ConsoleProgress(stream, min_interval=0, width=4)
+    console({'scope': 'stage', 'phase': 'end', 'name': 'constraints', 'status': 'done', 'elapsed': 75.0})
+    console({'scope': 'zone', 'phase': 'progress', 'name': 'run_model', 'done': 2, 'total': 2, 'eta': 0.0})
+    assert stream.getvalue() == 'constraints: done in 1m15s\n\rrun_model [####] 100.0% 2/2 zone ETA 0m00s\n'
+
+    log = ev.JsonLinesLog(str(tmp_path / 'events.jsonl'))
+    log({'scope': 'zone', 'phase': 'progress', 'name': 'run_model', 'cells': np.int64(5), 'fraction': np.float32(0.5)})
+    log.close()
+    assert json.loads((tmp_path / 'events.jsonl').read_text()) == {'scope': 'zone', 'phase': 'progress', 'name': 'run_model',
+                                                                  'cells': 5, 'fraction': 0.5}
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import source.FocalStatistics as fs
+
+NODATA = -1
+
+
+def brute_force_focal(values, valid, kernel):
+    r_rows, r_cols = kernel.shape[0] // 2, kernel.shape[1] // 2
+    padded_values = np.pad(np.where(valid, values, 0.0), ((r_rows,), (r_cols,)))
+    padded_weight = np.pad(valid.astype(float), ((r_rows,), (r_cols,)))
+    value_sum, weight_sum = np.zeros(values.shape), np.zeros(values.shape)
+    for row in range(values.shape[0]):
+        for col in range(values.shape[1]):
+            value_sum[row, col] = (padded_values[row:row + kernel.shape[0], col:col + kernel.shape[1]] * kernel).sum()
+            weight_sum[row, col] = (padded_weight[row:row + kernel.shape[0], col:col + kernel.shape[1]] * kernel).sum()
+    return value_sum, weight_sum
+
+
+def test_circular_and_annulus_kernels():
+    assert np.array_equal(fs.circular_kernel(100, 100), [[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+    annulus = fs.annulus_kernel(100, 200, 100)
+    assert annulus.shape == (5, 5) and annulus[2, 2] == 0 and annulus[2, 3] == 0 and annulus[2, 4] == 1 and annulus[3, 3] == 1
+    # The kernel is limited to the grid extent
+    assert fs.circular_kernel(1000, 100, (4, 30)).shape == (7, 21)
+    with pytest.raises(ValueError, match='must be smaller than its radius'):
+        fs.annulus_kernel(200, 200, 100)
+
+
+@pytest.mark.parametrize('kernel_type, inner_radius', [('circular', 0.0), ('annulus', 150.0)])
+def test_focal_mean_ignores_nodata(kernel_type, inner_radius):
+    rng = np.random.default_rng(0)
+    values = rng.random((12, 15))
+    values[rng.random(values.shape) < 0.2] = NODATA
+    valid = values != NODATA
+    kernel = (fs.circular_kernel(300, 100, values.shape) if kernel_type == 'circular'
+              else fs.annulus_kernel(inner_radius, 300, 100, values.shape))
+    value_sum, weight_sum = brute_force_focal(values, valid, kernel)
+    mean = fs.focal_statistic(values, NODATA, kernel_type, 300, 100, inner_radius=inner_radius)
+    expected = np.full(values.shape, float(NODATA))
+    expected[valid & (weight_sum > 0)] = (value_sum / np.where(weight_sum > 0, weight_sum, 1))[valid & (weight_sum > 0)]
+    assert np.allclose(mean, expected)
+    summed = fs.focal_statistic(values, NODATA, kernel_type, 300, 100, statistic='sum', inner_radius=inner_radius)
+    assert np.allclose(summed, np.where(valid, value_sum, NODATA))
+
+
+def test_focal_mean_without_valid_neighbour_is_nodata():
+    values = np.full((5, 5), float(NODATA))
+    values[2, 2] = 3.0
+    # The annulus leaves out the only valid cell, the centre
+    assert np.array_equal(fs.focal_statistic(values, NODATA, 'annulus', 200, 100, inner_radius=50),
+                          np.full((5, 5), float(NODATA)))
+    assert fs.focal_statistic(values, NODATA, 'circular', 200, 100)[2, 2] == pytest.approx(3.0)
+
+
+def test_gaussian_mean_of_constant_is_constant():
+    values = np.full((20, 25), 0.25)
+    values[:3, :3] = NODATA
+    mean = fs.focal_statistic(values, NODATA, 'gaussian', 200, 100)
+    assert np.allclose(mean[values != NODATA], 0.25)
+    assert np.all(mean[:3, :3] == NODATA)
+    with pytest.raises(ValueError, match='Unknown focal kernel'):
+        fs.focal_statistic(values, NODATA, 'square', 200, 100)
+    with pytest.raises(ValueError, match='Unknown focal statistic'):
+        fs.focal_statistic(values, NODATA, 'circular', 200, 100, statistic='median')
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pytest
+import source.GridAlignment as ga
+import source.RasterToolkit as rt
+
+# Zone grid of 6 x 4 cells of 100 m; the layers are on 30 m grids, offset so their cells straddle the zone cells
+REFERENCE_VALUES = [6, 4, 1000, 2000, 100, -9999]
+LAYER_VALUES = [23, 16, 980, 1970, 30, -1]
+
+
+def write_layer(tmp_path, values, header_values=LAYER_VALUES, name='layer.asc'):
+    file_path = str(tmp_path / name)
+    np.savetxt(file_path, values, fmt='%.6f', header=''.join(rt.header_lines(header_values)).rstrip('\n'), comments='')
+    return file_path
+
+
+def layer_values(seed=0, nodata_share=0.0):
+    rng = np.random.default_rng(seed)
+    values = np.round(rng.random((16, 23)) * 900, 6)
+    values[rng.random(values.shape) < nodata_share] = -1
+    return values
+
+
+# Brute-force resampling on 10 m subcells, a divisor of both cell sizes: each subcell takes the value of its layer cell
+def subcell_resample(values, method):
+    ncols, nrows, xll, yll, cellsize, nodata = LAYER_VALUES
+    ref_cols, ref_rows, ref_xll, ref_yll, ref_cellsize, ref_nodata = REFERENCE_VALUES
+    layer_top, ref_top = yll + nrows * cellsize, ref_yll + ref_rows * ref_cellsize
+    x = ref_xll + (np.arange(ref_cols * 10) + 0.5) * 10
+    y = ref_top - (np.arange(ref_rows * 10) + 0.5) * 10
+    subcells = values[((layer_top - y) // cellsize).astype(int)][:, ((x - xll) // cellsize).astype(int)]
+    if method == 'nearest':
+        centres = subcells[5::10, 5::10]
+        return np.where(centres == nodata, ref_nodata, centres)
+    valid = (subcells != nodata).reshape(ref_rows, 10, ref_cols, 10)
+    blocks = np.where(valid, subcells.reshape(ref_rows, 10, ref_cols, 10), 0)
+    if method == 'sum':
+        # A layer cell is shared out over its 3 x 3 subcells
+        return blocks.sum(axis=(1, 3)) / 9
+    count = valid.sum(axis=(1, 3))
+    return np.where(count > 0, blocks.sum(axis=(1, 3)) / np.maximum(count, 1), ref_nodata)
+
+
+@pytest.mark.parametrize('method', ga.RESAMPLING_METHODS)
+def test_resampling_matches_subcells(tmp_path, method):
+    values = layer_values(nodata_share=0.1)
+    layer = ga.aligned_layer(write_layer(tmp_path, values), ga.grid_header(REFERENCE_VALUES), method)
+    assert layer.shape == (4, 6)
+    assert np.allclose(layer, subcell_resample(values, method))
+
+
+def test_sum_resampling_preserves_total_coverage(tmp_path):
+    # A layer of 20 m cells over exactly the extent of the zone grid, and a 30 m layer with coverage inside the zone grid only
+    values = np.round(np.random.default_rng(1).random((20, 30)) * 400, 6)
+    layer = ga.aligned_layer(write_layer(tmp_path, values, [30, 20, 1000, 2000, 20, -1]), ga.grid_header(REFERENCE_VALUES), 'sum')
+    assert layer.sum() == pytest.approx(values.sum())
+    coverage = np.zeros((16, 23))
+    # Coverage only inside the zone grid extent: whole 30 m cells from x 1010 to 1580 and y 2000 to 2390
+    coverage[2:15, 1:20] = 900
+    layer = ga.aligned_layer(write_layer(tmp_path, coverage, name='coverage.asc'), ga.grid_header(REFERENCE_VALUES), 'sum')
+    assert layer.sum() == pytest.approx(coverage.sum())
+    assert layer.max() <= 100 ** 2
+
+
+def test_layers_off_the_grid_are_checked_and_cached(tmp_path, capsys):
+    file_path = write_layer(tmp_path, layer_values())
+    read_layer = ga.aligned_reader(REFERENCE_VALUES, str(tmp_path / 'aligned'), {file_path: 'sum'}, default='mean')
+    assert read_layer.key == 'resampling=layer.asc:sum'
+    first = read_layer(file_path)
+    assert 'resampled onto the zone identity grid (sum)' in capsys.readouterr().out
+    assert np.array_equal(read_layer(file_path), first) and capsys.readouterr().out == ''
+    assert os.path.exists(tmp_path / 'aligned' / 'layer.asc.sum.npy')
+    # A layer on the zone grid is read as it is, one that does not cover it is refused
+    on_grid = write_layer(tmp_path, np.ones((4, 6)), REFERENCE_VALUES, 'on_grid.asc')
+    assert np.array_equal(read_layer(on_grid), np.ones((4, 6)))
+    short = write_layer(tmp_path, layer_values(), [23, 16, 1010, 1970, 30, -1], 'short.asc')
+    with pytest.raises(ValueError, match='does not cover the extent'):
+        read_layer(short)
+    assert ga.resampling_method({'layer_name': 'roads.asc', 'resampling': ' Nearest '}, 'mean') == 'nearest'
+    assert ga.resampling_method({'layer_name': 'roads.asc', 'resampling': np.nan}, 'mean') == 'mean'
+    with pytest.raises(ValueError, match='resampling must be one of'):
+        ga.resampling_method({'layer_name': 'roads.asc', 'resampling': 'bilinear'}, 'mean')
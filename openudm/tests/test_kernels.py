@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import source.Kernels as kn
+
+numba_backend = pytest.mark.skipif(kn.BACKEND != 'numba', reason='Numba is not installed or the Python backend is forced')
+
+
+def random_patches(seed, nrows=60, ncols=80, num_patches=5):
+    rng = np.random.default_rng(seed)
+    patch_ids = rng.integers(0, num_patches + 1, size=nrows * ncols).astype(np.int32)
+    # Three-decimal suitability values, as read back from the suitability raster, to exercise tie-breaking
+    return patch_ids, np.round(rng.random(nrows * ncols), 3)
+
+
+@numba_backend
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('num_required', [1, 50, 500, 10 ** 6])
+def test_grow_patch_backends_identical(seed, num_required):
+    nrows, ncols = 60, 80
+    patch_ids, suit = random_patches(seed, nrows, ncols)
+    cells = np.flatnonzero(patch_ids == 1).astype(np.int32)
+    orders = []
+    for grow_patch in (kn.grow_patch, kn.PYTHON_KERNELS['grow_patch']):
+        order = np.full(cells.shape[0], -1, dtype=np.int32)
+        num_developed = grow_patch(cells, suit[cells], ncols, nrows, num_required, order)
+        orders.append((num_developed, order))
+    assert orders[0][0] == orders[1][0] == min(num_required, len(cells))
+    assert np.array_equal(orders[0][1], orders[1][1])
+    # Every developed cell is developed once
+    assert len(np.unique(orders[0][1][:orders[0][0]])) == orders[0][0]
+
+
+@numba_backend
+@pytest.mark.parametrize('seed', range(5))
+def test_patch_kernels_backends_identical(seed):
+    patch_ids, suit = random_patches(seed)
+    assert np.array_equal(kn.patch_sizes(patch_ids, 5), kn.PYTHON_KERNELS['patch_sizes'](patch_ids, 5))
+    cells, starts = kn.group_patch_cells(patch_ids, 5)
+    assert np.array_equal(kn.segment_means(suit[cells], starts), kn.PYTHON_KERNELS['segment_means'](suit[cells], starts))
+
+
+@pytest.mark.parametrize('num_patches', [1, 3, 40])
+def test_patch_means_match_np_mean(num_patches):
+    # Patches of a few cells up to thousands, so every branch of the pairwise summation is exercised
+    rng = np.random.default_rng(num_patches)
+    patch_ids = rng.integers(0, num_patches + 1, size=(150, 120)).astype(np.int32)
+    suit = np.round(rng.random((150, 120)), 3)
+    means = kn.patch_means(patch_ids, suit, num_patches)
+    for patch_id in range(1, num_patches + 1):
+        assert means[patch_id] == np.mean(suit[patch_ids == patch_id])
+    for segment_means in (kn.segment_means, kn.PYTHON_KERNELS['segment_means']):
+        for n in [1, 7, 8, 9, 127, 128, 129, 1000, 5003]:
+            values = np.round(rng.random(n), 3) * 1e3
+            assert segment_means(values, np.array([0, n]))[0] == np.mean(values)
@@ -0,0 +1,238 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+import source.Batch as batch
+import source.Events as ev
+import source.main as main
+import source.RasterToolkit as rt
+import source.ResultStore as rs
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'Data')
+
+
+# Copy the sample data to tmp_path/data, with density type 3 (dwellings.csv), its rasters' NODATA value replaced by nodata_value
+# and their origin moved by origin_offset
+def sample_data(tmp_path, nodata_value=-1, origin_offset=0, **parameters):
+    data_path = tmp_path / 'data'
+    shutil.copytree(SAMPLE_DATA, data_path)
+    pd.DataFrame({'zone_identity': [0], 'zone_code': ['S12000011'], 'dwellings_increase': [500]}).to_csv(data_path / 'dwellings.csv', index=False)
+    table = pd.read_csv(data_path / 'parameters.csv')
+    for key, value in dict({'density_calculation_type': 3, 'dwellings_per_hectare': 1}, **parameters).items():
+        table[key] = value
+    table.to_csv(data_path / 'parameters.csv', index=False)
+    for name in os.listdir(data_path):
+        if name.endswith('.asc'):
+            with open(data_path / name) as f:
+                header = [line.split() for line in f.readlines()[:6]]
+            values = np.loadtxt(data_path / name, skiprows=6)
+            values[values == float(header[5][1])] = nodata_value
+            header_values = [float(value) for key, value in header[:5]] + [nodata_value]
+            header_values[2] += origin_offset
+            header_values[3] += origin_offset
+            np.savetxt(data_path / name, values, fmt='%g', header=''.join(rt.header_lines(header_values)).rstrip('\n'), comments='')
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+    return str(data_path) + os.sep, str(output_path) + os.sep
+
+
+def test_new_development_keeps_nodata(tmp_path):
+    data_path, output_path = sample_data(tmp_path, nodata_value=-9999)
+    new_development = main.main(data_path, output_path, checkpoint=True)
+    written = np.loadtxt(os.path.join(output_path, 'out_cell_dev.asc'), skiprows=6)
+    assert np.array_equal(new_development, written)
+    assert set(np.unique(new_development)) == {-9999, 0, 1}
+    # Resuming returns the development stored in the checkpoint
+    assert np.array_equal(main.main(data_path, output_path, resume=True), written)
+
+
+def test_result_store_keeps_nodata(tmp_path):
+    data_path, output_path = sample_data(tmp_path, nodata_value=-9999)
+    store_path = str(tmp_path / 'store')
+    new_development = main.main(data_path, output_path, result_store=store_path, scenario='base')
+    assert np.array_equal(rs.ResultStore(store_path).read_raster('cell_dev', 'base'), new_development)
+
+
+def read_header(file_path):
+    with open(file_path) as f:
+        return [float(f.readline().split()[1]) for _ in range(6)]
+
+
+def test_output_headers_keep_grid_and_nodata(tmp_path):
+    data_path, output_path = sample_data(tmp_path, nodata_value=-9999, origin_offset=0.123456789, rank_allocation=1)
+    main.main(data_path, output_path)
+    zone_header = read_header(os.path.join(data_path, 'zone_identity.asc'))
+    assert zone_header[2] == 240000.123456789
+    for name in ['out_cell_rank.asc', 'out_cell_dph.asc', 'out_cell_dev.asc']:
+        assert read_header(os.path.join(output_path, name))[:5] == zone_header[:5]
+    # Cells without a rank are the header's NODATA value
+    assert read_header(os.path.join(output_path, 'out_cell_rank.asc'))[5] == -9999
+    rank = np.loadtxt(os.path.join(output_path, 'out_cell_rank.asc'), skiprows=6)
+    patch_ids = np.loadtxt(os.path.join(output_path, 'dev_patch_id.asc'), skiprows=6)
+    assert set(np.unique(rank[rank < 0])) == {-9999}
+    assert np.count_nonzero(rank >= 0) == np.count_nonzero(patch_ids > 0)
+
+
+# Replace the zone identity raster of the sample data by a GeoJSON polygon over its grid, holding zone S12000011
+def vector_zones(data_path):
+    os.remove(os.path.join(data_path, 'zone_identity.asc'))
+    xmin, ymin, xmax, ymax = 240000, 644000, 240000 + 210 * 100, 644000 + 180 * 100
+    ring = [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]
+    feature = {'type': 'Feature', 'properties': {'zone_code': 'S12000011'}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+    with open(os.path.join(data_path, 'zones.geojson'), 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [feature]}, f)
+
+
+def test_vector_zones_run(tmp_path):
+    pytest.importorskip('geopandas')
+    pytest.importorskip('rasterio')
+    data_path, output_path = sample_data(tmp_path, zones_vector='zones.geojson')
+    vector_zones(data_path)
+    new_development = main.main(data_path, output_path)
+    # The attractors are masked with the zone raster rasterised into the output directory
+    zone_ras = np.loadtxt(os.path.join(output_path, 'zone_identity.asc'), skiprows=6)
+    assert (zone_ras == 0).all()
+    assert (new_development == 1).sum() > 0
+
+
+def test_batch_finds_vector_zone_areas(tmp_path):
+    data_path, _ = sample_data(tmp_path / 'raster')
+    vector_path, _ = sample_data(tmp_path / 'vector', zones_vector='zones.geojson')
+    vector_zones(vector_path)
+    (tmp_path / 'areas').mkdir()
+    shutil.move(data_path, tmp_path / 'areas' / 'raster')
+    shutil.move(vector_path, tmp_path / 'areas' / 'vector')
+    (tmp_path / 'areas' / 'empty').mkdir()
+    # The vector-zone area runs on the grid of its reference raster, the first constraint layer
+    assert [(area['name'], area['cells']) for area in batch.find_areas(str(tmp_path / 'areas'))] == [('raster', 210 * 180), ('vector', 210 * 180)]
+
+
+# Attractors of the sample data: two generated from the current development and the sample attractor file
+MIXED_ATTRACTORS = pd.DataFrame({'layer_name': ['dev_distance', 'dev_share', 'development_proximity_100m.asc'],
+                                 'reverse_polarity_flag': [1, 0, 0], 'layer_weight': [2.0, 1.0, 4.0],
+                                 'generator': ['distance_to_development', 'focal', None], 'radius': [None, 300, None]})
+
+
+def run_suitability(tmp_path, attractors, **parameters):
+    data_path, output_path = sample_data(tmp_path, **parameters)
+    attractors.to_csv(os.path.join(data_path, 'attractors.csv'), index=False)
+    main.main(data_path, output_path)
+    return np.loadtxt(os.path.join(output_path, 'out_cell_suit.asc'), skiprows=6)
+
+
+def test_expression_mixes_generated_and_file_attractors(tmp_path):
+    weighted_sum = run_suitability(tmp_path / 'sum', MIXED_ATTRACTORS)
+    assert np.array_equal(run_suitability(tmp_path / 'wsum', MIXED_ATTRACTORS, suitability_expression='wsum()', suitability_tile_rows=7),
+                          weighted_sum)
+    # Each generated attractor is evaluated from its own layer
+    generated = MIXED_ATTRACTORS[:2]
+    assert np.array_equal(run_suitability(tmp_path / 'generated', generated, suitability_expression='wsum(dev_distance, dev_share)'),
+                          run_suitability(tmp_path / 'generated_sum', generated))
+    assert not np.array_equal(run_suitability(tmp_path / 'distance', generated, suitability_expression='wsum(dev_distance)'),
+                              run_suitability(tmp_path / 'share', generated, suitability_expression='wsum(dev_share)'))
+
+
+def test_mosaic_rasters_places_each_raster_in_its_window(tmp_path):
+    first, second = np.arange(12).reshape(3, 4), np.full((2, 3), 7)
+    second[0, 0] = -1
+    paths = [str(tmp_path / 'first.asc'), str(tmp_path / 'second.asc')]
+    # The second raster lies two cells right of and one cell below the top left of the first
+    for path, values, xll, yll in zip(paths, [first, second], [0, 20], [100, 100]):
+        np.savetxt(path, values, fmt='%d', header=''.join(rt.header_lines([values.shape[1], values.shape[0], xll, yll, 10, -1])).rstrip('\n'), comments='')
+    output_path = str(tmp_path / 'mosaic.asc')
+    assert batch.mosaic_rasters(paths, output_path, block_rows=1) == [5, 3, 0, 100, 10, -1]
+    # NoData cells of a raster leave the mosaic as it is
+    assert np.array_equal(np.loadtxt(output_path, skiprows=6), [[0, 1, 2, 3, -1], [4, 5, 6, 7, 7], [8, 9, 7, 7, 7]])
+    assert read_header(output_path) == [5, 3, 0, 100, 10, -1]
+    assert not os.path.exists(output_path + '.mosaic.npy')
+
+    np.savetxt(paths[1], second, fmt='%d', header=''.join(rt.header_lines([3, 2, 25, 100, 10, -1])).rstrip('\n'), comments='')
+    with pytest.raises(ValueError, match='is not aligned'):
+        batch.mosaic_rasters(paths, output_path)
+
+
+def test_batch_retries_failed_areas_and_mosaics_the_rest(tmp_path):
+    (tmp_path / 'areas').mkdir()
+    for name in ['good', 'broken']:
+        data_path, _ = sample_data(tmp_path / name)
+        shutil.move(data_path, tmp_path / 'areas' / name)
+    pd.DataFrame({'layer_name': ['missing.asc']}).to_csv(tmp_path / 'areas' / 'broken' / 'constraints.csv', index=False)
+    output_path = str(tmp_path / 'output')
+    results = batch.batch(str(tmp_path / 'areas'), output_path, max_workers=2, retries=1)
+    assert {result['area']: (result['status'], result['attempts']) for result in results} == {'broken': ('failed', 2), 'good': ('done', 1)}
+    assert 'missing.asc: file' in pd.read_csv(os.path.join(output_path, 'batch_summary.csv')).set_index('area').loc['broken', 'error']
+    assert 'Traceback' in open(os.path.join(output_path, 'broken', 'run.log')).read()
+    # The mosaic of the one completed area is its development raster
+    assert np.array_equal(np.loadtxt(os.path.join(output_path, 'out_cell_dev.asc'), skiprows=6),
+                          np.loadtxt(os.path.join(output_path, 'good', 'out_cell_dev.asc'), skiprows=6))
+
+
+def test_pipeline_stages_emit_matched_events(tmp_path):
+    data_path, output_path = sample_data(tmp_path)
+    events = []
+    handler = ev.subscribe(events.append)
+    try:
+        main.main(data_path, output_path, checkpoint=True)
+        first_run = len(events)
+        main.main(data_path, output_path, resume=True)
+    finally:
+        ev.unsubscribe(handler)
+    stages = [(event['name'], event['phase'], event.get('status')) for event in events[:first_run] if event['scope'] == 'stage']
+    names = [name for name, phase, status in stages if phase == 'start']
+    # Every stage starts, then ends done before the next one starts
+    assert len(names) == len(set(names)) > 1
+    assert stages == [item for name in names for item in [(name, 'start', None), (name, 'end', 'done')]]
+    zone_events = [event for event in events[:first_run] if event['scope'] == 'zone']
+    assert zone_events[0]['phase'] == 'start' and zone_events[-1]['phase'] == 'end'
+    assert zone_events[-1]['done'] == zone_events[-1]['total'] == 1
+    # Resuming skips every stage, each with a single end event
+    assert [(event['name'], event['phase'], event['status']) for event in events[first_run:] if event['scope'] == 'stage'] == [
+        (name, 'end', 'skipped') for name in names]
+
+
+def test_pipeline_writes_pyramids(tmp_path):
+    data_path, output_path = sample_data(tmp_path, pyramid_factors='4;20')
+    new_development = main.main(data_path, output_path)
+    # Each level counts every developed cell of the base grid
+    for factor in [4, 20]:
+        count = np.loadtxt(os.path.join(output_path, f'out_cell_dev_count_{factor}x.asc'), skiprows=6)
+        assert count[count != -1].sum() == (new_development == 1).sum()
+        assert read_header(os.path.join(output_path, f'out_cell_dev_count_{factor}x.asc'))[:2] == [-(-210 // factor), -(-180 // factor)]
+
+
+# Write a density raster (dwellings per hectare) on the grid of the sample data
+def density_raster(data_path, density):
+    with open(os.path.join(data_path, 'zone_identity.asc')) as f:
+        header = ''.join(f.readlines()[:6]).rstrip('\n')
+    np.savetxt(os.path.join(data_path, 'density.asc'), density, fmt='%g', header=header, comments='')
+
+
+@pytest.mark.parametrize('density', [3, 7.5])
+def test_variable_density_develops_capacity_of_increase(tmp_path, density):
+    data_path, output_path = sample_data(tmp_path, density_calculation_type=2)
+    density_raster(data_path, np.full((180, 210), density))
+    new_development = main.main(data_path, output_path)
+    current_development = np.loadtxt(os.path.join(output_path, 'current_development.asc'), skiprows=6)
+    new_cells = (new_development == 1) & (current_development != 1)
+    # One-hectare cells of the same capacity: the increase of 500 dwellings needs ceil(500 / density) cells
+    assert new_cells.sum() == np.ceil(500 / density)
+    dph = np.loadtxt(os.path.join(output_path, 'out_cell_dph.asc'), skiprows=6)
+    assert np.all(dph[new_cells] == np.ceil(density))
+
+
+def test_variable_density_fills_the_ranks_until_capacity_meets_increase(tmp_path):
+    data_path, output_path = sample_data(tmp_path, density_calculation_type=2)
+    density = np.tile(np.arange(210) % 9, (180, 1)).astype(np.float64)
+    density_raster(data_path, density)
+    new_development = main.main(data_path, output_path)
+    current_development = np.loadtxt(os.path.join(output_path, 'current_development.asc'), skiprows=6)
+    new_cells = (new_development == 1) & (current_development != 1)
+    # The new cells are the first ranks whose capacity reaches the increase, without the last of them falling short
+    rank = np.loadtxt(os.path.join(output_path, 'out_cell_rank.asc'), skiprows=6)
+    capacity = np.zeros(int(rank.max()) + 1)
+    capacity[rank[rank >= 0].astype(int)] = density[rank >= 0]
+    num_cells = new_cells.sum()
+    assert capacity[:num_cells].sum() >= 500 > capacity[:num_cells - 1].sum()
+    assert np.array_equal(np.sort(rank[new_cells]), np.arange(num_cells))
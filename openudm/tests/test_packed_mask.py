@@ -0,0 +1,66 @@
+import numpy as np
+import source.RasterToolkit as rt
+import source.PackedMask as pmk
+from source.PackedMask import PackedMask
+
+NODATA = -9999
+
+
+# 0/1 raster with NoData cells, of a size that is not a multiple of 8 cells
+def mask_raster(seed, shape=(13, 7)):
+    rng = np.random.default_rng(seed)
+    raster = rng.integers(0, 2, shape).astype(np.float64)
+    raster[rng.random(shape) < 0.2] = NODATA
+    return raster
+
+
+def test_array_round_trip_and_counts():
+    raster = mask_raster(0)
+    mask = PackedMask.from_array(raster, NODATA)
+    assert np.array_equal(mask.to_array(NODATA), raster)
+    assert np.array_equal(mask.to_bool(), raster == 1)
+    assert np.array_equal(mask.nodata_bool(), raster == NODATA)
+    assert mask.count() == np.count_nonzero(raster == 1)
+    assert mask.count_nodata() == np.count_nonzero(raster == NODATA)
+
+
+def test_logical_operations():
+    a, b = mask_raster(1), mask_raster(2)
+    mask_a, mask_b = PackedMask.from_array(a, NODATA), PackedMask.from_array(b, NODATA)
+    nodata = (a == NODATA) | (b == NODATA)
+    assert np.array_equal((mask_a & mask_b).to_bool(), (a == 1) & (b == 1) & ~nodata)
+    assert np.array_equal((mask_a | mask_b).to_bool(), ((a == 1) | (b == 1)) & ~nodata)
+    assert np.array_equal((mask_a & mask_b).nodata_bool(), nodata)
+
+
+def test_invert_leaves_padding_and_nodata_clear():
+    raster = mask_raster(3)
+    inverted = ~PackedMask.from_array(raster, NODATA)
+    assert np.array_equal(inverted.to_bool(), raster == 0)
+    # 91 cells: the last 5 bits of the last byte are padding, and must stay clear for popcounts
+    assert inverted.bits[-1] & 0b00011111 == 0
+    assert inverted.count() == np.count_nonzero(raster == 0)
+    assert (~inverted) == PackedMask.from_array(raster, NODATA)
+
+
+def test_save_load_round_trip(tmp_path):
+    raster = mask_raster(4)
+    mask = PackedMask.from_array(raster, NODATA)
+    header_values = [7, 13, 240000, 644000, 100, NODATA]
+    mask.save(str(tmp_path / 'constraint.mask.npz'), header_values)
+    loaded, loaded_header = PackedMask.load(str(tmp_path / 'constraint.mask.npz'))
+    assert loaded == mask and loaded.shape == (13, 7)
+    assert loaded_header == header_values
+    assert np.array_equal(loaded.to_array(NODATA), raster)
+    assert pmk.packed_mask_path('out/constraint.asc') == 'out/constraint.mask.npz'
+
+
+def test_read_mask_and_windows(tmp_path):
+    raster = mask_raster(5, shape=(21, 13))
+    rt.write_raster_to_file(raster, str(tmp_path / 'mask.asc'), rt.header_lines([13, 21, 0, 0, 100, NODATA]))
+    # Packed 8 rows at a time, the mask is the one of the whole raster
+    mask = pmk.read_mask(str(tmp_path / 'mask.asc'), NODATA, block_rows=8)
+    assert mask == PackedMask.from_array(raster, NODATA)
+    for window in [(slice(0, 21), slice(0, 13)), (slice(3, 9), slice(2, 11)), (slice(20, 21), slice(12, 13)), (slice(0, 0), slice(0, 0))]:
+        assert np.array_equal(mask.window_bool(window), raster[window] == 1)
+        assert np.array_equal(mask.window_nodata(window), raster[window] == NODATA)
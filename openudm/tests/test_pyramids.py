@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import source.Pyramids as py
+from source.PackedMask import PackedMask
+
+NODATA = -9999
+
+
+def pyramid_inputs(shape=(37, 53), seed=0):
+    rng = np.random.default_rng(seed)
+    nodata = rng.random(shape) < 0.15
+    nodata[:6, :6] = True
+    current_dev = ~nodata & (rng.random(shape) < 0.2)
+    new_development = np.where(current_dev | (rng.random(shape) < 0.3), 1, 0)
+    new_development[nodata] = NODATA
+    cell_suit_ras = np.where(nodata, NODATA, rng.random(shape))
+    return new_development, PackedMask.from_bool(current_dev, nodata), current_dev, cell_suit_ras
+
+
+def brute_force_sums(new_development, current_dev, cell_suit_ras, factor):
+    nrows, ncols = new_development.shape
+    sums = np.zeros((4, -(-nrows // factor), -(-ncols // factor)))
+    for block_row in range(sums.shape[1]):
+        for block_col in range(sums.shape[2]):
+            block = (slice(block_row * factor, (block_row + 1) * factor), slice(block_col * factor, (block_col + 1) * factor))
+            valid = new_development[block] != NODATA
+            developed = valid & (new_development[block] == 1)
+            sums[:, block_row, block_col] = [valid.sum(), developed.sum(), (developed & ~current_dev[block]).sum(),
+                                             cell_suit_ras[block][valid].sum()]
+    return sums
+
+
+def test_pyramid_sums_match_brute_force(monkeypatch):
+    # Bands of two blocks, so the base sums are reduced over several bands
+    monkeypatch.setattr(py, 'BAND_BLOCKS', 2)
+    new_development, current_dev_mask, current_dev, cell_suit_ras = pyramid_inputs()
+    levels = py.pyramid_sums(new_development, current_dev_mask, cell_suit_ras, NODATA, [10, 2, 3, 6])
+    assert sorted(levels) == [2, 3, 6, 10]
+    for factor, sums in levels.items():
+        assert np.allclose(sums, brute_force_sums(new_development, current_dev, cell_suit_ras, factor))
+
+
+def test_parse_factors_and_header_values():
+    assert py.parse_factors('10;2 2') == [2, 10]
+    assert py.parse_factors(5.0) == [5]
+    assert py.parse_factors(np.nan) == []
+    with pytest.raises(ValueError, match='at least 2'):
+        py.parse_factors('1;4')
+    # 53 x 37 cells in blocks of 10: 6 x 4 blocks, the bottom row of blocks reaching below the base grid
+    assert py.pyramid_header_values([53, 37, 1000, 2000, 100, NODATA], 10) == [6, 4, 1000, 2000 + 3700 - 4000, 1000, NODATA]
+
+
+def test_write_pyramids(tmp_path):
+    new_development, current_dev_mask, current_dev, cell_suit_ras = pyramid_inputs()
+    file_paths = py.write_pyramids(new_development, current_dev_mask, cell_suit_ras, [53, 37, 0, 0, 100, NODATA], [3], str(tmp_path) + '/')
+    assert file_paths == py.pyramid_file_paths(str(tmp_path) + '/', [3])
+    count, fraction, mean = [np.loadtxt(file_path, skiprows=6) for file_path in file_paths]
+    valid, developed, new, suitability = brute_force_sums(new_development, current_dev, cell_suit_ras, 3)
+    # The top-left block holds NoData cells only
+    assert count[0, 0] == fraction[0, 0] == mean[0, 0] == NODATA
+    assert np.array_equal(count[valid > 0], developed[valid > 0])
+    assert np.allclose(fraction[valid > 0], (new / np.maximum(valid, 1))[valid > 0], atol=5e-5)
+    assert np.allclose(mean[valid > 0], (suitability / np.maximum(valid, 1))[valid > 0], atol=5e-4)
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import source.RasterCatalog as rc
+import source.RasterToolkit as rt
+
+HEADER_VALUES = [6, 4, 1000, 2000, 50, -9999]
+
+
+def write_grid(file_path, values, header_values=HEADER_VALUES):
+    np.savetxt(file_path, values, fmt='%g', header=''.join(rt.header_lines(header_values)).rstrip('\n'), comments='')
+    return str(file_path)
+
+
+def test_read_header_converts_cell_centres(tmp_path):
+    file_path = tmp_path / 'centre.asc'
+    file_path.write_text('ncols 6\nnrows 4\nxllcenter 1025\nyllcenter 2025\ncellsize 50\n' + '0 0 0 0 0 0\n' * 4)
+    assert rc.read_header(str(file_path)) == {'ncols': 6, 'nrows': 4, 'xllcorner': 1000.0, 'yllcorner': 2000.0,
+                                              'cellsize': 50.0, 'nodata_value': -9999.0}
+    (tmp_path / 'table.asc').write_text('layer_name,weight\nroads.asc,1\n')
+    with pytest.raises(ValueError, match='incomplete header'):
+        rc.read_header(str(tmp_path / 'table.asc'))
+
+
+def test_build_catalog_lists_every_mismatch(tmp_path):
+    zones = write_grid(tmp_path / 'zones.asc', np.zeros((4, 6)))
+    write_grid(tmp_path / 'roads.asc', np.ones((4, 6)))
+    # A constraint layer on another grid must cover the zone raster; source and cost rasters must match its grid
+    write_grid(tmp_path / 'slope.asc', np.ones((4, 6)), [6, 4, 1100, 2000, 50, -9999])
+    write_grid(tmp_path / 'rivers.asc', np.ones((4, 6)), [6, 4, 1000, 2000, 100, -9999])
+    pd.DataFrame({'layer_name': ['slope.asc'], 'threshold': [0.5]}).to_csv(tmp_path / 'constraints.csv', index=False)
+    pd.DataFrame({'layer_name': ['roads.asc', 'river_distance', 'road_cost'], 'weight': [1, 2, 1],
+                  'generator': [np.nan, 'distance_to_feature', 'travel_cost'], 'source': [np.nan, 'rivers.asc', 'rivers.asc'],
+                  'cost': [np.nan, np.nan, 'cost.asc']}).to_csv(tmp_path / 'attractors.csv', index=False)
+    with pytest.raises(ValueError) as error:
+        rc.build_catalog(str(tmp_path), zones, str(tmp_path / 'constraints.csv'), str(tmp_path / 'attractors.csv'))
+    message = str(error.value)
+    assert 'slope.asc: does not cover the extent of the zone identity raster' in message
+    assert 'rivers.asc: cellsize is 100, expected 50 as in the zone identity raster' in message
+    assert f"cost.asc: file {os.path.join(str(tmp_path), 'cost.asc')} not found" in message
+    assert 'roads.asc' not in message
+
+    # A constraint layer on a coarser grid covering the zone raster is resampled onto it
+    write_grid(tmp_path / 'slope.asc', np.ones((4, 6)), [6, 4, 1000, 2000, 100, -9999])
+    write_grid(tmp_path / 'rivers.asc', np.zeros((4, 6)))
+    write_grid(tmp_path / 'cost.asc', np.ones((4, 6)))
+    catalog = rc.build_catalog(str(tmp_path), zones, str(tmp_path / 'constraints.csv'), str(tmp_path / 'attractors.csv'))
+    assert sorted(catalog.layers) == ['cost.asc', 'rivers.asc', 'roads.asc', 'slope.asc']
+    assert [name for name in sorted(catalog.layers) if catalog.resampled(name)] == ['slope.asc']
+
+
+def test_layer_stats_are_cached_until_the_layer_changes(tmp_path):
+    zones = write_grid(tmp_path / 'zones.asc', np.zeros((4, 6)))
+    values = np.arange(24.0).reshape(4, 6)
+    roads = write_grid(tmp_path / 'roads.asc', values)
+    mask_valid = np.ones((4, 6), dtype=bool)
+    mask_valid[0] = False
+    cache_path = str(tmp_path / 'stats.json')
+
+    catalog = rc.RasterCatalog(zones, cache_path)
+    catalog.add('roads.asc', roads)
+    assert catalog.cached_stats('roads.asc') is None
+    assert catalog.layer_stats('roads.asc', values, mask_valid) == {'min': 6.0, 'max': 23.0, 'count': 18}
+    catalog.save()
+
+    # A new catalog reads the statistics from the cache, not from the array it is given
+    catalog = rc.RasterCatalog(zones, cache_path)
+    catalog.add('roads.asc', roads)
+    assert catalog.layer_stats('roads.asc', np.zeros((4, 6)), mask_valid) == {'min': 6.0, 'max': 23.0, 'count': 18}
+
+    # Rewriting the layer invalidates its entry
+    write_grid(tmp_path / 'roads.asc', values * 10)
+    catalog = rc.RasterCatalog(zones, cache_path)
+    catalog.add('roads.asc', roads)
+    assert catalog.cached_stats('roads.asc') is None
+    assert catalog.layer_stats('roads.asc', values * 10, mask_valid)['max'] == 230.0
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+import numpy as np
+import pytest
+import source.RasterIO as rio
+
+
+def test_iter_rasters_yields_in_order():
+    delays = [0.05, 0.0, 0.03, 0.0, 0.01, 0.0]
+
+    def reader(name):
+        time.sleep(delays[int(name)])
+        return np.full((2, 2), float(name))
+
+    arrays = list(rio.iter_rasters([str(i) for i in range(6)], max_workers=4, reader=reader, nbytes=[32] * 6))
+    assert [array[0, 0] for array in arrays] == list(range(6))
+
+
+def test_iter_rasters_keeps_within_memory_budget():
+    started = []
+    lock = threading.Lock()
+
+    def reader(name):
+        with lock:
+            started.append(name)
+        return np.zeros(1)
+
+    # Each layer counts 10 bytes against a budget of 25, so one layer may load ahead of the one being used
+    for i, _ in enumerate(rio.iter_rasters([str(i) for i in range(8)], max_workers=4, memory_budget=25,
+                                           reader=reader, nbytes=[10] * 8)):
+        time.sleep(0.02)
+        with lock:
+            assert len(started) <= i + 2
+    assert started == [str(i) for i in range(8)]
+
+
+def test_iter_rasters_raises_read_errors_and_stops_early():
+    def reader(name):
+        if name == '2':
+            raise OSError('cannot read 2')
+        return np.zeros(1)
+
+    layers = rio.iter_rasters([str(i) for i in range(5)], max_workers=2, reader=reader, nbytes=[8] * 5)
+    assert next(layers)[0] == 0 and next(layers)[0] == 0
+    with pytest.raises(OSError, match='cannot read 2'):
+        next(layers)
+    # Stopping after the first layer does not wait for the rest
+    layers = rio.iter_rasters([str(i) for i in range(5)], max_workers=2, memory_budget=8, reader=reader, nbytes=[8] * 5)
+    next(layers)
+    layers.close()
+
+
+def test_read_rasters_and_row_blocks(tmp_path):
+    header = ['ncols 3\n', 'nrows 5\n', 'xllcorner 0\n', 'yllcorner 0\n', 'cellsize 1\n', 'NODATA_value -1\n']
+    array = np.arange(15).reshape(5, 3)
+    paths = [str(tmp_path / 'a.asc'), str(tmp_path / 'b.asc.gz')]
+    rio.write_raster_now(array, paths[0], header)
+    rio.write_raster_now(array * 2, paths[1], header)
+    assert rio.raster_nbytes(paths[1]) == 15 * 8
+    first, second = rio.read_rasters(paths)
+    assert np.array_equal(first, array) and np.array_equal(second, array * 2)
+    blocks = list(rio.iter_row_blocks(paths[1], 2))
+    assert [block.shape for block in blocks] == [(2, 3), (2, 3), (1, 3)]
+    assert np.array_equal(np.vstack(blocks), array * 2)
+
+
+@pytest.mark.parametrize('fmt', ['%d', '%.1f', '%.3f', '%1.2f'])
+def test_format_rows_matches_savetxt(tmp_path, fmt):
+    rng = np.random.default_rng(3)
+    array = np.round(rng.normal(0, 1000, (7, 9)), 5)
+    array[0, :4] = [0.0, -0.0, -9999, 0.04]
+    np.savetxt(tmp_path / 'expected.txt', array, fmt=fmt)
+    assert rio.format_rows(array, fmt) == (tmp_path / 'expected.txt').read_text()
+    # Values printf could round either way are left to np.savetxt
+    assert rio.format_rows_bytes(np.array([[0.125]]), '%.2f') is None
+    assert rio.format_rows(np.array([[0.125, 2]]), '%.2f') == '0.12 2.00\n'
+    assert rio.format_rows_bytes(array, '%g') is None
+
+
+def test_background_writer_queues_writes(tmp_path):
+    header = ['ncols 4\n', 'nrows 300\n', 'xllcorner 0\n', 'yllcorner 0\n', 'cellsize 1\n', 'NODATA_value -1\n']
+    array = np.arange(1200.0).reshape(300, 4) / 8
+    file_path = str(tmp_path / 'out.asc')
+    with rio.background_writer() as writer:
+        rio.write_raster(array, file_path, header, fmt='%.3f')
+        # The array is copied when queued, so it may be reused at once
+        array[:] = 0
+        # Reading waits for the pending write of the file
+        assert np.array_equal(rio.read_raster(file_path), np.arange(1200.0).reshape(300, 4) / 8)
+        rio.write_raster(array, str(tmp_path / 'out.asc.gz'), header)
+        writer.wait()
+    assert np.array_equal(np.loadtxt(tmp_path / 'out.asc.gz', skiprows=6), np.zeros((300, 4)))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_background_write_errors_are_raised(tmp_path):
+    header = ['ncols 1\n', 'nrows 1\n', 'xllcorner 0\n', 'yllcorner 0\n', 'cellsize 1\n', 'NODATA_value -1\n']
+    with pytest.raises(FileNotFoundError):
+        with rio.background_writer():
+            rio.write_raster(np.zeros((1, 1)), str(tmp_path / 'missing' / 'out.asc'), header)
+    assert rio._active_writer is None
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import source.ResultStore as rs
+
+HEADER_VALUES = [4, 3, 0, 0, 100, -9999]
+
+
+def development(seed):
+    new_development = np.random.default_rng(seed).integers(0, 2, (3, 4)).astype(np.float64)
+    new_development[0, :2] = -9999
+    return new_development
+
+
+def test_store_scenario_keeps_nodata(tmp_path):
+    for seed in range(2):
+        rs.store_scenario(str(tmp_path), None, development(seed), np.full((3, 4), 0.5), HEADER_VALUES, {'seed': seed})
+    store = rs.ResultStore(str(tmp_path))
+    for seed in range(2):
+        assert np.array_equal(store.read_raster('cell_dev', f'scenario_{seed}'), development(seed))
+    assert store.raster('cell_dev').meta['fill_value'] == -9999
+    assert np.isnan(store.frequency()[0, :2]).all() and not np.isnan(store.frequency()[1:]).any()
+
+
+def test_append_widens_raster_dtype(tmp_path):
+    store = rs.ResultStore(str(tmp_path))
+    first = np.array([[-1, 0], [1, 1]], dtype=np.int8)
+    store.append_scenario('int8', {'cell_dev': first}, [2, 2, 0, 0, 100, -1])
+    second = np.array([[-9999, 0], [1, 0]], dtype=np.int16)
+    store.append_scenario('int16', {'cell_dev': second}, [2, 2, 0, 0, 100, -9999])
+    assert store.raster('cell_dev').dtype == np.int16
+    assert np.array_equal(store.read_raster('cell_dev', 'int8'), first)
+    assert np.array_equal(store.read_raster('cell_dev', 'int16'), second)
+
+
+def test_append_rejects_nodata_outside_dtype(tmp_path):
+    store = rs.ResultStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.append_scenario('int8', {'cell_dev': np.zeros((2, 2), dtype=np.int8)}, [2, 2, 0, 0, 100, -9999])
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+import pytest
+import source.SharedRasters as sr
+import source.CellularModel as cm
+import source.ZoneIndex as zi
+
+OPENUDM_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_publish_keeps_nodata():
+    current_dev = np.array([[-9999., 0., 1.], [1., 0., -9999.]])
+    with sr.SharedRasterPool() as pool:
+        descriptors = sr.publish_model_rasters(pool, {'current_dev_ras': current_dev})
+        views = sr.attach_rasters(descriptors)
+        assert np.array_equal(views['current_dev_ras'], current_dev)
+        assert not views['current_dev_ras'].flags.writeable
+        views.clear()
+        sr.detach_rasters(descriptors)
+
+
+def test_publish_rejects_lossy_dtype():
+    with sr.SharedRasterPool() as pool:
+        with pytest.raises(ValueError):
+            pool.publish('current_dev_ras', np.array([-9999., 1.]), np.int8)
+
+
+def test_parallel_rank_raster_matches_serial():
+    rng = np.random.default_rng(3)
+    nrows, ncols = 40, 50
+    zone_id_ras = np.repeat(np.arange(4), nrows * ncols // 4).reshape(nrows, ncols).astype(np.float64)
+    dev_patchid_array = np.where(rng.random((nrows, ncols)) < 0.7, zone_id_ras * 10 + rng.integers(1, 4, (nrows, ncols)), 0)
+    dev_patch_suit_array = np.round(rng.random((nrows, ncols)), 3)
+    cell_suit_ras = np.round(rng.random((nrows, ncols)), 3)
+    zone_ids = np.arange(4)
+    windows = zi.zone_windows(zi.build_zone_index(zone_id_ras, -1, 100))
+    args = (zone_ids, windows, zone_id_ras, dev_patchid_array, dev_patch_suit_array, cell_suit_ras, -1)
+    serial = cm.development_rank_raster(*args)
+    assert np.array_equal(cm.development_rank_raster(*args, workers=2), serial)
+    assert (serial >= 0).sum() == (dev_patchid_array > 0).sum()
+
+
+# Worker run in a separate interpreter, with its own resource tracker: attach, detach and exit, then wait for the tracker
+# to finish (it unlinks the blocks still registered with it when the worker exits)
+WORKER = '''
+import os, sys, json
+import source.SharedRasters as sr
+from multiprocessing import resource_tracker
+descriptor = json.loads(sys.argv[1])
+view = sr.attach_raster(descriptor)
+assert view.sum() == 6
+del view
+sr.detach_raster(descriptor)
+tracker = resource_tracker._resource_tracker
+if tracker._fd is not None:
+    os.close(tracker._fd)
+    os.waitpid(tracker._pid, 0)
+'''
+
+
+def test_worker_exit_leaves_block_to_owner():
+    with sr.SharedRasterPool() as pool:
+        descriptor = pool.publish('zone_id_ras', np.arange(4.).reshape(2, 2), np.int32)
+        worker = subprocess.run([sys.executable, '-c', WORKER, json.dumps(descriptor)], cwd=OPENUDM_PATH, capture_output=True, text=True)
+        assert worker.returncode == 0, worker.stderr
+        assert 'leaked' not in worker.stderr
+        # The block is still there to attach to
+        view = sr.attach_raster(descriptor)
+        assert np.array_equal(view, [[0, 1], [2, 3]])
+        del view
+        sr.detach_raster(descriptor)
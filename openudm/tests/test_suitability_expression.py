@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import source.MultiCriteriaEval as mce
+import source.SuitabilityExpression as se
+
+LAYER_NAMES = ['roads.asc', 'slope-100m.asc', '2020_services.asc']
+WEIGHTS = [3.0, 1.0, 4.0]
+
+
+def blocks(seed, shape=(5, 7)):
+    rng = np.random.default_rng(seed)
+    return {se.layer_alias(name): rng.random(shape) for name in LAYER_NAMES}
+
+
+def evaluate(expression, values):
+    return se.SuitabilityExpression(expression, LAYER_NAMES, WEIGHTS).evaluate(values)
+
+
+def test_layer_alias():
+    assert [se.layer_alias(name) for name in LAYER_NAMES] == ['roads', 'slope_100m', '_2020_services']
+
+
+def test_weighted_sum_and_product():
+    values = blocks(0)
+    a, b, c = values['roads'], values['slope_100m'], values['_2020_services']
+    assert np.allclose(evaluate('wsum()', values), (3 * a + b + 4 * c) / 8)
+    assert np.allclose(evaluate('wsum(roads, slope_100m)', values), (3 * a + b) / 4)
+    assert np.allclose(evaluate('wprod(roads, _2020_services)', values), a ** (3 / 7) * c ** (4 / 7))
+
+
+def test_owa():
+    values = blocks(1)
+    # Equal order weights give the weighted sum
+    assert np.allclose(evaluate('owa(1, 1, 1)', values), evaluate('wsum()', values))
+    # All the order weight on the first rank is the maximum
+    stacked = np.stack(list(values.values()))
+    assert np.allclose(evaluate('owa(1, 0, 0)', values), stacked.max(axis=0))
+    assert np.allclose(evaluate('owa(0, 0, 1)', values), stacked.min(axis=0))
+
+
+def test_cap_threshold_and_operators():
+    values = blocks(2)
+    a, b = values['roads'], values['slope_100m']
+    assert np.array_equal(evaluate('cap(roads, 0.4)', values), np.minimum(a, 0.4))
+    assert np.array_equal(evaluate('threshold(roads, 0.4)', values), np.where(a >= 0.4, a, 0))
+    assert np.array_equal(evaluate('(roads > slope_100m) and not (roads > 0.9)', values), ((a > b) & ~(a > 0.9)).astype(float))
+    assert np.allclose(evaluate('where(roads < 0.5, 2 * roads, -slope_100m ** 2)', values), np.where(a < 0.5, 2 * a, -b ** 2))
+
+
+def test_layers_are_the_attractors_used():
+    assert se.SuitabilityExpression('cap(_2020_services, 1) + roads', LAYER_NAMES, WEIGHTS).layers == ['roads', '_2020_services']
+    assert se.SuitabilityExpression('wsum()', LAYER_NAMES, WEIGHTS).layers == ['roads', 'slope_100m', '_2020_services']
+
+
+@pytest.mark.parametrize('expression, message', [
+    ('wsum(rivers)', 'unknown attractor rivers'),
+    ('roads + rivers', 'unknown attractor rivers'),
+    ('median(roads)', 'unknown function median'),
+    ('cap(roads)', 'cap takes 2 arguments, got 1'),
+    ('threshold(roads, 0.1, 0.2)', 'threshold takes 2 arguments, got 3'),
+    ('max()', 'max takes at least 1 arguments, got 0'),
+    ('owa(0.5, 0.5)', 'owa takes one order weight per attractor (3), got 2'),
+    ('wsum(roads * 2)', 'wsum takes attractor names'),
+    ('roads +', 'is not a valid expression'),
+    ('roads[0]', 'unsupported element'),
+])
+def test_invalid_expressions(expression, message):
+    with pytest.raises(ValueError, match=message.replace('(', r'\(').replace(')', r'\)')):
+        se.SuitabilityExpression(expression, LAYER_NAMES, WEIGHTS)
+
+
+def test_row_tiles():
+    array = np.arange(35.0).reshape(7, 5)
+    tiles = list(mce.row_tiles(array, 3))
+    assert [tile.shape[0] for tile in tiles] == [3, 3, 1]
+    assert np.array_equal(np.vstack(tiles), array)
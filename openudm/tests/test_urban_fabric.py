@@ -0,0 +1,179 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+import source.main as main
+import source.RasterToolkit as rt
+import source.UrbanFabric as uf
+
+OPENUDM_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DATA = os.path.join(os.path.dirname(OPENUDM_PATH), 'Data')
+
+# Legacy UFG functions of RasterToolkit.cpp, called by a small driver:
+#   ufg coverage <density folder> <tiles folder>
+#   ufg fabric <build type raster> <tile type raster> <urban fabric raster> <tiles folder>
+LEGACY_DRIVER = '''
+#include <string>
+#include "RasterToolkit.h"
+int main(int argc, char** argv) {
+    if (std::string(argv[1]) == "coverage") UFGCoverageFromDensity(argv[2], argv[3]);
+    else UFGFabricFromCoverage(argv[2], argv[3], argv[4], argv[5]);
+    return 0;
+}
+'''
+
+
+@pytest.fixture(scope='session')
+def legacy_ufg(tmp_path_factory):
+    compiler = shutil.which('g++')
+    if compiler is None:
+        pytest.skip('g++ is needed to build the legacy RasterToolkit')
+    build_path = tmp_path_factory.mktemp('legacy')
+    (build_path / 'driver.cpp').write_text(LEGACY_DRIVER)
+    sources = [str(build_path / 'driver.cpp')] + [os.path.join(OPENUDM_PATH, name) for name in ['RasterToolkit.cpp', 'CSVToolkit.cpp', 'Raster.cpp']]
+    executable = str(build_path / 'ufg')
+    build = subprocess.run([compiler, '-std=c++14', '-O1', '-w', '-I', OPENUDM_PATH] + sources + ['-o', executable], capture_output=True)
+    if build.returncode != 0:
+        pytest.skip('the legacy RasterToolkit does not build: ' + build.stderr.decode()[-200:])
+    def run(*args):
+        subprocess.run([executable] + [str(arg) for arg in args], check=True, capture_output=True)
+    return run
+
+
+def read_asc(file_path):
+    return np.loadtxt(file_path, skiprows=6, ndmin=2)
+
+def read_nodata(file_path):
+    with open(file_path) as f:
+        return float(f.readlines()[5].split()[1])
+
+# Dwellings per hectare raster over every density band and beyond, without development in a third of the cells
+def write_dph(folder, nrows=30, ncols=40):
+    rng = np.random.default_rng(7)
+    dph = np.where(rng.random((nrows, ncols)) < 0.33, 0, rng.integers(1, 130, (nrows, ncols))).astype(np.float64)
+    header_values = [ncols, nrows, 240000, 644000, 100, 0]
+    rt.write_raster_to_file(dph, os.path.join(folder, 'out_cell_dph.asc'), rt.header_lines(header_values))
+    return dph, header_values
+
+
+def test_coverage_from_density_matches_legacy(tmp_path, legacy_ufg):
+    (tmp_path / 'legacy').mkdir()
+    dph, header_values = write_dph(tmp_path / 'legacy')
+    legacy_ufg('coverage', tmp_path / 'legacy', uf.DEFAULT_TILES_PATH)
+    legacy = {key: read_asc(tmp_path / 'legacy' / f'out_cell_{key}.asc') for key in uf.COVERAGE_OUTPUTS}
+    outputs = uf.ufg_coverage_from_density(dph, str(tmp_path), header_values, seed=0)
+
+    # The density band is deterministic, and written with the legacy NODATA value
+    assert np.array_equal(outputs['density_band'], legacy['density_band'])
+    assert read_nodata(tmp_path / 'out_cell_density_band.asc') == read_nodata(tmp_path / 'legacy' / 'out_cell_density_band.asc') == uf.BAND_NODATA
+    # Building types are drawn at random: both draws develop the same cells, with types the band's deck holds
+    library = uf.load_tile_library()
+    assert np.array_equal(outputs['build_type'] > 0, legacy['build_type'] > 0)
+    for build_type in (outputs['build_type'], legacy['build_type'].astype(np.int64)):
+        developed = build_type > 0
+        deck = np.diff(library['band_cards'], axis=1, prepend=0)[outputs['density_band'][developed]]
+        assert (deck[np.arange(developed.sum()), build_type[developed] - 1] > 0).all()
+    # Given the legacy building types, the tile types and coverages are the legacy ones
+    legacy_build_type = legacy['build_type'].astype(np.int64)
+    tile_type = uf.find_tile_type(dph.astype(np.int64), legacy_build_type, library)
+    assert np.array_equal(tile_type, legacy['tile_type'])
+    for key, coverage in uf.tile_coverages(legacy_build_type, tile_type, library).items():
+        assert np.array_equal(coverage, legacy[key])
+
+
+def test_pipeline_urban_fabric(tmp_path):
+    data_path = tmp_path / 'data'
+    shutil.copytree(SAMPLE_DATA, data_path)
+    pd.DataFrame({'zone_identity': [0], 'zone_code': ['S12000011'], 'dwellings_increase': [12000]}).to_csv(data_path / 'dwellings.csv', index=False)
+    parameters = pd.read_csv(data_path / 'parameters.csv')
+    parameters['density_calculation_type'] = 3
+    parameters['dwellings_per_hectare'] = 30
+    parameters['urban_fabric'] = 1
+    parameters['urban_fabric_seed'] = 3
+    parameters.to_csv(data_path / 'parameters.csv', index=False)
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+    main.main(str(data_path) + os.sep, str(output_path) + os.sep)
+
+    # The stage uses the dwelling density of the run, as written to out_cell_dph
+    dph = read_asc(output_path / 'out_cell_dph.asc')
+    expected = uf.coverage_from_density(dph, 0, uf.load_tile_library(), seed=3)
+    for key, file_path in uf.coverage_file_paths(str(output_path)).items():
+        assert np.array_equal(read_asc(file_path), expected[key])
+    assert (expected['build_type'] > 0).sum() == (dph > 0).sum() > 0
+    # The urban fabric stage stamps the tiles of those rasters
+    fabric = uf.fabric_from_coverage(expected['build_type'], expected['build_cov'], uf.FABRIC_NODATA, uf.load_tile_library(),
+                                     expected['tile_type'], seed=3)
+    assert np.array_equal(read_asc(output_path / 'out_uf.asc'), fabric)
+
+
+def tile_blocks(fabric, scale):
+    nrows, ncols = fabric.shape[0] // scale, fabric.shape[1] // scale
+    return fabric.reshape(nrows, scale, ncols, scale).transpose(0, 2, 1, 3)
+
+
+def test_fabric_from_coverage_matches_legacy(tmp_path, legacy_ufg):
+    dph, header_values = write_dph(tmp_path)
+    legacy_ufg('coverage', tmp_path, uf.DEFAULT_TILES_PATH)
+    coverage_files = uf.coverage_file_paths(str(tmp_path))
+    legacy_ufg('fabric', coverage_files['build_type'], coverage_files['tile_type'], tmp_path / 'legacy_uf.asc', uf.DEFAULT_TILES_PATH)
+    legacy = read_asc(tmp_path / 'legacy_uf.asc')
+    library = uf.load_tile_library()
+    scale = library['tile_scale']
+    tiles = library['tiles'].reshape(-1, 2, scale, scale)
+    build_type = read_asc(coverage_files['build_type']).astype(np.int64)
+    tile_type = read_asc(coverage_files['tile_type']).astype(np.int64)
+    developed = build_type > 0
+    tile_numbers = (tile_type[developed] // 10 - 1) * library['tile_dph'].shape[1] + tile_type[developed] % 10 - 1
+
+    fabric = uf.ufg_fabric_from_coverage(coverage_files['build_type'], coverage_files['build_cov'], str(tmp_path / 'out_uf.asc'),
+                                         header_values, coverage_files['tile_type'], seed=0)
+    assert np.array_equal(read_asc(tmp_path / 'out_uf.asc'), fabric)
+    with open(tmp_path / 'out_uf.asc') as f, open(tmp_path / 'legacy_uf.asc') as g:
+        assert f.readlines()[:5] == g.readlines()[:5]
+    assert fabric.shape == legacy.shape
+    # Cells without development are the legacy -1; developed cells hold the tile of their tile type, rotated at random in both
+    assert np.array_equal(fabric == uf.FABRIC_NODATA, legacy == uf.FABRIC_NODATA)
+    for stamped in (tile_blocks(fabric, scale)[developed], tile_blocks(legacy, scale)[developed]):
+        assert ((stamped == tiles[tile_numbers, 0]).all(axis=(1, 2)) | (stamped == tiles[tile_numbers, 1]).all(axis=(1, 2))).all()
+
+
+def test_match_tiles_picks_nearest_coverage_tile():
+    library = uf.load_tile_library()
+    num_types, num_tiles = library['build_cov'].shape
+    rng = np.random.default_rng(5)
+    # Coverages around and between the tile coverages, including exact matches, equal-coverage tiles and midpoints
+    build_cov = np.concatenate([rng.integers(0, 10000, 1600), library['build_cov'].ravel().repeat(10),
+                                (library['build_cov'][:, :-1] + library['build_cov'][:, 1:]).ravel() // 2])
+    build_type = rng.integers(1, num_types + 1, len(build_cov))
+    tile_numbers = uf.match_tiles(build_type, build_cov, uf.build_tile_index(library))
+    # Brute force: the nearest tile of the cell's building type, ties to the lower coverage, then to the first tile
+    for k, cov, tile_number in zip(build_type, build_cov, tile_numbers):
+        tile_covs = library['build_cov'][k - 1]
+        expected = min(range(num_tiles), key=lambda t: (abs(int(cov) - tile_covs[t]), tile_covs[t], t))
+        assert tile_number == (k - 1) * num_tiles + expected
+
+
+def test_pipeline_urban_fabric_matched_on_coverage(tmp_path):
+    data_path = tmp_path / 'data'
+    shutil.copytree(SAMPLE_DATA, data_path)
+    pd.DataFrame({'zone_identity': [0], 'zone_code': ['S12000011'], 'dwellings_increase': [12000]}).to_csv(data_path / 'dwellings.csv', index=False)
+    parameters = pd.read_csv(data_path / 'parameters.csv')
+    parameters['density_calculation_type'] = 3
+    parameters['dwellings_per_hectare'] = 30
+    parameters['urban_fabric'] = 1
+    parameters['urban_fabric_seed'] = 3
+    parameters['urban_fabric_match'] = 'coverage'
+    parameters.to_csv(data_path / 'parameters.csv', index=False)
+    output_path = tmp_path / 'output'
+    output_path.mkdir()
+    main.main(str(data_path) + os.sep, str(output_path) + os.sep)
+
+    coverage_files = uf.coverage_file_paths(str(output_path))
+    build_type = read_asc(coverage_files['build_type']).astype(np.int64)
+    build_cov = read_asc(coverage_files['build_cov']).astype(np.int64)
+    fabric = uf.fabric_from_coverage(build_type, build_cov, uf.FABRIC_NODATA, uf.load_tile_library(), seed=3)
+    assert np.array_equal(read_asc(output_path / 'out_uf.asc'), fabric)
+    assert (fabric != uf.FABRIC_NODATA).any()
@@ -0,0 +1,91 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import source.RasterToolkit as rt
+import source.VectorInput as vi
+
+HEADER_VALUES = [4, 3, 1000, 2000, 100, -1]
+
+
+def polygon(xmin, ymin, xmax, ymax, **properties):
+    ring = [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]
+    return {'type': 'Feature', 'properties': properties, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+
+
+def write_geojson(file_path, features):
+    with open(file_path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return str(file_path)
+
+
+def test_vector_files_and_fingerprints(tmp_path):
+    assert vi.is_vector_file('zones.GPKG') and vi.is_vector_file('roads.shp') and not vi.is_vector_file('roads.asc')
+    for part in ['.shp', '.dbf']:
+        (tmp_path / ('zones' + part)).write_text('x')
+    shapefile = str(tmp_path / 'zones.shp')
+    assert [entry.split(':')[0] for entry in vi.layer_fingerprint(shapefile).split('|')] == ['zones.shp', 'zones.dbf']
+    # A change to another part of a shapefile changes its fingerprint
+    before = vi.layer_fingerprint(shapefile)
+    (tmp_path / 'zones.dbf').write_text('xy')
+    assert vi.layer_fingerprint(shapefile) != before
+
+
+def test_cache_key_is_written_after_the_file(tmp_path):
+    cache_path = str(tmp_path / 'cache' / 'roads.coverage.npy')
+    key = vi.cache_key({'vector': 'roads.gpkg:1-2', 'grid': HEADER_VALUES[:5]})
+    assert key == vi.cache_key({'grid': HEADER_VALUES[:5], 'vector': 'roads.gpkg:1-2'})
+    assert not vi.cache_valid(cache_path, key)
+    vi.write_npy_cache(cache_path, np.arange(12.0).reshape(3, 4), key)
+    assert vi.cache_valid(cache_path, key) and not vi.cache_valid(cache_path, vi.cache_key({}))
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['roads.coverage.npy', 'roads.coverage.npy.key']
+
+
+def test_zone_code_mapping_and_reference_header(tmp_path):
+    pd.DataFrame({'zone_identity': [0, 1], 'zone_code': ['S1', 'S2'], 'current_population': [5, 6]}).to_csv(tmp_path / 'population.csv', index=False)
+    assert vi.zone_code_mapping(str(tmp_path / 'population.csv')) == {'S1': 0, 'S2': 1}
+    np.savetxt(tmp_path / 'grid.asc', np.zeros((3, 4)), fmt='%d', header=''.join(rt.header_lines([4, 3, 1000, 2000, 100, -9999])).rstrip('\n'), comments='')
+    assert vi.reference_header_values(str(tmp_path / 'grid.asc'), -1) == HEADER_VALUES
+
+
+def test_rasterise_zones_by_cell_centre(tmp_path, capsys):
+    pytest.importorskip('geopandas')
+    pytest.importorskip('rasterio')
+    # S1 covers the two left columns and the centre of column 2; the unknown code S9 is left as NoData
+    zones = write_geojson(tmp_path / 'zones.geojson', [polygon(1000, 2000, 1260, 2300, code='S1'), polygon(1300, 2000, 1400, 2100, code='S9')])
+    zone_ras = vi.rasterise_zones(zones, 'code', {'S1': 0, 'S2': 1}, HEADER_VALUES)
+    assert np.array_equal(zone_ras, np.tile([0, 0, 0, -1], (3, 1)))
+    output = capsys.readouterr().out
+    assert 'not in the zone table, left as NoData: S9' in output and 'no feature in' in output
+    with pytest.raises(ValueError, match='has no field zone_code'):
+        vi.rasterise_zones(zones, 'zone_code', {'S1': 0}, HEADER_VALUES)
+
+
+def test_cached_coverage_area_is_read_from_its_cache(tmp_path):
+    vector_path = write_geojson(tmp_path / 'water.geojson', [polygon(1000, 2000, 1150, 2300)])
+    cache_dir = str(tmp_path / 'vector_coverage')
+    cached = np.full((3, 4), 2500.0)
+    key = vi.cache_key({'vector': vi.vector_fingerprint(vector_path), 'grid': HEADER_VALUES[:5], 'supersample': 4})
+    vi.write_npy_cache(os.path.join(cache_dir, 'water.geojson.coverage.npy'), cached, key)
+    # The layer reader takes the coverage of a vector file from the cache, and reads grids with the raster reader
+    raster_reader = lambda file_path: np.zeros((3, 4))
+    raster_reader.key = 'aligned'
+    read_layer = vi.constraint_layer_reader(HEADER_VALUES, cache_dir, supersample=4, raster_reader=raster_reader)
+    assert np.array_equal(read_layer(vector_path), cached)
+    assert np.array_equal(read_layer(str(tmp_path / 'roads.asc')), np.zeros((3, 4)))
+    assert read_layer.key == 'supersample=4|aligned'
+
+
+def test_coverage_area_of_polygons(tmp_path, monkeypatch):
+    pytest.importorskip('geopandas')
+    pytest.importorskip('rasterio')
+    # Column 0 is covered, column 1 half covered, and the top right cell half covered by two overlapping polygons, counted once
+    vector_path = write_geojson(tmp_path / 'water.geojson', [polygon(1000, 2000, 1150, 2300), polygon(1300, 2250, 1400, 2300),
+                                                             polygon(1300, 2250, 1400, 2300)])
+    expected = np.zeros((3, 4))
+    expected[:, 0], expected[:, 1], expected[0, 3] = 10000, 5000, 5000
+    assert np.allclose(vi.coverage_area(vector_path, HEADER_VALUES, supersample=10), expected)
+    # Tiles of one row give the same coverage
+    monkeypatch.setattr(vi, 'TILE_SUBCELLS', 1)
+    assert np.allclose(vi.coverage_area(vector_path, HEADER_VALUES, supersample=10), expected)